@@ -11,6 +11,7 @@ Class that calculate adjoint source using asdf
 """
 from __future__ import (absolute_import, division, print_function)
 from functools import partial
+import os
 import inspect
 import json
 import pyadjoint
@@ -19,7 +20,10 @@ from pytomo3d.adjoint.adjsrc import calculate_adjsrc_on_stream
 from pytomo3d.adjoint.process_adjsrc import process_adjoint
 from .procbase import ProcASDFBase
 from .adjoint_util import reshape_adj, calculate_chan_weight
-from .utils import smart_read_json
+from .utils import JSONStreamWriter
+from .window_store import smart_load_windows, scatter_windows, \
+    read_window_counts_from_asdf, read_windows_from_asdf
+from .stations import count_station_windows
 
 
 def dump_json(content, filename):
@@ -186,15 +190,91 @@ class AdjointASDF(ProcASDFBase):
                              "than max_period(%5.1f)" % (param["min_period"],
                                                          param["max_period"]))
 
-    def load_windows(self, winfile):
+    def load_windows(self, winfile, bcast=True):
         """
-        load window json file
+        load window file, in json or npz format
 
         :param winfile:
+        :param bcast: broadcast windows to all ranks in mpi mode. If
+            False, only rank 0 gets the windows.
         :return:
         """
-        return smart_read_json(winfile, mpi_mode=self.mpi_mode,
-                               object_hook=False)
+        return smart_load_windows(winfile, mpi_mode=self.mpi_mode,
+                                  comm=self.comm, bcast=bcast)
+
+    @staticmethod
+    def station_costs(stations, windows):
+        """
+        Estimate the cost of each station by its number of windows,
+        since calculate_adjsrc_on_stream scales with it
+
+        :return: dict of cost of each station
+        """
+        return dict((sta, count_station_windows(windows[sta]))
+                    for sta in stations)
+
+    def _load_asdf_windows(self, window_file, obsd_ds, synt_ds, stations):
+        """
+        Windows stored inside an asdf file. The window counts are read
+        on rank 0, then each rank reads the windows of only its own
+        stations from the file.
+        """
+        window_ds = None
+        for ds in [obsd_ds, synt_ds]:
+            if os.path.abspath(ds.filename) == os.path.abspath(window_file):
+                window_ds = ds
+        if window_ds is None:
+            window_ds = self.load_asdf(window_file, mode="r")
+
+        if not self.mpi_mode or self.rank == 0:
+            counts = read_window_counts_from_asdf(window_ds)
+        else:
+            counts = None
+        if self.mpi_mode:
+            counts = self.comm.bcast(counts, root=0)
+
+        stations = [sta for sta in stations if counts.get(sta, 0) > 0]
+        costs = dict((sta, counts[sta]) for sta in stations)
+        windows = read_windows_from_asdf(
+            window_ds, self.executor.local_stations(stations, costs=costs))
+        return stations, costs, windows
+
+    def load_station_windows(self, window_file, obsd_ds, synt_ds, obsd_tag,
+                             synt_tag, obsd_staxml=False):
+        """
+        Load windows and build the station index. The window file could
+        be windows.json, windows.npz or an asdf file(".h5") with windows
+        inside, for example, the observed or synthetic asdf file.
+
+        :return: stations to process, cost of each station and windows
+        """
+        if os.path.splitext(window_file)[1] != ".h5":
+            # in mpi mode, windows are only loaded on rank 0, where the
+            # station index is built, and then scattered by station
+            windows = self.load_windows(window_file,
+                                        bcast=not self.mpi_mode)
+            stations = self.build_station_index(
+                obsd_ds, synt_ds, obsd_tag, synt_tag,
+                obsd_staxml=obsd_staxml, windows=windows)
+            # balance the ranks by number of windows
+            if not self.mpi_mode:
+                costs = self.station_costs(stations, windows)
+                return stations, costs, windows
+
+            if self.rank == 0:
+                costs = self.station_costs(stations, windows)
+            else:
+                costs = None
+            costs = self.comm.bcast(costs, root=0)
+            partition = self.executor.partition_stations(stations,
+                                                         costs=costs)
+            windows = scatter_windows(windows, partition, comm=self.comm)
+            return stations, costs, windows
+
+        stations = self.build_station_index(
+            obsd_ds, synt_ds, obsd_tag, synt_tag, obsd_staxml=obsd_staxml)
+        return self._load_asdf_windows(window_file, obsd_ds, synt_ds,
+                                       stations)
 
     def _core(self, path, param):
         """
@@ -238,14 +318,16 @@ class AdjointASDF(ProcASDFBase):
         figure_dir = path["figure_dir"]
 
         event = obsd_ds.events[0]
-        windows = self.load_windows(window_file)
+        stations, costs, windows = self.load_station_windows(
+            window_file, obsd_ds, synt_ds, obsd_tag, synt_tag,
+            obsd_staxml=True)
 
         adj_src_type = adjoint_param["adj_src_type"]
         adjoint_param.pop("adj_src_type", None)
 
         config = load_adjoint_config(adjoint_param)
 
-        if self.mpi_mode and self.rank == 0:
+        if self.rank == 0:
             output_ds = ASDFDataSet(output_filename, mpi=False)
             if output_ds.events:
                 output_ds.events = obsd_ds.events
@@ -261,8 +343,9 @@ class AdjointASDF(ProcASDFBase):
                     postproc_param=postproc_param,
                     figure_mode=figure_mode, figure_dir=figure_dir)
 
-        results = obsd_ds.process_two_files(synt_ds, adjsrc_func,
-                                            output_filename)
+        results = self.process_two_files(obsd_ds, synt_ds, adjsrc_func,
+                                         output_filename=output_filename,
+                                         stations=stations, costs=costs)
         return results
 
 
@@ -315,7 +398,7 @@ class MeasureAdjointASDF(AdjointASDF):
     """
     Make measurements on ASDF file. The output file is the json
     file which contains measurements for all the windows in
-    the window file
+    the window file. No asdf file is written.
     """
     def _core(self, path, param):
         """
@@ -357,29 +440,34 @@ class MeasureAdjointASDF(AdjointASDF):
         synt_ds = self.load_asdf(synt_file, mode="r")
 
         event = obsd_ds.events[0]
-        windows = self.load_windows(window_file)
+        stations, costs, windows = self.load_station_windows(
+            window_file, obsd_ds, synt_ds, obsd_tag, synt_tag)
 
         adj_src_type = adjoint_param["adj_src_type"]
         adjoint_param.pop("adj_src_type", None)
 
         config = load_adjoint_config(adjoint_param)
 
-        if self.mpi_mode and self.rank == 0:
-            output_ds = ASDFDataSet(output_filename, mpi=False)
-            if output_ds.events:
-                output_ds.events = obsd_ds.events
-            del output_ds
-        if self.mpi_mode:
-            self.comm.barrier()
-
         measure_adj_func = \
             partial(measure_adjoint_wrapper, config=config,
                     obsd_tag=obsd_tag, synt_tag=synt_tag,
                     windows=windows, event=event,
                     adj_src_type=adj_src_type)
 
-        results = obsd_ds.process_two_files(synt_ds, measure_adj_func)
-
+        # no asdf output here. Measurements are streamed to rank 0
+        # and written into the json file incrementally
+        writer = None
         if self.rank == 0:
             print("output filename: %s" % output_filename)
-            dump_json(results, output_filename)
+            writer = JSONStreamWriter(output_filename)
+            writer.open()
+
+        def _write_results(results):
+            writer.write_items(results)
+
+        self.process_two_files(obsd_ds, synt_ds, measure_adj_func,
+                               stations=stations, costs=costs,
+                               result_handler=_write_results)
+
+        if self.rank == 0:
+            writer.close()
@@ -15,7 +15,11 @@ Class that handles the whole preprocessing workflow, including:
 from __future__ import (absolute_import, division, print_function)
 from functools import partial
 
+from pyasdf import ASDFDataSet
 from .procbase import ProcASDFBase
+from .executor import add_auxiliary_results, add_process_results
+from .write_window import window_json_writer, write_station_windows
+from .utils import smart_mkdir, JSONStreamWriter
 from pytomo3d.signal.process import process_stream
 from pytomo3d.adjoint.adjsrc import calculate_adjsrc_on_stream
 from pytomo3d.adjoint.process_adjsrc import process_adjoint
@@ -24,7 +28,6 @@ from .adjoint_util import calculate_chan_weight, reshape_adj
 from .adjoint_util import smart_transform_window
 import pyflex
 import pyadjoint
-import copy
 
 
 def load_window_config(param):
@@ -35,21 +38,39 @@ def load_window_config(param):
 
 
 def load_adjoint_config(param):
+    """
+    Load adjoint param into pyadjoint.Config. The input param is
+    not modified.
+
+    :return: pyadjoint.Config and adjoint source type
+    """
     adj_src_type = param["adj_src_type"]
-    param.pop("adj_src_type", None)
-    config = pyadjoint.Config(**param)
+    config_param = dict((k, v) for k, v in param.iteritems()
+                        if k != "adj_src_type")
+    config = pyadjoint.Config(**config_param)
     return config, adj_src_type
 
 
 def func_wrapper(obsd_station_group, synt_station_group, obsd_tag=None,
-                 synt_tag=None, event=None, param=None, _verbose=False,
-                 figure_mode=False, figure_dir=None):
+                 synt_tag=None, event=None, param=None, window_config=None,
+                 adj_config=None, adj_src_type=None, _verbose=False,
+                 figure_mode=False, figure_dir=None, checkpoint_stages=None):
     """
     combo function, including:
     1) observed data signal processing
     2) synthetic data signal processing
     3) window selection based on a pair of data
     4) adjoint source constructor
+
+    param is shared by all stations and read only. window_config and
+    adj_config should be built once per event, see AdjPreASDF._core.
+    If not provided, they are built from param.
+
+    If checkpoint_stages is given, the adjoint sources are returned
+    in a dict under key "adjsrcs", together with the intermediate
+    products listed in checkpoint_stages, out of "proc_obsd",
+    "proc_synt", "windows" and "measurements". Products not listed are
+    left out, so they are not gathered.
     """
     # Make sure everything thats required is there.
     _station_name = obsd_station_group._station_name
@@ -66,8 +87,6 @@ def func_wrapper(obsd_station_group, synt_station_group, obsd_tag=None,
         raise ValueError("synt station group '%s' missing '%s'"
                          % (_station_name, synt_tag))
 
-    param = copy.deepcopy(param)
-
     obsd_staxml = obsd_station_group.StationXML
     synt_staxml = synt_station_group.StationXML
     observed = getattr(obsd_station_group, obsd_tag)
@@ -83,23 +102,46 @@ def func_wrapper(obsd_station_group, synt_station_group, obsd_tag=None,
     synt_param = param["proc_synt_param"]
     new_synt = process_stream(synthetic, inventory=synt_staxml, **synt_param)
 
-    window_config = load_window_config(param["window_param"])
+    if window_config is None:
+        window_config = load_window_config(param["window_param"])
     windows = window_on_stream(new_obsd, new_synt, window_config,
                                station=synt_staxml, event=event,
                                figure_mode=figure_mode, figure_dir=figure_dir,
                                _verbose=_verbose)
+
+    checkpoint = checkpoint_stages is not None
+    stage_results = {"adjsrcs": None}
+    if checkpoint:
+        if "windows" in checkpoint_stages:
+            stage_results["windows"] = windows
+        if "measurements" in checkpoint_stages:
+            stage_results["measurements"] = None
+        if "proc_obsd" in checkpoint_stages:
+            stage_results["proc_obsd"] = {"inventory": obsd_staxml,
+                                          "stream": new_obsd}
+        if "proc_synt" in checkpoint_stages:
+            stage_results["proc_synt"] = {"inventory": synt_staxml,
+                                          "stream": new_synt}
+
     if len(windows) == 0:
         # No windows selected
+        if checkpoint:
+            return stage_results
         return
 
     windows = smart_transform_window(windows)
 
-    adj_config, adj_src_type = load_adjoint_config(param["adjsrc_param"])
+    if adj_config is None:
+        adj_config, adj_src_type = load_adjoint_config(param["adjsrc_param"])
     adjsrcs = calculate_adjsrc_on_stream(
         new_obsd, new_synt, windows, adj_config, adj_src_type,
         figure_mode=figure_mode, figure_dir=figure_dir,
         adjoint_src_flag=True)
 
+    if checkpoint and "measurements" in checkpoint_stages:
+        stage_results["measurements"] = \
+            dict((adj.id, adj.measurement) for adj in adjsrcs)
+
     chan_weight_dict = calculate_chan_weight(adjsrcs, windows)
 
     interp_starttime = _raw_synt_tr.stats.starttime
@@ -117,15 +159,105 @@ def func_wrapper(obsd_station_group, synt_station_group, obsd_tag=None,
     time_offset = interp_starttime - origin.time
     results = reshape_adj(new_adjsrcs, time_offset, synt_staxml)
 
+    if checkpoint:
+        stage_results["adjsrcs"] = results
+        return stage_results
     return results
 
 
+class CheckpointWriter(object):
+    """
+    Writer of the adjoint sources and the intermediate products of the
+    stages in checkpoint mode, see AdjPreASDF._checkpoint_mode. The
+    outputs are opened once and the results of each rank(or chunk) are
+    appended as they arrive, so the results of all stations are never
+    held in memory together. Use write_results as the result_handler
+    of process_two_files. It should only be opened on rank 0.
+
+    :param path: path dict of AdjPreASDF
+    :param events: events of the processed waveform outputs
+    """
+
+    def __init__(self, path, events):
+        self.path = path
+        self.events = events
+        self._output_ds = None
+        self._proc_ds = {}
+        self._window_writer = None
+        self._measure_writer = None
+
+    def open(self):
+        path = self.path
+        self._output_ds = ASDFDataSet(path["output_asdf"], mode="a",
+                                      mpi=False)
+        for key in ["proc_obsd", "proc_synt"]:
+            if "%s_asdf" % key not in path:
+                continue
+            print("Output processed waveforms(%s): %s"
+                  % (path["%s_tag" % key], path["%s_asdf" % key]))
+            ds = ASDFDataSet(path["%s_asdf" % key], mode="a", mpi=False)
+            ds.events = self.events
+            self._proc_ds[key] = ds
+        if "window_dir" in path:
+            self._window_writer = window_json_writer(path["window_dir"])
+            self._window_writer.open()
+        if "measure_file" in path:
+            print("Output measurements: %s" % path["measure_file"])
+            self._measure_writer = JSONStreamWriter(path["measure_file"])
+            self._measure_writer.open()
+
+    def write_results(self, results):
+        """
+        Append the results of a few stations, as returned by
+        func_wrapper with checkpoint_stages
+        """
+        results = dict((sta, value) for sta, value in results.iteritems()
+                       if value is not None)
+        add_auxiliary_results(
+            self._output_ds,
+            dict((sta, value["adjsrcs"])
+                 for sta, value in results.iteritems()))
+
+        for key, ds in self._proc_ds.iteritems():
+            tag = self.path["%s_tag" % key]
+            add_process_results(
+                ds, dict((sta, {"inventory": value[key]["inventory"],
+                                "streams": [(tag, value[key]["stream"])]})
+                         for sta, value in results.iteritems()))
+
+        if self._window_writer is not None:
+            write_station_windows(
+                self._window_writer,
+                dict((sta, value["windows"])
+                     for sta, value in results.iteritems()))
+
+        if self._measure_writer is not None:
+            self._measure_writer.write_items(
+                dict((sta, value["measurements"])
+                     for sta, value in results.iteritems()))
+
+    def close(self):
+        """ Close the outputs. Nothing happens if they are not opened """
+        if self._window_writer is not None:
+            self._window_writer.close()
+            self._window_writer = None
+        if self._measure_writer is not None:
+            self._measure_writer.close()
+            self._measure_writer = None
+        # the asdf files are closed once the datasets are released
+        self._proc_ds = {}
+        self._output_ds = None
+
+
 class AdjPreASDF(ProcASDFBase):
 
     def __init__(self, path, param, components=["Z", "R", "T"],
-                 verbose=False):
+                 verbose=False, executor=None, nworkers=None,
+                 event_farm=False):
 
-        ProcASDFBase.__init__(self, path, param, verbose=verbose)
+        ProcASDFBase.__init__(self, path, param, verbose=verbose,
+                              executor=executor, nworkers=nworkers,
+                              event_farm=event_farm)
         self.components = components
 
     def _parse_param(self):
@@ -163,6 +295,29 @@ class AdjPreASDF(ProcASDFBase):
         necessary_keys = ["obsd_asdf", "obsd_tag", "synt_asdf", "synt_tag",
                           "output_asdf", "figure_mode", "figure_dir"]
         self._missing_keys(necessary_keys, path)
+        # tags are required for the processed waveform outputs
+        for key in ["proc_obsd", "proc_synt"]:
+            if "%s_asdf" % key in path:
+                self._missing_keys(["%s_tag" % key], path)
+
+    @staticmethod
+    def _checkpoint_mode(path):
+        """
+        Checkpoint mode is on if any of the stage output is specified
+        in path, including "proc_obsd_asdf", "proc_synt_asdf",
+        "window_dir" and "measure_file"
+
+        :return: list of the stage products to keep, see func_wrapper,
+            or None if checkpoint mode is off
+        """
+        outputs = [("proc_obsd_asdf", "proc_obsd"),
+                   ("proc_synt_asdf", "proc_synt"),
+                   ("window_dir", "windows"),
+                   ("measure_file", "measurements")]
+        stages = [stage for key, stage in outputs if key in path]
+        if len(stages) == 0:
+            return None
+        return stages
 
     def _validate_param(self, param):
         necessary_keys = ["proc_obsd_param", "proc_synt_param", "adjsrc_param",
@@ -206,6 +361,14 @@ class AdjPreASDF(ProcASDFBase):
         self.check_input_file(synt_file)
         self.check_output_file(output_file)
 
+        checkpoint_stages = self._checkpoint_mode(path)
+        for key in ["proc_obsd_asdf", "proc_synt_asdf", "measure_file"]:
+            if key in path:
+                self.check_output_file(path[key])
+        if "window_dir" in path:
+            smart_mkdir(path["window_dir"], mpi_mode=self.mpi_mode,
+                        comm=self.comm)
+
         obsd_ds = self.load_asdf(obsd_file, mode="r")
         synt_ds = self.load_asdf(synt_file, mode="r")
         synt_tag = path["synt_tag"]
@@ -215,8 +378,36 @@ class AdjPreASDF(ProcASDFBase):
 
         self._refine_param(param, event)
 
-        proc_func = partial(func_wrapper, event=event, obsd_tag=obsd_tag,
-                            synt_tag=synt_tag, param=param)
+        # build the configs once and share them with all stations
+        window_config = load_window_config(param["window_param"])
+        adj_config, adj_src_type = load_adjoint_config(param["adjsrc_param"])
 
-        obsd_ds.process_two_files(
-            synt_ds, proc_func, output_filename=output_file)
+        proc_func = partial(func_wrapper, event=event, obsd_tag=obsd_tag,
+                            synt_tag=synt_tag, param=param,
+                            window_config=window_config,
+                            adj_config=adj_config, adj_src_type=adj_src_type,
+                            checkpoint_stages=checkpoint_stages)
+
+        stations = self.build_station_index(
+            obsd_ds, synt_ds, obsd_tag, synt_tag, obsd_staxml=True,
+            synt_staxml=True)
+
+        if checkpoint_stages is None:
+            self.process_two_files(obsd_ds, synt_ds, proc_func,
+                                   output_filename=output_file,
+                                   stations=stations)
+            return
+
+        # in checkpoint mode, the stage results are written out on
+        # rank 0 as they arrive, one rank(or chunk) at a time
+        writer = CheckpointWriter(path, obsd_ds.events)
+        if self.rank == 0:
+            writer.open()
+        try:
+            self.process_two_files(obsd_ds, synt_ds, proc_func,
+                                   stations=stations,
+                                   result_handler=writer.write_results)
+        finally:
+            writer.close()
+        if self.mpi_mode:
+            self.comm.barrier()
@@ -24,9 +24,16 @@ def main():
                         help="param file")
     parser.add_argument('-v', action='store_true', dest='verbose',
                         help="verbose flag")
+    parser.add_argument('-n', action='store', dest='nworkers', type=int,
+                        default=1,
+                        help="number of worker processes for receiver "
+                             "weighting")
+    parser.add_argument('-m', action='store_true', dest='mpi_mode',
+                        help="distribute receiver weighting over mpi ranks")
     args = parser.parse_args()
 
-    weightobj = WindowWeight(args.path_file, args.param_file)
+    weightobj = WindowWeight(args.path_file, args.param_file,
+                             nworkers=args.nworkers, mpi_mode=args.mpi_mode)
     weightobj.run()
 
 
@@ -14,10 +14,18 @@ def main():
     parser.add_argument('filename', help="Input ASDF filename")
     parser.add_argument('-v', action='store_true', dest='verbose',
                         help="verbose")
+    parser.add_argument('-f', action='store', dest='output_format',
+                        default="ascii", choices=["ascii", "asdf"],
+                        help="output format: ascii(.adj files) or "
+                             "asdf(adjoint.h5)")
+    parser.add_argument('-n', action='store', dest='nworkers', type=int,
+                        default=4,
+                        help="number of worker processes to write files")
     args = parser.parse_args()
 
     convert_adjsrcs_from_asdf(
-        args.filename, args.outputdir, _verbose=args.verbose)
+        args.filename, args.outputdir, _verbose=args.verbose,
+        output_format=args.output_format, nworkers=args.nworkers)
 
 
 if __name__ == '__main__':
@@ -13,9 +13,22 @@ def main():
                         help="verbose flag")
     parser.add_argument('-s', action='store_true', dest='status_bar',
                         help="status bar flag")
+    parser.add_argument('-n', action='store', dest='nworkers', type=int,
+                        default=1,
+                        help="number of worker processes to read the files "
+                             "of one event")
+    parser.add_argument('--nevents', action='store', dest='nevents', type=int,
+                        default=1,
+                        help="number of events converted concurrently when "
+                             "the path file contains a list of events")
+    parser.add_argument('-i', action='store_true', dest='incremental',
+                        help="keep existing asdf files and only add new or "
+                             "changed input files")
     args = parser.parse_args()
 
-    converter = ConvertASDF(args.path_file, args.verbose, args.status_bar)
+    converter = ConvertASDF(args.path_file, args.verbose, args.status_bar,
+                            nworkers=args.nworkers, nevents=args.nevents,
+                            incremental=args.incremental)
     converter.run()
 
 
@@ -18,12 +18,23 @@ def main():
                         help="Output StationXML files")
     parser.add_argument('-q', action='store_true', dest="quakeml",
                         help="Output Quakeml file")
+    parser.add_argument('-t', action='store', dest='tags', nargs='+',
+                        default=None, help="waveform tags to export")
+    parser.add_argument('--stations', action='store', dest='stations',
+                        nargs='+', default=None,
+                        help="stations to export, like II.AAK or 'II.*'")
+    parser.add_argument('--channels', action='store', dest='channels',
+                        nargs='+', default=None,
+                        help="channels to export, like BHZ or 'LH?'")
+    parser.add_argument('-n', action='store', dest='nworkers', type=int,
+                        default=1, help="number of worker processes")
     args = parser.parse_args()
 
     convert_from_asdf(
-        args.filename, args.outputdir, filetype="sac",
+        args.filename, args.outputdir, tag=args.tags, filetype="sac",
         output_staxml=args.stationxml, output_quakeml=args.quakeml,
-        _verbose=args.verbose)
+        _verbose=args.verbose, stations=args.stations,
+        channels=args.channels, nworkers=args.nworkers)
 
 
 if __name__ == '__main__':
@@ -0,0 +1,26 @@
+#!/usr/bin/env python
+"""
+Convert window file between json(windows.json) and the binary
+columnar format(npz), based on the extension of the output file
+"""
+import argparse
+
+from pypaw.window_store import convert_window_file
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('-o', action='store', dest='output_file',
+                        required=True,
+                        help="output window file(.json or .npz)")
+    parser.add_argument('-c', action='store_true', dest='compress',
+                        help="compress the npz file")
+    parser.add_argument('filename', help="Input window file(.json or .npz)")
+    args = parser.parse_args()
+
+    convert_window_file(args.filename, args.output_file,
+                        compress=args.compress)
+
+
+if __name__ == '__main__':
+    main()
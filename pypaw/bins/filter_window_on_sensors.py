@@ -18,6 +18,7 @@ from __future__ import (absolute_import, division, print_function)
 import os
 import argparse
 from .utils import load_json, dump_json
+from pypaw.window_store import load_windows, write_window_table
 
 
 def filter_windows(windows, stations, sensor_types, verbose=False):
@@ -87,7 +88,7 @@ def main():
     print("sensor types: %s" % sensor_types)
     print("output filtered window file: %s" % output_file)
 
-    windows = load_json(window_file)
+    windows = load_windows(window_file)
     stations = load_json(station_file)
 
     # filter the window based on given sensor types
@@ -95,7 +96,10 @@ def main():
                                  verbose=args.verbose)
 
     # dump the new windows file to replace the original one
-    dump_json(windows_new, output_file)
+    if os.path.splitext(output_file)[1] == ".npz":
+        write_window_table(windows_new, output_file)
+    else:
+        dump_json(windows_new, output_file)
 
 
 if __name__ == "__main__":
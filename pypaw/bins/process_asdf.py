@@ -13,9 +13,17 @@ def main():
                         help="path file")
     parser.add_argument('-v', action='store_true', dest='verbose',
                         help="verbose flag")
+    parser.add_argument('-n', action='store', dest='nworkers', type=int,
+                        default=None,
+                        help="number of worker processes when running "
+                             "without mpi")
+    parser.add_argument('-e', action='store_true', dest='event_farm',
+                        help="run whole events concurrently when the path "
+                             "file contains a list of events")
     args = parser.parse_args()
 
-    proc = ProcASDF(args.path_file, args.params_file, args.verbose)
+    proc = ProcASDF(args.path_file, args.params_file, args.verbose,
+                    nworkers=args.nworkers, event_farm=args.event_farm)
     proc.smart_run()
 
 
@@ -12,7 +12,8 @@ on certain weights provided by the user
 """
 from __future__ import print_function, division, absolute_import
 import argparse
-from pypaw.sum_adjoint import PostAdjASDF
+from pypaw.sum_adjoint import PostAdjASDF, sum_adjoint_events
+from pypaw.bins import load_json
 
 
 def main():
@@ -21,10 +22,26 @@ def main():
                         help="path file")
     parser.add_argument('-v', action='store_true', dest='verbose',
                         help="verbose flag")
+    parser.add_argument('-s', action='store_true', dest='streaming',
+                        help="sum and write out station by station to "
+                             "bound the memory usage")
+    parser.add_argument('-n', action='store', dest='nworkers', type=int,
+                        default=None,
+                        help="number of worker processes when the path "
+                             "file contains a list of events")
+    parser.add_argument('-o', action='store', dest='summary_file',
+                        default=None,
+                        help="combined misfit summary file of all events")
     args = parser.parse_args()
 
-    job = PostAdjASDF(args.path_file, args.verbose)
-    job.smart_run()
+    path = load_json(args.path_file)
+    if isinstance(path, list):
+        sum_adjoint_events(path, nworkers=args.nworkers,
+                           verbose=args.verbose, streaming=args.streaming,
+                           summary_file=args.summary_file)
+    else:
+        job = PostAdjASDF(path, args.verbose, streaming=args.streaming)
+        job.smart_run()
 
 
 if __name__ == '__main__':
@@ -10,14 +10,32 @@ Methods that contains utils for adjoint sources
     (http://www.gnu.org/licenses/lgpl-3.0.en.html)
 """
 from __future__ import (absolute_import, division, print_function)
+import io
 import os
 import glob
+import json
+import fnmatch
+import hashlib
+from collections import deque
+from functools import partial
 import numpy as np
+from concurrent.futures import ProcessPoolExecutor, as_completed
 from .utils import smart_read_json, drawProgressBar, timing
+from .executor import split_stations
 from pyasdf import ASDFDataSet
-from obspy import UTCDateTime, read
+from obspy import UTCDateTime, Stream, read, read_inventory
 from obspy.core.inventory import Channel, Station, Network, Inventory, Site
 
+# data type of the manifest of converted files in the auxiliary data
+MANIFEST_DATA_TYPE = "ConvertManifest"
+
+# placeholders used to build the StationXML template of simple inventory
+_TEMPLATE_NETWORK = "XQXQX"
+_TEMPLATE_STATION = "SQSQS"
+_TEMPLATE_COORDINATES = {"latitude": 11.125, "longitude": 111.625,
+                         "elevation": 1111.375, "depth": 11.875}
+_SIMPLE_INVENTORY_TEMPLATES = {}
+
 
 def create_simple_inventory(network, station, latitude=None, longitude=None,
                             elevation=None, depth=None, start_date=None,
@@ -59,38 +77,373 @@ def create_simple_inventory(network, station, latitude=None, longitude=None,
     return inv
 
 
-def add_waveform_to_asdf(ds, waveform_filelist, tag, event=None,
-                         create_simple_inv=False, status_bar=False):
+def _simple_inventory_template(start_date, location_code="S3",
+                               channel_code="MX"):
+    """
+    StationXML text of create_simple_inventory, with the codes and
+    coordinates replaced by format fields. It is built once for each
+    start_date and cached, since only the codes and coordinates differ
+    between the stations.
+    """
+    key = (str(start_date), location_code, channel_code)
+    if key in _SIMPLE_INVENTORY_TEMPLATES:
+        return _SIMPLE_INVENTORY_TEMPLATES[key]
+
+    inv = create_simple_inventory(
+        _TEMPLATE_NETWORK, _TEMPLATE_STATION,
+        start_date=start_date, location_code=location_code,
+        channel_code=channel_code, **_TEMPLATE_COORDINATES)
+    buf = io.BytesIO()
+    inv.write(buf, format="STATIONXML")
+    xml = buf.getvalue().decode("utf-8").replace("{", "{{").replace("}", "}}")
+
+    replaces = [('code="%s"' % _TEMPLATE_NETWORK, 'code="{network}"'),
+                ('code="%s"' % _TEMPLATE_STATION, 'code="{station}"')]
+    for field, value in _TEMPLATE_COORDINATES.iteritems():
+        replaces.append((">%s<" % value, ">{%s}<" % field))
+    for old, new in replaces:
+        if old not in xml:
+            raise ValueError("Failed to create StationXML template: '%s' "
+                             "not found" % old)
+        xml = xml.replace(old, new)
+
+    _SIMPLE_INVENTORY_TEMPLATES[key] = xml
+    return xml
+
+
+def create_simple_stationxml(network, station, latitude=None, longitude=None,
+                             elevation=None, depth=None, start_date=None,
+                             location_code="S3", channel_code="MX"):
+    """
+    Same as create_simple_inventory, but returns the StationXML bytes,
+    filled in from the cached template without building the Inventory
+    """
+    if start_date is None:
+        start_date = UTCDateTime(0)
+    template = _simple_inventory_template(
+        start_date, location_code=location_code, channel_code=channel_code)
+    return template.format(
+        network=network, station=station, latitude=repr(float(latitude)),
+        longitude=repr(float(longitude)), elevation=repr(float(elevation)),
+        depth=repr(float(depth))).encode("utf-8")
 
-    nwaveform = len(waveform_filelist)
-    sta_dict = {}
-    # Add waveforms.
-    for _i, filename in enumerate(waveform_filelist):
+
+def add_simple_stationxml_to_asdf(ds, sta_dict, start_date,
+                                  status_bar=False):
+    """
+    Bulk add created StationXML of the stations in sta_dict into the
+    asdf file. The StationXML is written into the station groups
+    directly, the same way as pyasdf stores it, so there is no
+    Inventory parsing and merging for each station. Stations which
+    already have StationXML are skipped.
+
+    :param sta_dict: dict of [network, station, latitude, longitude,
+        elevation, depth], keyed by station tag, from
+        add_waveform_to_asdf
+    """
+    waveform_group = ds._waveform_group
+    nstaxml = len(sta_dict)
+    for count, sta_tag in enumerate(sorted(sta_dict)):
+        value = sta_dict[sta_tag]
+        # station groups are named "NET.STA" in asdf
+        group_name = "%s.%s" % (value[0], value[1])
+        if group_name not in waveform_group:
+            waveform_group.create_group(group_name)
+        sta_group = waveform_group[group_name]
+        if "StationXML" in sta_group:
+            # created in the previous run
+            continue
+        xml = create_simple_stationxml(
+            value[0], value[1], latitude=value[2], longitude=value[3],
+            elevation=value[4], depth=value[5], start_date=start_date)
+        sta_group.create_dataset(
+            "StationXML", data=np.frombuffer(xml, dtype=np.dtype("byte")),
+            maxshape=(None,))
+        if status_bar > 0:
+            drawProgressBar((count+1)/nstaxml,
+                            "Adding StationXML(created) data")
+
+
+def _file_stat(filename):
+    stat = os.stat(filename)
+    return {"size": stat.st_size, "mtime": stat.st_mtime}
+
+
+def _file_hash(filename, blocksize=2**20):
+    md5 = hashlib.md5()
+    with open(filename, "rb") as fh:
+        for block in iter(lambda: fh.read(blocksize), b""):
+            md5.update(block)
+    return md5.hexdigest()
+
+
+def _file_info(filename):
+    """
+    Size, mtime and md5 of the file, recorded in the convert manifest
+    """
+    info = _file_stat(filename)
+    info["md5"] = _file_hash(filename)
+    return info
+
+
+def read_convert_manifest(ds):
+    """
+    Read the manifest of converted input files from the asdf file.
+    It is stored as json text in the auxiliary data
+    "ConvertManifest/manifest".
+
+    :return: dict of manifest, empty if there is no manifest
+    """
+    if MANIFEST_DATA_TYPE not in ds.auxiliary_data:
+        return {}
+    data = ds.auxiliary_data[MANIFEST_DATA_TYPE]["manifest"].data
+    return json.loads(np.asarray(data).tobytes().decode("utf-8"))
+
+
+def write_convert_manifest(ds, manifest):
+    """
+    Write(replace) the manifest of converted input files into the
+    asdf file
+    """
+    aux_group = ds._auxiliary_data_group
+    if MANIFEST_DATA_TYPE in aux_group:
+        del aux_group[MANIFEST_DATA_TYPE]
+    content = json.dumps(manifest, sort_keys=True).encode("utf-8")
+    ds.add_auxiliary_data(np.frombuffer(content, dtype=np.uint8),
+                          data_type=MANIFEST_DATA_TYPE, path="manifest",
+                          parameters={"format": "json"})
+
+
+def _filter_changed_files(filelist, file_manifest):
+    """
+    Find the files which are new or changed compared to the manifest.
+    Files with the same size and mtime are taken as unchanged without
+    being read. Otherwise, the md5 decides.
+
+    :param file_manifest: dict of file info, keyed by absolute path
+    :return: list of new or changed files, and set of changed files
+    """
+    todo = []
+    changed = set()
+    for filename in filelist:
+        entry = file_manifest.get(os.path.abspath(filename))
+        if entry is None:
+            todo.append(filename)
+            continue
+        info = _file_stat(filename)
+        if info["size"] == entry["size"] and info["mtime"] == entry["mtime"]:
+            continue
+        if _file_hash(filename) == entry["md5"]:
+            # touched but not modified
+            entry.update(info)
+            continue
+        todo.append(filename)
+        changed.add(filename)
+    return todo, changed
+
+
+def _read_waveform_file(filename):
+    """
+    Worker function: read one waveform file. Errors are returned
+    instead of raised so one bad file doesn't stop the others.
+    """
+    try:
+        return read(filename), None, _file_info(filename)
+    except Exception as err:
+        return None, err, None
+
+
+def _read_staxml_file(filename):
+    """
+    Worker function: parse one StationXML file.
+    """
+    try:
+        return read_inventory(filename), None, _file_info(filename)
+    except Exception as err:
+        return None, err, None
+
+
+def _read_files_chunk(read_function, filenames):
+    """
+    Worker function: read a chunk of files.
+    """
+    return [read_function(_f) for _f in filenames]
+
+
+def _imap_files(read_function, filelist, nworkers=1, chunksize=16,
+                max_pending=None):
+    """
+    Read files, in input order, in the current process or using a
+    process pool of nworkers workers. Only parsing is done by the
+    workers. Everything written into the asdf file is done by the
+    calling process.
+
+    Files are sent to the workers in chunks of chunksize files, and
+    at most max_pending chunks(2 * nworkers by default) are submitted
+    but not yet consumed, so parsed files don't pile up in memory when
+    the caller falls behind.
+    """
+    if nworkers <= 1:
+        for filename in filelist:
+            yield filename, read_function(filename)
+        return
+
+    if max_pending is None:
+        max_pending = 2 * nworkers
+    worker_function = partial(_read_files_chunk, read_function)
+    pending = deque()
+    with ProcessPoolExecutor(max_workers=nworkers) as pool:
+        for _i in range(0, len(filelist), chunksize):
+            chunk = filelist[_i:(_i + chunksize)]
+            pending.append((chunk, pool.submit(worker_function, chunk)))
+            if len(pending) < max_pending:
+                continue
+            chunk, future = pending.popleft()
+            for filename, res in zip(chunk, future.result()):
+                yield filename, res
+        while len(pending) > 0:
+            chunk, future = pending.popleft()
+            for filename, res in zip(chunk, future.result()):
+                yield filename, res
+
+
+def _check_files_exist(filelist, name):
+    nfiles = len(filelist)
+    for _i, filename in enumerate(filelist):
         if not os.path.exists(filename):
-            raise ValueError("File not exist %i of %i: %s"
-                             % (_i, nwaveform, filename))
+            raise ValueError("%s not exist %i of %i: %s"
+                             % (name, _i, nfiles, filename))
+
+
+def _add_sta_info(sta_dict, st):
+    """
+    Extract station information from sac header, used to create
+    simple inventory
+    """
+    for tr in st:
+        sta_tag = "%s_%s" % (tr.stats.network, tr.stats.station)
+        if sta_tag in sta_dict:
+            continue
+        try:
+            _sac = tr.stats.sac
+        except:
+            raise ValueError("The original data format should be"
+                             "sac format to extract station"
+                             "information")
+        sta_dict[sta_tag] = [tr.stats.network, tr.stats.station,
+                             _sac["stla"], _sac["stlo"],
+                             _sac["stel"], _sac["stdp"]]
+
 
+def _remove_waveforms(ds, st, tag):
+    """
+    Remove the traces with the same ids as in st and the given tag
+    from the asdf file, so a changed file could be added again
+    """
+    waveform_group = ds._waveform_group
+    for tr in st:
+        # station groups are named "NET.STA" in asdf
+        sta_tag = "%s.%s" % (tr.stats.network, tr.stats.station)
+        if sta_tag not in waveform_group:
+            continue
+        sta_group = waveform_group[sta_tag]
+        for name in list(sta_group.keys()):
+            if name.startswith(tr.id + "__") and name.endswith("__" + tag):
+                del sta_group[name]
+
+
+def _remove_stationxml(ds, inv):
+    """
+    Remove the StationXML of the stations in inv from the asdf file,
+    so the changed StationXML replaces them instead of being merged
+    """
+    waveform_group = ds._waveform_group
+    for nw in inv:
+        for sta in nw:
+            sta_tag = "%s.%s" % (nw.code, sta.code)
+            if sta_tag in waveform_group and \
+                    "StationXML" in waveform_group[sta_tag]:
+                del waveform_group[sta_tag]["StationXML"]
+
+
+def _flush_waveforms(ds, batch, tag, event=None, changed=None):
+    """
+    Bulk-append a batch of (filename, stream, file_info) into the asdf
+    file. If it fails, fall back to one file at a time to find the bad
+    ones. Old traces of changed files are removed first.
+
+    :return: list of (filename, stream, file_info) which are added
+    """
+    if len(batch) == 0:
+        return []
+    if changed:
+        for filename, st, _ in batch:
+            if filename in changed:
+                _remove_waveforms(ds, st, tag)
+    try:
+        ds.add_waveforms(Stream([tr for _, st, _ in batch for tr in st]),
+                         tag=tag, event_id=event)
+        return batch
+    except Exception:
+        pass
+
+    added = []
+    for filename, st, info in batch:
         try:
-            st = read(filename)
             ds.add_waveforms(st, tag=tag, event_id=event)
         except Exception as err:
             print("Error converting(%s) due to: %s" % (filename, err))
             continue
-        if create_simple_inv:
-            for tr in st:
-                sta_tag = "%s_%s" % (tr.stats.network, tr.stats.station)
-                if sta_tag not in sta_dict.keys():
-                    try:
-                        _sac = tr.stats.sac
-                    except:
-                        raise ValueError("The original data format should be"
-                                         "sac format to extract station"
-                                         "information")
-                    sta_dict[sta_tag] = [tr.stats.network, tr.stats.station,
-                                         _sac["stla"], _sac["stlo"],
-                                         _sac["stel"], _sac["stdp"]]
-                else:
-                    continue
+        added.append((filename, st, info))
+    return added
+
+
+def add_waveform_to_asdf(ds, waveform_filelist, tag, event=None,
+                         create_simple_inv=False, status_bar=False,
+                         nworkers=1, batch_size=64, manifest=None,
+                         incremental=False):
+    """
+    Add waveform files into asdf file. If nworkers is larger than 1,
+    files are read by a process pool while the streams are appended
+    to the asdf file, batch_size files at a time, by this process.
+
+    :param manifest: if given, the converted files are recorded in it
+    :param incremental: only add files which are new or changed
+        compared to manifest
+    """
+    _check_files_exist(waveform_filelist, "File")
+
+    file_manifest = None
+    changed = set()
+    if manifest is not None:
+        file_manifest = manifest.setdefault("waveforms", {}).setdefault(
+            tag, {})
+        if incremental:
+            nfiles = len(waveform_filelist)
+            waveform_filelist, changed = _filter_changed_files(
+                waveform_filelist, file_manifest)
+            print("Waveform files new or changed: %d of %d"
+                  % (len(waveform_filelist), nfiles))
+
+    nwaveform = len(waveform_filelist)
+    sta_dict = {}
+    batch = []
+    for _i, (filename, (st, err, info)) in enumerate(_imap_files(
+            _read_waveform_file, waveform_filelist, nworkers=nworkers)):
+        if err is not None:
+            print("Error converting(%s) due to: %s" % (filename, err))
+        else:
+            batch.append((filename, st, info))
+
+        if len(batch) >= batch_size or _i == nwaveform - 1:
+            added = _flush_waveforms(ds, batch, tag, event=event,
+                                     changed=changed)
+            batch = []
+            for _filename, _st, _info in added:
+                if create_simple_inv:
+                    _add_sta_info(sta_dict, _st)
+                if file_manifest is not None:
+                    file_manifest[os.path.abspath(_filename)] = _info
 
         if status_bar:
             drawProgressBar((_i+1)/nwaveform, "Adding Waveform data")
@@ -99,7 +452,8 @@ def add_waveform_to_asdf(ds, waveform_filelist, tag, event=None,
 
 def add_stationxml_to_asdf(ds, staxml_filelist, event=None,
                            create_simple_inv=False, sta_dict=None,
-                           status_bar=False):
+                           status_bar=False, nworkers=1, manifest=None,
+                           incremental=False):
     # Add StationXML files.
     if create_simple_inv:
         if event is None:
@@ -108,30 +462,41 @@ def add_stationxml_to_asdf(ds, staxml_filelist, event=None,
             origin = event.preferred_origin() or event.origins[0]
             event_time = origin.time
             start_date = event_time - 300.0
-        nstaxml = len(sta_dict)
-        count = 0
-        for tag, value in sta_dict.iteritems():
-            count += 1
-            inv = create_simple_inventory(
-                    value[0], value[1], latitude=value[2], longitude=value[3],
-                    elevation=value[4], depth=value[5], start_date=start_date)
-            ds.add_stationxml(inv)
-            if status_bar > 0:
-                drawProgressBar((count)/nstaxml,
-                                "Adding StationXML(created) data")
+        add_simple_stationxml_to_asdf(ds, sta_dict, start_date,
+                                      status_bar=status_bar)
     else:
-        nstaxml = len(staxml_filelist)
-        if staxml_filelist is not None and nstaxml > 0:
-            for _i, filename in enumerate(staxml_filelist):
-                if not os.path.exists(filename):
-                    raise ValueError("Staxml not exist %i of %i: %s"
-                                     % (_i, nstaxml, filename))
+        if staxml_filelist is not None and len(staxml_filelist) > 0:
+            _check_files_exist(staxml_filelist, "Staxml")
+            file_manifest = None
+            changed = set()
+            if manifest is not None:
+                file_manifest = manifest.setdefault("stationxml", {})
+                if incremental:
+                    nfiles = len(staxml_filelist)
+                    staxml_filelist, changed = _filter_changed_files(
+                        staxml_filelist, file_manifest)
+                    print("StationXML files new or changed: %d of %d"
+                          % (len(staxml_filelist), nfiles))
+            nstaxml = len(staxml_filelist)
+            # StationXML files are parsed by the workers and the
+            # inventory objects are added here
+            for _i, (filename, (inv, err, info)) in enumerate(_imap_files(
+                    _read_staxml_file, staxml_filelist, nworkers=nworkers)):
                 try:
-                    ds.add_stationxml(filename)
+                    if err is not None:
+                        raise err
+                    if filename in changed:
+                        _remove_stationxml(ds, inv)
+                    ds.add_stationxml(inv)
                 except Exception as err:
                     print("Error convert(%s) due to:%s" % (filename, err))
-                if status_bar > 0:
-                    drawProgressBar((_i+1)/nstaxml, "Adding StationXML data")
+                    continue
+                finally:
+                    if status_bar > 0:
+                        drawProgressBar((_i+1)/nstaxml,
+                                        "Adding StationXML data")
+                if file_manifest is not None:
+                    file_manifest[os.path.abspath(filename)] = info
         else:
             print("No stationxml added")
 
@@ -139,9 +504,17 @@ def add_stationxml_to_asdf(ds, staxml_filelist, event=None,
 @timing
 def convert_to_asdf(asdf_fn, waveform_filelist, tag, quakemlfile=None,
                     staxml_filelist=None, verbose=False, status_bar=False,
-                    create_simple_inv=False):
+                    create_simple_inv=False, nworkers=1, incremental=False):
     """
-    Convert files(sac or mseed) to asdf
+    Convert files(sac or mseed) to asdf. A manifest of the converted
+    input files(size, mtime and md5) is stored in the asdf file.
+
+    :param nworkers: number of worker processes to read the waveform
+        and StationXML files. The asdf file is always written by the
+        calling process.
+    :param incremental: if the asdf file exists, only add the files
+        which are new or changed compared to its manifest. Files failed
+        to convert are not recorded, so they are tried again.
     """
 
     if verbose:
@@ -151,30 +524,38 @@ def convert_to_asdf(asdf_fn, waveform_filelist, tag, quakemlfile=None,
     if nwaveform == 0:
         print("No file specified. Return...")
         return
-    if os.path.exists(asdf_fn):
+    if os.path.exists(asdf_fn) and not incremental:
         raise Exception("File '%s' exists." % asdf_fn)
 
-    ds = ASDFDataSet(asdf_fn, mode='a')
+    ds = ASDFDataSet(asdf_fn, mode='a', mpi=False)
 
     # Add event
     if quakemlfile:
         if not os.path.exists(quakemlfile):
             raise ValueError("Quakeml file not exists:%s" % quakemlfile)
-        ds.add_quakeml(quakemlfile)
+        if len(ds.events) == 0:
+            ds.add_quakeml(quakemlfile)
         event = ds.events[0]
         if status_bar:
             drawProgressBar(1.0, "Adding Quakeml data")
     else:
         raise ValueError("No Event file")
 
+    manifest = read_convert_manifest(ds)
+
     sta_dict = add_waveform_to_asdf(ds, waveform_filelist, tag, event=event,
                                     create_simple_inv=create_simple_inv,
-                                    status_bar=status_bar)
+                                    status_bar=status_bar,
+                                    nworkers=nworkers, manifest=manifest,
+                                    incremental=incremental)
 
     add_stationxml_to_asdf(ds, staxml_filelist, event=event,
                            create_simple_inv=create_simple_inv,
                            sta_dict=sta_dict,
-                           status_bar=status_bar)
+                           status_bar=status_bar, nworkers=nworkers,
+                           manifest=manifest, incremental=incremental)
+
+    write_convert_manifest(ds, manifest)
 
     if verbose:
         print("ASDF filesize: %s" % ds.pretty_filesize)
@@ -190,12 +571,85 @@ def write_stream_to_sac(stream, outputdir, tag=""):
         tr.write(filename, format="SAC")
 
 
+def _match_any(name, patterns):
+    return patterns is None or \
+        any(fnmatch.fnmatch(name, _p) for _p in patterns)
+
+
+def _convert_stations_from_asdf(asdf_fn, outputdir, stations, tag_list=None,
+                                channels=None, filetype="SAC",
+                                output_staxml=True, _verbose=True):
+    """
+    Worker function: export the waveforms of the given stations. Each
+    worker opens the asdf file by itself in read-only mode.
+
+    :return: number of stations exported
+    """
+    ds = ASDFDataSet(asdf_fn, mode='r', mpi=False)
+    count = 0
+    for station_name in stations:
+        if _verbose:
+            print("Convert station: %s" % station_name)
+        station_name2 = station_name.replace(".", "_")
+        station = getattr(ds.waveforms, station_name2)
+        default_tag_list = station.get_waveform_tags()
+        if tag_list is None:
+            _tag_list = default_tag_list
+        else:
+            _tag_list = tag_list
+        inv = None
+        if output_staxml and "StationXML" in dir(station):
+            inv = station.StationXML
+        for _tag in _tag_list:
+            if _tag not in default_tag_list:
+                print("Tag(%s) not in Station(%s) taglist(%s)" %
+                      (_tag, station_name2, default_tag_list))
+                continue
+            try:
+                stream = getattr(station, _tag)
+            except Exception as err:
+                print("Error for station(%s): %s" % (station_name2, err))
+                continue
+            if channels is not None:
+                stream = Stream([tr for tr in stream
+                                 if _match_any(tr.stats.channel, channels)])
+                if len(stream) == 0:
+                    continue
+            if filetype == "SAC":
+                write_stream_to_sac(stream, outputdir, _tag)
+            elif filetype == "MSEED":
+                # one file for all the traces of the station
+                filename = os.path.join(outputdir, "%s.%s.mseed"
+                                        % (station_name, _tag))
+                stream.write(filename, format="MSEED")
+            if inv is not None:
+                filename = os.path.join(outputdir, "%s.%s.xml"
+                                        % (station_name, _tag))
+                try:
+                    inv.write(filename, format="STATIONXML")
+                except Exception:
+                    print("Error creating STATIONXML: %s" % filename)
+        count += 1
+    del ds
+    return count
+
+
 @timing
 def convert_from_asdf(asdf_fn, outputdir, tag=None, filetype="sac",
                       output_staxml=True, output_quakeml=True,
-                      _verbose=True):
+                      _verbose=True, stations=None, channels=None,
+                      nworkers=1):
     """
     Convert the waveform in asdf to different types of file
+
+    :param tag: waveform tag, or list of tags. If None, all the tags
+    :param stations: list of stations("NET.STA") to export. Unix
+        shell-style wildcards are supported, like "II.*". If None,
+        all the stations
+    :param channels: list of channels to export, like ["BHZ", "LH?"].
+        Wildcards are supported. If None, all the channels
+    :param nworkers: number of worker processes. Stations are split
+        over the workers.
     """
     filetype = filetype.upper()
     if filetype not in ["SAC", "MSEED"]:
@@ -206,15 +660,19 @@ def convert_from_asdf(asdf_fn, outputdir, tag=None, filetype="sac",
     if not os.path.exists(outputdir):
         os.makedirs(outputdir)
 
-    if isinstance(tag, str):
+    if tag is None:
+        tag_list = None
+    elif isinstance(tag, basestring):
         tag_list = [tag]
+    else:
+        tag_list = list(tag)
 
     print("Input ASDF: %s" % asdf_fn)
     print("Output dir: %s" % outputdir)
     print("Output StationXML and Quakeml: [%s, %s]" % (output_staxml,
                                                        output_quakeml))
 
-    ds = ASDFDataSet(asdf_fn, mode='r')
+    ds = ASDFDataSet(asdf_fn, mode='r', mpi=False)
 
     if output_quakeml:
         if len(ds.events) >= 1:
@@ -223,47 +681,86 @@ def convert_from_asdf(asdf_fn, outputdir, tag=None, filetype="sac",
                 print("Quakeml file: %s" % filename)
             ds.events.write(filename, format="QUAKEML")
 
-    sta_list = ds.waveforms.list()
+    sta_list = [_sta for _sta in ds.waveforms.list()
+                if _match_any(_sta, stations)]
+    del ds
+    print("Number of stations to export: %d" % len(sta_list))
 
-    for station_name in sta_list:
-        if _verbose:
-            print("Convert station: %s" % station_name)
-        station_name2 = station_name.replace(".", "_")
-        station = getattr(ds.waveforms, station_name2)
-        default_tag_list = station.get_waveform_tags()
-        if tag is None:
-            tag_list = default_tag_list
-        for _tag in tag_list:
-            if _tag not in default_tag_list:
-                print("Tag(%s) not in Station(%s) taglist(%s)" %
-                      (_tag, station_name2, default_tag_list))
-                continue
-            try:
-                stream, inv = ds.get_data_for_tag(station_name2, _tag)
-            except:
-                print("Error for station:", station_name2)
-            if filetype == "SAC":
-                write_stream_to_sac(stream, outputdir, _tag)
-            elif filetype == "MSEED":
-                filename = os.path.join(outputdir, "%s.%s.mseed"
-                                        % (station_name, _tag))
-                stream.write(filename, format="MSEED")
-            if output_staxml:
-                filename = os.path.join(outputdir, "%s.%s.xml"
-                                        % (station_name, _tag))
-                try:
-                    inv.write(filename, format="STATIONXML")
-                except:
-                    print("Error creating STATIONXML: %f" % filename)
+    worker_function = partial(
+        _convert_stations_from_asdf, asdf_fn, outputdir,
+        tag_list=tag_list, channels=channels, filetype=filetype,
+        output_staxml=output_staxml, _verbose=_verbose)
 
-    del ds
+    if nworkers <= 1:
+        worker_function(sta_list)
+        return
+
+    with ProcessPoolExecutor(max_workers=nworkers) as pool:
+        for future in as_completed(
+                [pool.submit(worker_function, _chunk)
+                 for _chunk in split_stations(sta_list, 4 * nworkers)]):
+            future.result()
+
+
+# same row format as the default of np.savetxt
+_ADJ_ROW_FORMAT = "%.18e %.18e\n"
+_ADJ_FILE_FORMATS = {}
+
+
+def _adj_file_format(npts):
+    """
+    Format string of a whole adjoint source file with npts rows,
+    cached since most adjoint sources have the same length
+    """
+    if npts not in _ADJ_FILE_FORMATS:
+        _ADJ_FILE_FORMATS[npts] = _ADJ_ROW_FORMAT * npts
+    return _ADJ_FILE_FORMATS[npts]
+
+
+def write_adjsrc_ascii(filename, data, time_offset, dt):
+    """
+    Write one adjoint source into ASCII file for specfem, two columns
+    of time and value. The output is the same as np.savetxt but with
+    the whole file formatted at once.
+    """
+    npts = len(data)
+    values = np.empty(2 * npts)
+    values[0::2] = time_offset + dt * np.arange(npts)
+    values[1::2] = data
+    with open(filename, "w") as fh:
+        fh.write(_adj_file_format(npts) % tuple(values.tolist()))
+
+
+def _export_adjsrcs_asdf(ds, outputdir):
+    """
+    Copy the adjoint sources into outputdir/adjoint.h5, which could be
+    read by specfem directly(READ_ADJSRC_ASDF), without text files
+    """
+    filename = os.path.join(outputdir, "adjoint.h5")
+    if os.path.exists(filename):
+        os.remove(filename)
+    print("Output adjoint asdf file: %s" % filename)
+    output_ds = ASDFDataSet(filename, mode="a", mpi=False)
+    src_group = ds._auxiliary_data_group
+    src_group.copy(src_group["AdjointSources"],
+                   output_ds._auxiliary_data_group, name="AdjointSources")
+    del output_ds
 
 
 @timing
-def convert_adjsrcs_from_asdf(asdf_fn, outputdir, _verbose=True):
+def convert_adjsrcs_from_asdf(asdf_fn, outputdir, _verbose=True,
+                              output_format="ascii", nworkers=4):
     """
     Convert adjoint sources from asdf to ASCII file(for specfem3d_globe use)
+
+    :param output_format: "ascii" for one .adj file per adjoint source,
+        or "asdf" for one adjoint.h5 file, which specfem could read
+        directly
+    :param nworkers: number of worker processes to format and write
+        ASCII files. The asdf file is read by the calling process.
     """
+    if output_format not in ["ascii", "asdf"]:
+        raise ValueError("Supported output_format: 1) ascii; 2) asdf")
     if not os.path.exists(asdf_fn):
         raise ValueError("No asdf file: %s" % asdf_fn)
     if not os.path.exists(outputdir):
@@ -272,7 +769,7 @@ def convert_adjsrcs_from_asdf(asdf_fn, outputdir, _verbose=True):
     print("Input ASDF: %s" % asdf_fn)
     print("Output dir: %s" % outputdir)
 
-    ds = ASDFDataSet(asdf_fn, mode='r')
+    ds = ASDFDataSet(asdf_fn, mode='r', mpi=False)
     if "AdjointSources" not in ds.auxiliary_data:
         print("No adjoint source exists in asdf file: %s" % asdf_fn)
         return
@@ -280,27 +777,75 @@ def convert_adjsrcs_from_asdf(asdf_fn, outputdir, _verbose=True):
     nadj = len(adjsrcs)
     print("Number of adjoint sources: %d" % nadj)
 
-    for idx, adj in enumerate(adjsrcs):
-        if _verbose:
-            print("Adjoint sources(%d/%d) from: %s" % (idx, nadj, adj.path))
-        time_offset = adj.parameters["time_offset"]
-        dt = adj.parameters['dt']
-        npts = len(adj.data)
-        times = np.array([time_offset + i * dt for i in range(npts)])
-        _data = np.zeros([npts, 2])
-        _data[:, 0] = times[:]
-        _data[:, 1] = adj.data[:]
-        adj_path = adj.path.replace("_", ".")
-        filename = os.path.join(outputdir, "%s.adj" % adj_path)
-        np.savetxt(filename, _data)
+    if output_format == "asdf":
+        _export_adjsrcs_asdf(ds, outputdir)
+        return
+
+    def _adjsrc_files():
+        for idx, adj in enumerate(adjsrcs):
+            if _verbose:
+                print("Adjoint sources(%d/%d) from: %s"
+                      % (idx, nadj, adj.path))
+            adj_path = adj.path.replace("_", ".")
+            filename = os.path.join(outputdir, "%s.adj" % adj_path)
+            yield (filename, np.asarray(adj.data),
+                   adj.parameters["time_offset"], adj.parameters["dt"])
+
+    if nworkers <= 1:
+        for args in _adjsrc_files():
+            write_adjsrc_ascii(*args)
+        return
+
+    # text formatting holds the GIL, so the files are formatted and
+    # written by worker processes. The asdf file is read here, and the
+    # number of adjoint sources waiting in memory is limited.
+    max_pending = 4 * nworkers
+    with ProcessPoolExecutor(max_workers=nworkers) as pool:
+        futures = deque()
+        for args in _adjsrc_files():
+            futures.append(pool.submit(write_adjsrc_ascii, *args))
+            if len(futures) >= max_pending:
+                futures.popleft().result()
+        for future in futures:
+            future.result()
+
+
+def _convert_path_in_pool(path, verbose=False, incremental=False):
+    """
+    Worker function: convert one event, used when events are
+    converted concurrently
+    """
+    try:
+        ConvertASDF(None, verbose=verbose,
+                    incremental=incremental)._run_subs(path)
+    except Exception as err:
+        print("Error converting event(%s) due to: %s"
+              % (path.get("output_file"), err))
+        return False
+    return True
 
 
 class ConvertASDF(object):
+    """
+    Convert sac or mseed files into asdf files.
+
+    :param nworkers: number of worker processes to read the files of
+        one event
+    :param nevents: number of events converted concurrently, if the
+        path file contains a list of events. Each event then uses a
+        single process.
+    :param incremental: keep the existing output files and only add
+        the input files which are new or changed since the last run
+    """
 
-    def __init__(self, path, verbose=False, status_bar=False):
+    def __init__(self, path, verbose=False, status_bar=False, nworkers=1,
+                 nevents=1, incremental=False):
         self.path = path
         self._verbose = verbose
         self._status_bar = status_bar
+        self._nworkers = nworkers
+        self._nevents = nevents
+        self._incremental = incremental
 
     @staticmethod
     def print_info(waveform_files, tag, staxml_files, quakemlfile,
@@ -319,12 +864,12 @@ class ConvertASDF(object):
         print("Output filename:", output_fn)
 
     @staticmethod
-    def clean_output(output_fn):
+    def clean_output(output_fn, remove_flag=True):
         basepath = os.path.dirname(output_fn)
         if not os.path.exists(basepath):
             print("Output dir not exists so created: %s" % basepath)
             os.makedirs(basepath)
-        if os.path.exists(output_fn):
+        if remove_flag and os.path.exists(output_fn):
             print("Outfile exist and being removed:", output_fn)
             os.remove(output_fn)
 
@@ -372,18 +917,34 @@ class ConvertASDF(object):
         self.print_info(waveformfiles, tag, staxmlfiles, quakemlfile,
                         outputfile, create_simple_inv)
 
-        self.clean_output(outputfile)
+        self.clean_output(outputfile, remove_flag=not self._incremental)
 
         convert_to_asdf(outputfile, waveformfiles, tag,
                         quakemlfile=quakemlfile,
                         staxml_filelist=staxmlfiles,
                         verbose=self._verbose, status_bar=self._status_bar,
-                        create_simple_inv=create_simple_inv)
+                        create_simple_inv=create_simple_inv,
+                        nworkers=self._nworkers,
+                        incremental=self._incremental)
+
+    def _run_events_in_pool(self, paths):
+        with ProcessPoolExecutor(max_workers=self._nevents) as pool:
+            status = list(pool.map(
+                partial(_convert_path_in_pool, verbose=self._verbose,
+                        incremental=self._incremental), paths))
+        failed = [_p["output_file"] for _p, _s in zip(paths, status)
+                  if not _s]
+        if len(failed) > 0:
+            raise ValueError("Failed to convert %d of %d events: %s"
+                             % (len(failed), len(paths), failed))
 
     def run(self):
         path = smart_read_json(self.path, mpi_mode=False)
         if isinstance(path, list):
-            for _path in path:
-                self._run_subs(_path)
+            if self._nevents > 1:
+                self._run_events_in_pool(path)
+            else:
+                for _path in path:
+                    self._run_subs(_path)
         else:
             self._run_subs(path)
@@ -0,0 +1,407 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+"""
+Executors that dispatch the per-station work of ProcASDFBase jobs.
+The MPI executor hands everything over to pyasdf, while the pool
+executor splits the station list over a local process pool so jobs
+could run on a single node without an MPI launcher.
+
+:copyright:
+    Wenjie Lei (lei@princeton.edu), 2016
+:license:
+    GNU Lesser General Public License, version 3 (LGPLv3)
+    (http://www.gnu.org/licenses/lgpl-3.0.en.html)
+"""
+from __future__ import (absolute_import, division, print_function)
+from functools import partial
+import heapq
+import multiprocessing
+import traceback
+from concurrent.futures import ProcessPoolExecutor, as_completed
+from pyasdf import ASDFDataSet
+
+# mpi message tag for the streaming gather of results
+_TAG_RESULTS = 21
+
+
+def _get_station_group(ds, station):
+    return getattr(ds.waveforms, station.replace(".", "_"))
+
+
+def split_stations(stations, nchunks):
+    """
+    Split the station list into nchunks chunks with (almost) equal size.
+    Empty chunks are dropped.
+    """
+    nchunks = max(1, min(nchunks, len(stations)))
+    chunks = [stations[_i::nchunks] for _i in range(nchunks)]
+    return [_c for _c in chunks if len(_c) > 0]
+
+
+def lpt_partition(stations, costs, nparts):
+    """
+    Partition the stations into nparts parts with balanced total cost,
+    using the longest-processing-time-first rule: stations are sorted
+    by cost in descending order and each one is assigned to the part
+    with the least total cost so far.
+
+    :param costs: dict of cost of each station
+    :return: list of nparts lists of stations
+    """
+    parts = [[] for _ in range(nparts)]
+    heap = [(0, _i) for _i in range(nparts)]
+    for sta in sorted(stations, key=lambda x: (-costs[x], x)):
+        load, idx = heapq.heappop(heap)
+        parts[idx].append(sta)
+        heapq.heappush(heap, (load + costs[sta], idx))
+    return parts
+
+
+def process_two_files_on_stations(obsd_ds, synt_ds, stations,
+                                  process_function, traceback_limit=3):
+    """
+    Run process_function on the given stations of a pair of asdf
+    dataset, in the current process.
+    """
+    results = {}
+    for station in stations:
+        try:
+            results[station] = process_function(
+                _get_station_group(obsd_ds, station),
+                _get_station_group(synt_ds, station))
+        except Exception:
+            print("Error processing station '%s':\n%s"
+                  % (station, traceback.format_exc(limit=traceback_limit)))
+            results[station] = None
+    return results
+
+
+def process_on_stations(ds, stations, process_function, tag_map,
+                        traceback_limit=3):
+    """
+    Run process_function on the waveforms of the given stations, in
+    the current process. Returns the processed streams and the
+    inventory of each station.
+    """
+    results = {}
+    for station in stations:
+        group = _get_station_group(ds, station)
+        if "StationXML" not in dir(group):
+            print("Missing 'StationXML' from station '%s'. Skipped."
+                  % station)
+            continue
+        inv = group.StationXML
+        tags = group.get_waveform_tags()
+        sta_results = []
+        for input_tag, output_tag in tag_map.iteritems():
+            if input_tag not in tags:
+                continue
+            try:
+                stream = process_function(getattr(group, input_tag), inv)
+            except Exception:
+                print("Error processing station '%s':\n%s"
+                      % (station,
+                         traceback.format_exc(limit=traceback_limit)))
+                continue
+            if stream is None:
+                continue
+            sta_results.append((output_tag, stream))
+        if len(sta_results) > 0:
+            results[station] = {"inventory": inv, "streams": sta_results}
+    return results
+
+
+def _process_two_files_chunk(obsd_file, synt_file, stations,
+                             process_function):
+    """
+    Worker function: run process_function on a chunk of stations.
+    Each worker opens the asdf files by itself in read-only mode.
+    """
+    obsd_ds = ASDFDataSet(obsd_file, mode="r", mpi=False)
+    synt_ds = ASDFDataSet(synt_file, mode="r", mpi=False)
+    results = process_two_files_on_stations(obsd_ds, synt_ds, stations,
+                                            process_function)
+    del obsd_ds
+    del synt_ds
+    return results
+
+
+def _process_chunk(input_file, stations, process_function, tag_map):
+    """
+    Worker function: run process_function on the waveforms of a chunk
+    of stations, which will be written out by the parent process.
+    """
+    ds = ASDFDataSet(input_file, mode="r", mpi=False)
+    results = process_on_stations(ds, stations, process_function, tag_map)
+    del ds
+    return results
+
+
+def add_process_results(output_ds, results):
+    """
+    Add the results of process, streams and inventories, into the
+    opened output asdf dataset
+    """
+    for station in sorted(results):
+        output_ds.add_stationxml(results[station]["inventory"])
+        for output_tag, stream in results[station]["streams"]:
+            output_ds.add_waveforms(stream, tag=output_tag)
+
+
+def write_process_results(ds, output_filename, results):
+    """
+    Write the results of process, streams and inventories, into the
+    output asdf file
+    """
+    output_ds = ASDFDataSet(output_filename, mode="a", mpi=False)
+    output_ds.events = ds.events
+    add_process_results(output_ds, results)
+    del output_ds
+
+
+def add_auxiliary_results(output_ds, results):
+    """
+    Add the results of process_two_files, in the format of
+    reshape_adj, into the opened output asdf dataset
+    """
+    for station in sorted(results):
+        sta_results = results[station]
+        if not sta_results:
+            continue
+        for _res in sta_results:
+            if _res["type"] != "AuxiliaryData":
+                raise NotImplementedError(
+                    "Can not write out result type: %s" % _res["type"])
+            data_type, path = _res["path"].split("/", 1)
+            output_ds.add_auxiliary_data(
+                _res["object"], data_type=data_type, path=path,
+                parameters=_res["parameters"])
+
+
+def write_auxiliary_results(output_filename, results):
+    """
+    Write the results of process_two_files, in the format of
+    reshape_adj, into the output asdf file
+    """
+    output_ds = ASDFDataSet(output_filename, mode="a", mpi=False)
+    add_auxiliary_results(output_ds, results)
+    del output_ds
+
+
+class MPIExecutor(object):
+    """
+    Executor using the MPI parallel machinary inside pyasdf. If the
+    stations to process are given, they are distributed over the ranks
+    directly and the results are gathered on rank 0.
+    """
+    mpi_mode = True
+
+    def partition_stations(self, stations, costs=None):
+        """
+        Partition the stations over the ranks, the same way as in
+        process_two_files with the same stations and costs
+
+        :return: list of stations of each rank
+        """
+        from .utils import _get_mpi_comm
+        size = _get_mpi_comm().Get_size()
+        if costs is None:
+            return [stations[_i::size] for _i in range(size)]
+        return lpt_partition(stations, costs, size)
+
+    def local_stations(self, stations, costs=None):
+        """
+        Stations that will be processed by this rank in
+        process_two_files, with the same stations and costs
+        """
+        from .utils import _get_mpi_comm
+        rank = _get_mpi_comm().Get_rank()
+        return self.partition_stations(stations, costs=costs)[rank]
+
+    def process(self, ds, process_function, output_filename, tag_map):
+        return ds.process(process_function, output_filename,
+                          tag_map=tag_map)
+
+    def process_two_files(self, obsd_ds, synt_ds, process_function,
+                          output_filename=None, stations=None, costs=None,
+                          result_handler=None):
+        if stations is None and result_handler is None:
+            return obsd_ds.process_two_files(
+                synt_ds, process_function, output_filename=output_filename)
+
+        from .utils import _get_mpi_comm
+        comm = _get_mpi_comm()
+        rank = comm.Get_rank()
+        size = comm.Get_size()
+
+        if stations is None:
+            stations = sorted(set(obsd_ds.waveforms.list()) &
+                              set(synt_ds.waveforms.list()))
+        rank_stations = self.local_stations(stations, costs=costs)
+
+        results = process_two_files_on_stations(
+            obsd_ds, synt_ds, rank_stations, process_function)
+
+        if result_handler is not None:
+            # streaming gather: rank 0 handles the results of one rank
+            # at a time, so they never need to be all in memory
+            if rank == 0:
+                result_handler(results)
+                for source in range(1, size):
+                    result_handler(comm.recv(source=source,
+                                             tag=_TAG_RESULTS))
+            else:
+                comm.send(results, dest=0, tag=_TAG_RESULTS)
+            comm.barrier()
+            return
+
+        gathered = comm.gather(results, root=0)
+        if rank == 0:
+            results = {}
+            for _res in gathered:
+                results.update(_res)
+            if output_filename is not None:
+                write_auxiliary_results(output_filename, results)
+        else:
+            results = None
+        comm.barrier()
+        return results
+
+
+class SerialExecutor(object):
+    """
+    Executor running everything in the current process. It is used
+    when a whole event is handed to a single rank or worker.
+    """
+    mpi_mode = False
+
+    def local_stations(self, stations, costs=None):
+        return stations
+
+    def process(self, ds, process_function, output_filename, tag_map):
+        results = process_on_stations(ds, ds.waveforms.list(),
+                                      process_function, tag_map)
+        write_process_results(ds, output_filename, results)
+
+    def process_two_files(self, obsd_ds, synt_ds, process_function,
+                          output_filename=None, stations=None, costs=None,
+                          result_handler=None):
+        if stations is None:
+            stations = sorted(set(obsd_ds.waveforms.list()) &
+                              set(synt_ds.waveforms.list()))
+        results = process_two_files_on_stations(
+            obsd_ds, synt_ds, stations, process_function)
+        if result_handler is not None:
+            result_handler(results)
+            return
+        if output_filename is not None:
+            write_auxiliary_results(output_filename, results)
+        return results
+
+
+class PoolExecutor(object):
+    """
+    Executor using a local process pool. The station list is split
+    into chunks, which are processed by the workers, and the results
+    are reduced and written out by the parent process.
+    """
+    mpi_mode = False
+
+    def __init__(self, nworkers=None, chunks_per_worker=4):
+        if nworkers is None:
+            nworkers = multiprocessing.cpu_count()
+        if nworkers < 1:
+            raise ValueError("Number of workers(%d) should be larger "
+                             "than 0" % nworkers)
+        self.nworkers = nworkers
+        self.chunks_per_worker = chunks_per_worker
+
+    def local_stations(self, stations, costs=None):
+        # workers get their input from the parent process
+        return stations
+
+    def _map_chunks(self, worker_function, chunks, result_handler=None):
+        """
+        Map worker_function onto station chunks and merge the results.
+        If result_handler is given, the results of each chunk are passed
+        to it as soon as they are ready, instead of being merged.
+        """
+        results = {}
+        with ProcessPoolExecutor(max_workers=self.nworkers) as pool:
+            futures = [pool.submit(worker_function, _c) for _c in chunks]
+            for future in as_completed(futures):
+                if result_handler is None:
+                    results.update(future.result())
+                else:
+                    result_handler(future.result())
+        return results
+
+    def _split(self, stations, costs=None):
+        """
+        Split stations into chunks. If costs are given, the chunks are
+        balanced by cost and the most expensive chunks come first.
+        """
+        nchunks = self.nworkers * self.chunks_per_worker
+        if costs is None:
+            return split_stations(sorted(stations), nchunks)
+        nchunks = max(1, min(nchunks, len(stations)))
+        chunks = [_c for _c in lpt_partition(stations, costs, nchunks)
+                  if len(_c) > 0]
+        return sorted(chunks, key=lambda c: -sum(costs[x] for x in c))
+
+    def process(self, ds, process_function, output_filename, tag_map):
+        stations = ds.waveforms.list()
+        print("Processing %d stations with %d workers"
+              % (len(stations), self.nworkers))
+        worker_function = partial(
+            _process_chunk, ds.filename,
+            process_function=process_function, tag_map=tag_map)
+        results = self._map_chunks(worker_function, self._split(stations))
+        write_process_results(ds, output_filename, results)
+
+    def process_two_files(self, obsd_ds, synt_ds, process_function,
+                          output_filename=None, stations=None, costs=None,
+                          result_handler=None):
+        if stations is None:
+            stations = list(set(obsd_ds.waveforms.list()) &
+                            set(synt_ds.waveforms.list()))
+        print("Processing %d stations with %d workers"
+              % (len(stations), self.nworkers))
+        worker_function = partial(
+            _process_two_files_chunk, obsd_ds.filename, synt_ds.filename,
+            process_function=process_function)
+        results = self._map_chunks(worker_function,
+                                   self._split(stations, costs=costs),
+                                   result_handler=result_handler)
+        if result_handler is not None:
+            return
+
+        if output_filename is not None:
+            write_auxiliary_results(output_filename, results)
+        return results
+
+
+def get_executor(executor=None, nworkers=None):
+    """
+    Get the executor. If executor is None, MPI will be used in the
+    MPI environment, otherwise a local process pool will be used.
+
+    :param executor: "mpi", "pool", "serial", an executor instance
+        or None
+    :param nworkers: number of workers for the pool executor
+    """
+    if executor is None:
+        from .utils import is_mpi_env
+        executor = "mpi" if is_mpi_env() else "pool"
+
+    if isinstance(executor, str):
+        if executor == "mpi":
+            return MPIExecutor()
+        elif executor == "pool":
+            return PoolExecutor(nworkers=nworkers)
+        elif executor == "serial":
+            return SerialExecutor()
+        else:
+            raise ValueError("Not recogonized executor: %s. Supported: "
+                             "'mpi', 'pool' and 'serial'" % executor)
+    return executor
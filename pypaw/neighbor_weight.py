@@ -0,0 +1,134 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+"""
+Neighbor based receiver weighting for very dense arrays. It uses the
+same Gaussian kernel exp(-(d/ref)^2) as SphereDistRel in spaceweight,
+but the kernel is truncated at truncate * ref, so only the neighbors
+within that radius are visited. They are found by a KD-tree on the unit
+vectors of the points, so the cost goes from O(N^2) to O(N log N) plus
+the number of neighbor pairs.
+
+scipy is only needed for this engine.
+
+:copyright:
+    Wenjie Lei (lei@princeton.edu), 2016
+:license:
+    GNU Lesser General Public License, version 3 (LGPLv3)
+    (http://www.gnu.org/licenses/lgpl-3.0.en.html)
+"""
+from __future__ import (absolute_import, division, print_function)
+import numpy as np
+
+
+def _import_ckdtree():
+    try:
+        from scipy.spatial import cKDTree
+    except ImportError:
+        raise ImportError("scipy is required by the 'kdtree' receiver "
+                          "weighting engine")
+    return cKDTree
+
+
+def unit_vectors(latitudes, longitudes):
+    """
+    Unit vectors of points on the sphere
+
+    :param latitudes: latitudes in degrees
+    :param longitudes: longitudes in degrees
+    :return: numpy array of shape (npoints, 3)
+    """
+    lats = np.deg2rad(np.asarray(latitudes, dtype=float))
+    lons = np.deg2rad(np.asarray(longitudes, dtype=float))
+    return np.column_stack([np.cos(lats) * np.cos(lons),
+                            np.cos(lats) * np.sin(lons),
+                            np.sin(lats)])
+
+
+class NeighborDistWeight(object):
+    """
+    Weights of points based on their neighbors, with the kernel
+    truncated at truncate * ref_distance. Each dropped pair contributes
+    less than exp(-truncate^2) to the kernel sum of a point, whose
+    value is at least 1, so with the default truncate(4.0) the weights
+    match the all-pairs kernel to about 1e-7 per dropped neighbor.
+
+    :param latitudes: latitudes of points in degrees
+    :param longitudes: longitudes of points in degrees
+    :param truncate: kernel is truncated at truncate * ref_distance
+    """
+
+    def __init__(self, latitudes, longitudes, truncate=4.0):
+        if truncate <= 0:
+            raise ValueError("truncate(%f) should be larger than 0"
+                             % truncate)
+        cKDTree = _import_ckdtree()
+        self.xyz = unit_vectors(latitudes, longitudes)
+        self.tree = cKDTree(self.xyz)
+        self.truncate = truncate
+        self.weights = np.ones(len(self.xyz))
+
+    def neighbor_pairs(self, max_distance):
+        """
+        Pairs of points within max_distance and their distances
+
+        :param max_distance: in degrees
+        :return: array of pairs, shape (npairs, 2), and array of their
+            great-circle distances in degrees
+        """
+        max_distance = min(max_distance, 180.0)
+        chord = 2.0 * np.sin(np.deg2rad(max_distance) / 2.0)
+        pairs = self.tree.query_pairs(chord, output_type="ndarray")
+        pairs = pairs.reshape(-1, 2)
+        chords = np.linalg.norm(
+            self.xyz[pairs[:, 0]] - self.xyz[pairs[:, 1]], axis=1)
+        dists = np.rad2deg(2.0 * np.arcsin(np.clip(chords / 2.0, 0, 1)))
+        return pairs, dists
+
+    def weights_at(self, ref_distance):
+        """
+        Weights at the reference distance, normalized to an average of 1
+        """
+        npts = len(self.xyz)
+        pairs, dists = self.neighbor_pairs(self.truncate * ref_distance)
+        kernel = np.exp(-(dists / ref_distance) ** 2)
+        # the point itself contributes exp(0) = 1
+        sums = 1.0 + \
+            np.bincount(pairs[:, 0], weights=kernel, minlength=npts) + \
+            np.bincount(pairs[:, 1], weights=kernel, minlength=npts)
+        weights = 1.0 / sums
+        return weights / weights.mean()
+
+    def calculate_weight(self, ref_distance):
+        self.weights = self.weights_at(ref_distance)
+        return self.weights
+
+    def smart_scan(self, max_ratio=0.5, start=0.5, gap=0.5,
+                   drop_ratio=0.20):
+        """
+        Scan the reference distance the same way as SphereDistRel: the
+        condition number(max/min of weights) goes up with the reference
+        distance, reaches its maximum and then goes down. The scan stops
+        once it drops below drop_ratio * maximum, and the reference
+        distance whose condition number is closest to
+        max_ratio * maximum is taken.
+
+        :return: the reference distance and condition number taken
+        """
+        ref_dists = []
+        cond_nums = []
+        ref_dist = start
+        while True:
+            weights = self.weights_at(ref_dist)
+            ref_dists.append(ref_dist)
+            cond_nums.append(weights.max() / weights.min())
+            if len(cond_nums) >= 3 and \
+                    cond_nums[-1] < drop_ratio * max(cond_nums):
+                break
+            if ref_dist >= 180.0:
+                break
+            ref_dist += gap
+
+        cond_nums = np.array(cond_nums)
+        best = np.argmin(np.abs(cond_nums - max_ratio * cond_nums.max()))
+        self.calculate_weight(ref_dists[best])
+        return ref_dists[best], float(cond_nums[best])
@@ -12,18 +12,40 @@ and parallel I/O so they are invisible to users.
 """
 from __future__ import (absolute_import, division, print_function)
 import os
+import copy
+import traceback
+from concurrent.futures import ProcessPoolExecutor, as_completed
 from pyasdf import ASDFDataSet
-from mpi4py import MPI
-from .utils import smart_read_yaml, smart_read_json, is_mpi_env
+from .utils import smart_read_yaml, smart_read_json, _get_mpi_comm
 from .utils import smart_check_path, smart_remove_file, smart_mkdir
+from .executor import get_executor, SerialExecutor
+from .stations import build_station_pair_index
+
+# mpi message tags used by the event farm
+_TAG_REQUEST = 11
+_TAG_TASK = 12
+
+
+def _run_event_in_pool(job, path, param):
+    """
+    Pool worker function: run one event of the job
+    """
+    return job._run_one_event(path, param)
 
 
 class ProcASDFBase(object):
 
-    def __init__(self, path, param, verbose=False, debug=False):
+    def __init__(self, path, param, verbose=False, debug=False,
+                 executor=None, nworkers=None, event_farm=False):
 
         self.comm = None
         self.rank = None
+        self.mpi_mode = None
+
+        self._executor = executor
+        self._nworkers = nworkers
+        self.executor = None
+        self.event_farm = event_farm
 
         self.path = path
         self.param = param
@@ -74,17 +96,20 @@ class ProcASDFBase(object):
 
     def detect_env(self):
         """
-        Detect environment, mpi or not
+        Detect environment, mpi or not, and set up the executor. If
+        not in mpi environment, a local process pool will be used.
 
         :return:
         """
-        self.mpi_mode = is_mpi_env()
-        if not self.mpi_mode:
-            raise EnvironmentError(
-                "mpi environment required for parallel"
-                "running window selection")
-        self.comm = MPI.COMM_WORLD
-        self.rank = self.comm.Get_rank()
+        self.executor = get_executor(self._executor,
+                                     nworkers=self._nworkers)
+        self.mpi_mode = self.executor.mpi_mode
+        if self.mpi_mode:
+            self.comm = _get_mpi_comm()
+            self.rank = self.comm.Get_rank()
+        else:
+            self.comm = None
+            self.rank = 0
 
     def print_info(self, dict_obj, extra_info=""):
         """
@@ -123,7 +148,7 @@ class ProcASDFBase(object):
             return ASDFDataSet(filename, compression=None, debug=self._debug,
                                mode=mode)
         else:
-            return ASDFDataSet(filename, mode=mode)
+            return ASDFDataSet(filename, mode=mode, mpi=False)
 
     def check_input_file(self, filename):
         """
@@ -151,7 +176,69 @@ class ProcASDFBase(object):
                 if self.rank == 0:
                     print("Output file already exists and removed:%s"
                           % filename)
-                smart_remove_file(filename)
+                smart_remove_file(filename, mpi_mode=self.mpi_mode,
+                                  comm=self.comm)
+
+    def process(self, ds, process_function, output_filename, tag_map):
+        """
+        Process waveforms in ds using the executor
+
+        :param ds: input asdf dataset
+        :param process_function: function applied on (stream, inventory)
+        :param output_filename: output asdf filename
+        :param tag_map: input tag to output tag map
+        :return:
+        """
+        return self.executor.process(ds, process_function,
+                                     output_filename, tag_map)
+
+    def build_station_index(self, obsd_ds, synt_ds, obsd_tag, synt_tag,
+                            obsd_staxml=False, synt_staxml=False,
+                            windows=None):
+        """
+        Pre-scan the pair of asdf files on rank 0 and broadcast the
+        list of stations to be processed. See
+        stations.build_station_pair_index for the arguments.
+
+        :return: sorted list of matched stations
+        """
+        if not self.mpi_mode or self.rank == 0:
+            stations = build_station_pair_index(
+                obsd_ds, synt_ds, obsd_tag, synt_tag,
+                obsd_staxml=obsd_staxml, synt_staxml=synt_staxml,
+                windows=windows)
+        else:
+            stations = None
+        if self.mpi_mode:
+            stations = self.comm.bcast(stations, root=0)
+        return stations
+
+    def process_two_files(self, obsd_ds, synt_ds, process_function,
+                          output_filename=None, stations=None, costs=None,
+                          result_handler=None):
+        """
+        Process pair of observed and synthetic asdf dataset using
+        the executor
+
+        :param obsd_ds: observed asdf dataset
+        :param synt_ds: synthetic asdf dataset
+        :param process_function: function applied on station groups
+        :param output_filename: output asdf filename. If specified,
+            results will be written into it as auxiliary data
+        :param stations: stations to be processed, usually from
+            build_station_index. If None, all stations in both files.
+        :param costs: dict of estimated cost of each station in
+            stations. If given, stations are assigned to ranks(or workers)
+            to balance the total cost instead of a uniform split.
+        :param result_handler: if given, called on rank 0 with the
+            results dict of each rank(or chunk) as soon as it arrives,
+            instead of gathering all the results. Then None is returned.
+        :return: results dict on rank 0
+        """
+        return self.executor.process_two_files(
+            obsd_ds, synt_ds, process_function,
+            output_filename=output_filename, stations=stations, costs=costs,
+            result_handler=result_handler)
 
     @staticmethod
     def clean_memory(asdf_ds):
@@ -185,6 +272,121 @@ class ProcASDFBase(object):
         """
         pass
 
+    @staticmethod
+    def _event_cost(path):
+        """
+        Estimate the cost of one event by its number of stations
+
+        :param path: path information of one event
+        :return: number of stations in the (observed) input asdf file
+        """
+        for key in ["obsd_asdf", "input_asdf"]:
+            if key not in path:
+                continue
+            try:
+                ds = ASDFDataSet(path[key], mode="r", mpi=False)
+                nstations = len(ds.waveforms)
+                del ds
+                return nstations
+            except Exception as err:
+                print("Failed to count stations in %s: %s"
+                      % (path[key], err))
+        return 0
+
+    def _sort_events(self, paths):
+        """
+        Sort the events by cost(number of stations), in descending
+        order, so the biggest events get scheduled first
+
+        :return: list of event index
+        """
+        costs = [self._event_cost(_path) for _path in paths]
+        return sorted(range(len(paths)), key=lambda i: costs[i],
+                      reverse=True)
+
+    def _run_one_event(self, path, param):
+        """
+        Run one event. Exceptions are caught so one bad event won't
+        stop the other events in the event farm
+
+        :return: True if succeed, otherwise False
+        """
+        try:
+            self._core(path, copy.deepcopy(param))
+        except Exception:
+            print("Error in event %s:\n%s" % (path, traceback.format_exc()))
+            return False
+        return True
+
+    def _event_farm_mpi(self, paths, param):
+        """
+        Event farm in mpi mode. Rank 0 works as master and hands out
+        whole events, biggest first, from a dynamic work queue. Other
+        ranks process one event at a time, without mpi.
+        """
+        comm = self.comm
+        rank = self.rank
+        nworkers = comm.Get_size() - 1
+
+        self.executor = SerialExecutor()
+        self.mpi_mode = False
+        self.comm = None
+        self.rank = 0
+
+        if rank == 0:
+            print("Event farm: %d events on %d ranks"
+                  % (len(paths), nworkers))
+            failed = []
+            for event_idx in self._sort_events(paths) + [None] * nworkers:
+                worker, last_idx, status = comm.recv(tag=_TAG_REQUEST)
+                if last_idx is not None and not status:
+                    failed.append(last_idx)
+                comm.send(event_idx, dest=worker, tag=_TAG_TASK)
+        else:
+            last_idx = None
+            status = True
+            while True:
+                comm.send((rank, last_idx, status), dest=0, tag=_TAG_REQUEST)
+                last_idx = comm.recv(source=0, tag=_TAG_TASK)
+                if last_idx is None:
+                    break
+                status = self._run_one_event(paths[last_idx], param)
+
+        self.executor = get_executor("mpi")
+        self.mpi_mode = True
+        self.comm = comm
+        self.rank = rank
+
+        if rank == 0 and len(failed) > 0:
+            print("Failed events: %s" % [paths[_i] for _i in failed])
+        comm.barrier()
+
+    def _event_farm_pool(self, paths, param):
+        """
+        Event farm in non-mpi mode. Whole events, biggest first, are
+        handed to the workers of a local process pool.
+        """
+        nworkers = getattr(self.executor, "nworkers", 1)
+        print("Event farm: %d events on %d workers"
+              % (len(paths), nworkers))
+        executor = self.executor
+        self.executor = SerialExecutor()
+
+        failed = []
+        with ProcessPoolExecutor(max_workers=nworkers) as pool:
+            futures = {}
+            for event_idx in self._sort_events(paths):
+                future = pool.submit(_run_event_in_pool, self,
+                                     paths[event_idx], param)
+                futures[future] = event_idx
+            for future in as_completed(futures):
+                if not future.result():
+                    failed.append(futures[future])
+
+        self.executor = executor
+        if len(failed) > 0:
+            print("Failed events: %s" % [paths[_i] for _i in failed])
+
     def smart_run(self):
         """
         Job launch method
@@ -197,8 +399,13 @@ class ProcASDFBase(object):
         param = self._parse_param()
 
         if isinstance(path, list):
-            for _path in path:
-                self._core(_path, param)
+            if not self.event_farm:
+                for _path in path:
+                    self._core(_path, param)
+            elif self.mpi_mode:
+                self._event_farm_mpi(path, param)
+            else:
+                self._event_farm_pool(path, param)
         elif isinstance(path, dict):
             self._core(path, param)
         else:
@@ -46,9 +46,11 @@ def process_wrapper(stream, inv, param=None):
 
 class ProcASDF(ProcASDFBase):
 
-    def __init__(self, path, param, verbose=False, debug=False):
+    def __init__(self, path, param, verbose=False, debug=False,
+                 executor=None, nworkers=None, event_farm=False):
         ProcASDFBase.__init__(self, path, param, verbose=verbose,
-                              debug=debug)
+                              debug=debug, executor=executor,
+                              nworkers=nworkers, event_farm=event_farm)
 
     def _validate_path(self, path):
         necessary_keys = ["input_asdf", "input_tag",
@@ -81,7 +83,10 @@ class ProcASDF(ProcASDFBase):
         self.check_output_file(output_asdf, remove_flag=True)
 
         # WJ: not sure why it needs 'w', if not, it will be wrong
-        ds = self.load_asdf(input_asdf, mode='a')
+        # Pool workers open the file read-only, so the file can not
+        # be held in 'a' mode by the parent
+        mode = 'a' if self.mpi_mode else 'r'
+        ds = self.load_asdf(input_asdf, mode=mode)
 
         # read in event
         event = ds.events[0]
@@ -105,6 +110,6 @@ class ProcASDF(ProcASDFBase):
             partial(process_wrapper, param=param)
 
         tag_map = {input_tag: output_tag}
-        ds.process(process_function, output_asdf, tag_map=tag_map)
+        self.process(ds, process_function, output_asdf, tag_map)
 
         del ds
@@ -114,3 +114,53 @@ def extract_adjoint_stations(asdf, stations=None):
                                     pars["depth_in_m"]]
 
     return sta_dict
+
+
+def count_station_windows(sta_win):
+    """
+    Count the total number of windows of one station
+    """
+    if not sta_win:
+        return 0
+    return sum(len(chan_win) for chan_win in sta_win.itervalues())
+
+
+def build_station_pair_index(obsd_ds, synt_ds, obsd_tag, synt_tag,
+                             obsd_staxml=False, synt_staxml=False,
+                             windows=None):
+    """
+    Pre-scan a pair of asdf files and find the stations which have
+    the obsd_tag and synt_tag(and StationXML, if required). If windows
+    are given, stations without windows are also dropped. Only those
+    stations need to be dispatched to process_two_files.
+
+    :param obsd_staxml: require StationXML in the observed file
+    :param synt_staxml: require StationXML in the synthetic file
+    :param windows: windows dict, keyed by station
+    :return: sorted list of matched station names
+    """
+    stations = sorted(set(obsd_ds.waveforms.list()) &
+                      set(synt_ds.waveforms.list()))
+    ntotal = len(stations)
+    if windows is not None:
+        # check windows first since it doesn't touch the file
+        stations = [sta for sta in stations
+                    if count_station_windows(windows.get(sta)) > 0]
+
+    required = [(obsd_ds, obsd_tag, obsd_staxml),
+                (synt_ds, synt_tag, synt_staxml)]
+    matched = []
+    for sta in stations:
+        sta_ok = True
+        for ds, tag, staxml_flag in required:
+            content = dir(getattr(ds.waveforms, sta.replace(".", "_")))
+            if tag not in content or \
+                    (staxml_flag and "StationXML" not in content):
+                sta_ok = False
+                break
+        if sta_ok:
+            matched.append(sta)
+
+    print("Station index: %d of %d stations matched"
+          % (len(matched), ntotal))
+    return matched
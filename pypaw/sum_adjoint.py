@@ -12,13 +12,13 @@ on certain weights provided by the user
 """
 from __future__ import print_function, division, absolute_import
 import os
+import multiprocessing
+from functools import partial
 import numpy as np
 import copy
+from concurrent.futures import ProcessPoolExecutor
 from pyasdf import ASDFDataSet
-from pytomo3d.signal.rotate import rotate_one_station_stream
-from pytomo3d.adjoint.process_adjsrc import convert_stream_to_adjs
-from pytomo3d.adjoint.process_adjsrc import convert_adjs_to_stream
-from pytomo3d.adjoint.process_adjsrc import add_missing_components
+from obspy.geodetics import gps2dist_azimuth
 from pprint import pprint
 from pyadjoint import AdjointSource
 from pypaw.bins import load_json, dump_json
@@ -46,19 +46,115 @@ def check_adj_consistency(adj_base, adj):
                          % (adj_base.dt, adj.dt))
 
 
-def _rotate_one_station(sta_adjs, slat, slon, elat, elon):
-    adj_stream, meta_info = convert_adjs_to_stream(sta_adjs)
-    add_missing_components(adj_stream)
-    rotate_one_station_stream(adj_stream, elat, elon,
-                              station_latitude=slat,
-                              station_longitude=slon,
-                              mode="RT->NE")
-    new_adjs = convert_stream_to_adjs(adj_stream, meta_info)
-    adj_dict = {}
-    for _adj in new_adjs:
-        adj_id = "%s_%s_%s" % (_adj.network, _adj.station, _adj.component)
-        adj_dict[adj_id] = _adj
-    return adj_dict
+def station_backazimuths(station_latitudes, station_longitudes,
+                         event_latitude, event_longitude):
+    """
+    Back azimuths(station to event azimuth, in degree) of stations,
+    on the same ellipsoid as pytomo3d rotation
+    """
+    return np.array([gps2dist_azimuth(_lat, _lon, event_latitude,
+                                      event_longitude)[1]
+                     for _lat, _lon in zip(station_latitudes,
+                                           station_longitudes)])
+
+
+def rotate_rt_to_ne(data, backazimuths):
+    """
+    Rotate stacked (nsta, 3, npts) array of Z, R and T components to
+    Z, N and E, with the back azimuth of each station, in one array
+    operation. Same as obspy.signal.rotate.rotate_rt_ne.
+
+    :return: (nsta, 3, npts) array of Z, N and E components
+    """
+    baz = np.radians(backazimuths)[:, np.newaxis]
+    sin_baz = np.sin(baz)
+    cos_baz = np.cos(baz)
+    r = data[:, 1, :]
+    t = data[:, 2, :]
+    rotated = np.empty_like(data)
+    rotated[:, 0, :] = data[:, 0, :]
+    rotated[:, 1, :] = t * sin_baz - r * cos_baz
+    rotated[:, 2, :] = -t * cos_baz - r * sin_baz
+    return rotated
+
+
+def _rotate_station_batch(sta_tags, sta_comps, stations, event_latitude,
+                          event_longitude, npts):
+    """
+    Rotate a batch of stations with the same npts. Missing components
+    are taken as zeros. Z keeps its metadata. N and E take the
+    adjoint source type and periods of the horizontal components, with
+    zero misfit since the misfit is not defined after rotation.
+    """
+    data = np.zeros([len(sta_tags), 3, npts])
+    for idx, sta_tag in enumerate(sta_tags):
+        for icomp, comp in enumerate("ZRT"):
+            if comp in sta_comps[sta_tag]:
+                data[idx, icomp, :] = \
+                    sta_comps[sta_tag][comp].adjoint_source
+    baz = station_backazimuths(
+        [stations[_s]["latitude"] for _s in sta_tags],
+        [stations[_s]["longitude"] for _s in sta_tags],
+        event_latitude, event_longitude)
+    rotated = rotate_rt_to_ne(data, baz)
+
+    new_adjs = {}
+    for idx, sta_tag in enumerate(sta_tags):
+        comps = sta_comps[sta_tag]
+        base = comps.get("R") or comps.get("T") or comps.get("Z")
+        horizontals = [comps[_c] for _c in "RT" if _c in comps] or [base]
+        for icomp, comp in enumerate("ZNE"):
+            if comp == "Z" and "Z" in comps:
+                meta = comps["Z"]
+                misfit = meta.misfit
+                min_period = meta.min_period
+                max_period = meta.max_period
+            else:
+                meta = base
+                misfit = 0.0
+                min_period = min(_a.min_period for _a in horizontals)
+                max_period = max(_a.max_period for _a in horizontals)
+            component = base.component[:-1] + comp
+            adj = AdjointSource(
+                meta.adj_src_type, misfit, base.dt, min_period,
+                max_period, component,
+                adjoint_source=rotated[idx, icomp, :],
+                network=base.network, station=base.station,
+                location=base.location, starttime=base.starttime)
+            adj_id = "%s_%s_%s" % (adj.network, adj.station, component)
+            new_adjs[adj_id] = adj
+    return new_adjs
+
+
+def rotate_adjsrcs_rt_to_ne(adjoint_sources, stations, event_latitude,
+                            event_longitude, batch_size=1000):
+    """
+    Rotate adjoint sources from RT to NE. Each station is rotated once:
+    stations are grouped by npts and rotated in batches of batch_size
+    on stacked (nsta, 3, npts) arrays.
+
+    :param adjoint_sources: dict of AdjointSource, keyed by adj_id
+    :param stations: dict of station information, keyed by station tag
+    :return: dict of rotated AdjointSource, keyed by adj_id
+    """
+    sta_comps = {}
+    for adj in adjoint_sources.itervalues():
+        sta_tag = "%s_%s" % (adj.network, adj.station)
+        sta_comps.setdefault(sta_tag, {})[adj.component[-1]] = adj
+
+    npts_groups = {}
+    for sta_tag, comps in sta_comps.iteritems():
+        npts = len(comps.values()[0].adjoint_source)
+        npts_groups.setdefault(npts, []).append(sta_tag)
+
+    new_adjs = {}
+    for npts, sta_tags in npts_groups.iteritems():
+        sta_tags = sorted(sta_tags)
+        for idx in range(0, len(sta_tags), batch_size):
+            new_adjs.update(_rotate_station_batch(
+                sta_tags[idx:idx+batch_size], sta_comps, stations,
+                event_latitude, event_longitude, npts))
+    return new_adjs
 
 
 def validate_path(path):
@@ -88,6 +184,40 @@ def validate_path(path):
         raise ValueError("Error in path file")
 
 
+def _station_info_from_parameters(parameters):
+    """
+    Station information from the parameters of adjoint source in
+    asdf file
+    """
+    nw, sta = parameters["station_id"].split(".")
+    return {"latitude": parameters["latitude"],
+            "longitude": parameters["longitude"],
+            "elevation_in_m": parameters["elevation_in_m"],
+            "depth_in_m": parameters["depth_in_m"],
+            "station": sta, "network": nw,
+            "location": parameters["location"]}
+
+
+def check_parameters_consistency(base, parameters, npts_base, npts):
+    """
+    Same as check_adj_consistency, but on the parameters of adjoint
+    sources in asdf file, so the data doesn't need to be loaded
+    """
+    if npts_base != npts:
+        raise ValueError("Dimension of current adjoint_source(%d)"
+                         "and new added adj(%d) not the same" %
+                         (npts_base, npts))
+    if not np.isclose(base["dt"], parameters["dt"]):
+        raise ValueError("DeltaT of current adjoint source(%f)"
+                         "and new added adj(%f) not the same"
+                         % (base["dt"], parameters["dt"]))
+    if np.abs(base["time_offset"] - parameters["time_offset"]) > \
+            0.5 * parameters["dt"]:
+        raise ValueError("Start time of current adjoint source(%s)"
+                         "and new added adj(%s) not the same"
+                         % (base["time_offset"], parameters["time_offset"]))
+
+
 def load_to_adjsrc(adj, event_time):
     """
     Load from asdf file adjoint source to pyadjoint.AdjointSources
@@ -109,12 +239,7 @@ def load_to_adjsrc(adj, event_time):
                             location=loc,
                             starttime=starttime)
 
-    station_info = {"latitude": adj.parameters["latitude"],
-                    "longitude": adj.parameters["longitude"],
-                    "elevation_in_m": adj.parameters["elevation_in_m"],
-                    "depth_in_m": adj.parameters["depth_in_m"],
-                    "station": sta, "network": nw,
-                    "location": loc}
+    station_info = _station_info_from_parameters(adj.parameters)
     return new_adj, station_info
 
 
@@ -142,29 +267,24 @@ def dump_adjsrc(adj, station_info, event_time):
     return adj_array, adj_path, parameters
 
 
-def _get_station_adjsrcs(adjsrcs, sta_tag):
-    """
-    Extract three components for a specific sta_tag
-    """
-    comp_list = ["MXZ", "MXR", "MXT"]
-    adj_list = []
-    for comp in comp_list:
-        adj_name = "%s_%s" % (sta_tag, comp)
-        if adj_name in adjsrcs:
-            adj_list.append(adjsrcs[adj_name])
-    return adj_list
-
-
 def extract_event_info(event):
     origin = event.preferred_origin()
     return origin.latitude, origin.longitude, origin.time
 
 
 class PostAdjASDF(object):
+    """
+    Sum adjoint sources of different period bands based on weights.
+
+    :param streaming: sum, rotate and write out the adjoint sources
+        station by station, so only one station is kept in memory,
+        instead of loading all the adjoint sources first
+    """
 
-    def __init__(self, path, verbose=False):
+    def __init__(self, path, verbose=False, streaming=False):
         self.path = path
         self.verbose = verbose
+        self.streaming = streaming
 
         # event information
         self.events = None
@@ -179,6 +299,12 @@ class PostAdjASDF(object):
         self.adjoint_sources = {}
         self.misfits = {}
 
+        # reused float64 buffers of streaming sum
+        self._buffers = {}
+
+        # input asdf datasets, opened once and keyed by period
+        self.datasets = {}
+
     def _attach_adj(self, station_id, adj, weight):
         """
         Attach adj to self.adjoint_sources based on weight information
@@ -253,28 +379,66 @@ class PostAdjASDF(object):
 
     def add_adjoint_dataset_on_channel_weight(self, ds, weights):
         """
-        Add adjoint source based on channel window weight
+        Add adjoint source based on channel window weight. The names of
+        adjoint sources are listed once and the data is read in sorted
+        order. Channels with zero weight only contribute to the raw
+        misfit, and their data is not read.
         """
         misfits = {}
         adjsrc_group = ds.auxiliary_data.AdjointSources
+        adj_names = set(adjsrc_group.list())
+
+        # channels different only in location code share the adj_id
+        pairs = []
         for channel in weights:
             _nw, _sta, _, _comp = channel.split(".")
             adj_id = "%s_%s_MX%s" % (_nw, _sta, _comp[-1])
-            adj = adjsrc_group[adj_id]
-            new_adj, station_info = load_to_adjsrc(adj, self.event_time)
-
+            if adj_id not in adj_names:
+                print("Missing adjoint source(%s) for channel(%s). Skipped."
+                      % (adj_id, channel))
+                continue
+            pairs.append((adj_id, channel))
+
+        loaded_id = None
+        for adj_id, channel in sorted(pairs):
+            _comp = channel.split(".")[-1]
             channel_weight = weights[channel]["weight"]
-            self._attach_adj(adj_id, new_adj, channel_weight)
+            adj = adjsrc_group[adj_id]
 
-            self._attach_station(station_info)
+            if channel_weight == 0:
+                misfit = adj.parameters["misfit"]
+                self._attach_station(
+                    _station_info_from_parameters(adj.parameters))
+            else:
+                if adj_id != loaded_id:
+                    new_adj, station_info = load_to_adjsrc(
+                        adj, self.event_time)
+                    loaded_id = adj_id
+                misfit = new_adj.misfit
+                self._attach_adj(adj_id, new_adj, channel_weight)
+                self._attach_station(station_info)
 
             if _comp not in misfits:
                 misfits[_comp] = {"misfit": 0, "raw_misfit": 0}
-            misfits[_comp]["misfit"] += channel_weight * new_adj.misfit
-            misfits[_comp]["raw_misfit"] += new_adj.misfit
+            misfits[_comp]["misfit"] += channel_weight * misfit
+            misfits[_comp]["raw_misfit"] += misfit
 
         return misfits
 
+    def _get_dataset(self, period):
+        """
+        Input asdf dataset of the period band. Each file is opened only
+        once and shared by the event check and the summation.
+        """
+        if period not in self.datasets:
+            filename = self.path["input_file"][period]["asdf_file"]
+            self.datasets[period] = ASDFDataSet(filename, mode='r',
+                                                mpi=False)
+        return self.datasets[period]
+
+    def close_datasets(self):
+        self.datasets = {}
+
     def check_all_event_info(self):
         """
         Gather event information to make sure every asdf file
@@ -283,15 +447,14 @@ class PostAdjASDF(object):
         """
         error_code = 0
         error_list = []
-        for _file_info in self.path["input_file"].itervalues():
+        for period, _file_info in self.path["input_file"].iteritems():
             asdf_fn = _file_info["asdf_file"]
-            ds = ASDFDataSet(asdf_fn, mode='r')
+            ds = self._get_dataset(period)
             if self.events is None:
                 self.events = ds.events
             elif self.events != ds.events:
                 error_list.append(asdf_fn)
                 error_code = 1
-            del ds
         if error_code == 1:
             raise ValueError("Event information in %s not the same as others"
                              % (error_list))
@@ -307,7 +470,7 @@ class PostAdjASDF(object):
         print("="*15 + "\nSumming asdf files...")
         for period, _file_info in self.path["input_file"].iteritems():
             filename = _file_info["asdf_file"]
-            ds = ASDFDataSet(filename, mode='r')
+            ds = self._get_dataset(period)
 
             # if "category_weight" in _file_info:
             #    _weight = _file_info["weight"]
@@ -329,28 +492,9 @@ class PostAdjASDF(object):
         Rotate self.adjoint_sources
         """
         print("="*15 + "\nRotate adjoint sources from RT to EN")
-        done_sta_list = []
-        old_adjs = self.adjoint_sources
-        new_adjs = {}
-        station_locations = {}
-
-        for adj_id, adj in old_adjs.iteritems():
-            network = adj.network
-            station = adj.station
-            sta_tag = "%s_%s" % (network, station)
-
-            if sta_tag not in done_sta_list:
-                slat = self.stations[sta_tag]["latitude"]
-                slon = self.stations[sta_tag]["longitude"]
-
-                sta_adjs = _get_station_adjsrcs(old_adjs, sta_tag)
-                adj_dict = _rotate_one_station(sta_adjs, slat, slon,
-                                               self.event_latitude,
-                                               self.event_longitude)
-                new_adjs.update(adj_dict)
-
-        self.station_locations = station_locations
-        self.adjoint_sources = new_adjs
+        self.adjoint_sources = rotate_adjsrcs_rt_to_ne(
+            self.adjoint_sources, self.stations, self.event_latitude,
+            self.event_longitude)
 
     def dump_to_asdf(self, outputfile):
         """
@@ -376,29 +520,257 @@ class PostAdjASDF(object):
             ds.add_auxiliary_data(adj_array, data_type="AdjointSources",
                                   path=adj_path, parameters=parameters)
 
+    def _buffer(self, name, npts):
+        """
+        Preallocated float64 buffer, reused between stations and only
+        reallocated when a longer one is needed
+        """
+        buf = self._buffers.get(name)
+        if buf is None or len(buf) < npts:
+            buf = np.zeros(npts, dtype=np.float64)
+            self._buffers[name] = buf
+        return buf[:npts]
+
+    def _group_weights_by_station(self, weights_dict, adj_names):
+        """
+        Group channel weights of all period bands by station. Channels
+        whose adjoint source is missing are skipped, the same as in
+        add_adjoint_dataset_on_channel_weight.
+
+        :param weights_dict: dict of channel weights, keyed by period
+        :param adj_names: set of names of adjoint sources, keyed by period
+        :return: dict of list of (period, channel, adj_id, weight), keyed
+            by station tag
+        """
+        station_entries = {}
+        for period, weights in weights_dict.iteritems():
+            for channel, weight_info in weights.iteritems():
+                _nw, _sta, _, _comp = channel.split(".")
+                sta_tag = "%s_%s" % (_nw, _sta)
+                adj_id = "%s_MX%s" % (sta_tag, _comp[-1])
+                if adj_id not in adj_names[period]:
+                    print("Missing adjoint source(%s) for channel(%s). "
+                          "Skipped." % (adj_id, channel))
+                    continue
+                station_entries.setdefault(sta_tag, []).append(
+                    (period, channel, adj_id, weight_info["weight"]))
+        return station_entries
+
+    def _sum_one_station(self, entries, adjsrc_groups):
+        """
+        Sum the adjoint sources of one station over all period bands,
+        into the preallocated buffers
+
+        :return: list of summed AdjointSource, station information
+        """
+        comps = {}
+        station_info = None
+        for period, channel, adj_id, weight in sorted(entries):
+            adj = adjsrc_groups[period][adj_id]
+            parameters = adj.parameters
+
+            station_info = _station_info_from_parameters(parameters)
+            self._attach_station(station_info)
+
+            misfits = self.misfits.setdefault(period, {})
+            _comp = channel.split(".")[-1]
+            if _comp not in misfits:
+                misfits[_comp] = {"misfit": 0, "raw_misfit": 0}
+            misfits[_comp]["misfit"] += weight * parameters["misfit"]
+            misfits[_comp]["raw_misfit"] += parameters["misfit"]
+
+            if weight == 0:
+                # no contribution, so the data is not read
+                continue
+
+            npts = adj.data.shape[0]
+            comp = adj_id.split("_")[-1]
+
+            if comp not in comps:
+                buf = self._buffer(comp, npts)
+                buf[:] = 0.0
+                comps[comp] = {"data": buf, "parameters": parameters,
+                               "misfit": 0.0,
+                               "min_period": parameters["min_period"],
+                               "max_period": parameters["max_period"]}
+            _comp_sum = comps[comp]
+            check_parameters_consistency(
+                _comp_sum["parameters"], parameters,
+                len(_comp_sum["data"]), npts)
+
+            scratch = self._buffer("scratch", npts)
+            adj.data.read_direct(scratch)
+            scratch *= weight
+            _comp_sum["data"] += scratch
+            _comp_sum["misfit"] += weight * parameters["misfit"]
+            _comp_sum["min_period"] = min(_comp_sum["min_period"],
+                                          parameters["min_period"])
+            _comp_sum["max_period"] = max(_comp_sum["max_period"],
+                                          parameters["max_period"])
+
+        adjs = []
+        for comp in sorted(comps):
+            _comp_sum = comps[comp]
+            parameters = _comp_sum["parameters"]
+            adjs.append(AdjointSource(
+                parameters["adjoint_source_type"], _comp_sum["misfit"],
+                parameters["dt"], _comp_sum["min_period"],
+                _comp_sum["max_period"], comp,
+                adjoint_source=_comp_sum["data"],
+                network=station_info["network"],
+                station=station_info["station"], location="",
+                starttime=self.event_time + parameters["time_offset"]))
+        return adjs, station_info
+
+    def stream_sum_asdf(self, outputfile):
+        """
+        Sum different asdf files station by station. Each station is
+        rotated(if rotate_flag) and written into outputfile right away,
+        so the peak memory is one station's adjoint sources.
+        """
+        print("="*15 + "\nStreaming sum of asdf files into: %s"
+              % outputfile)
+        if os.path.exists(outputfile):
+            print("Output file exists and removed:%s" % outputfile)
+            os.remove(outputfile)
+
+        adjsrc_groups = {}
+        adj_names = {}
+        weights_dict = {}
+        for period, _file_info in self.path["input_file"].iteritems():
+            adjsrc_groups[period] = \
+                self._get_dataset(period).auxiliary_data.AdjointSources
+            adj_names[period] = set(adjsrc_groups[period].list())
+            weights_dict[period] = load_json(_file_info["weight_file"])
+            self.misfits[period] = {}
+            print("Adding asdf file(%s) using assigned weight_file(%s)"
+                  % (_file_info["asdf_file"], _file_info["weight_file"]))
+
+        station_entries = self._group_weights_by_station(weights_dict,
+                                                         adj_names)
+        del weights_dict
+
+        output_ds = ASDFDataSet(outputfile, mode='a', compression=None,
+                                mpi=False)
+        output_ds.add_quakeml(self.events)
+        for sta_tag in sorted(station_entries):
+            adjs, station_info = self._sum_one_station(
+                station_entries[sta_tag], adjsrc_groups)
+            if self.path["rotate_flag"]:
+                adjs = rotate_adjsrcs_rt_to_ne(
+                    dict(enumerate(adjs)), self.stations,
+                    self.event_latitude, self.event_longitude).values()
+            for adj in adjs:
+                adj_array, adj_path, parameters = \
+                    dump_adjsrc(adj, station_info, self.event_time)
+                output_ds.add_auxiliary_data(
+                    adj_array, data_type="AdjointSources", path=adj_path,
+                    parameters=parameters)
+        del output_ds
+        del adjsrc_groups
+
     def smart_run(self):
 
         if isinstance(self.path, str):
             self.path = load_json(self.path)
-        elif not isinstance(self.path, str):
+        elif not isinstance(self.path, dict):
             raise TypeError("self.path must be filename or dict")
 
         validate_path(self.path)
 
         self.check_all_event_info()
 
-        # sum asdf files
-        self.sum_asdf()
-
-        if self.path["rotate_flag"]:
-            self.rotate_asdf()
-
         outputfile = self.path["output_file"]
         outputdir = os.path.dirname(outputfile)
         if not os.path.exists(outputdir):
             os.makedirs(outputdir)
-        self.dump_to_asdf(outputfile)
+
+        if self.streaming:
+            self.stream_sum_asdf(outputfile)
+        else:
+            # sum asdf files
+            self.sum_asdf()
+
+            if self.path["rotate_flag"]:
+                self.rotate_asdf()
+
+            self.dump_to_asdf(outputfile)
+
+        self.close_datasets()
 
         # write out the misfit summary
         misfit_file = outputfile.rstrip("h5") + "adjoint.misfit.json"
         dump_json(self.misfits, misfit_file)
+
+
+def _sum_one_event(path, verbose=False, streaming=False):
+    """
+    Worker function: sum the adjoint sources of one event
+
+    :return: output file, misfits and error message(None if succeeded)
+    """
+    try:
+        job = PostAdjASDF(path, verbose=verbose, streaming=streaming)
+        job.smart_run()
+    except Exception as err:
+        print("Error summing event(%s) due to: %s"
+              % (path["output_file"], err))
+        return path["output_file"], None, str(err)
+    return path["output_file"], job.misfits, None
+
+
+def combine_misfit_summary(event_misfits):
+    """
+    Combine the misfit summary of events, and sum them up for each
+    period band and component
+
+    :param event_misfits: dict of misfits of each event, keyed by
+        output file
+    """
+    total = {}
+    for misfits in event_misfits.itervalues():
+        for period, comp_misfits in misfits.iteritems():
+            for comp, values in comp_misfits.iteritems():
+                _total = total.setdefault(period, {}).setdefault(
+                    comp, {"misfit": 0, "raw_misfit": 0, "nevents": 0})
+                _total["misfit"] += values["misfit"]
+                _total["raw_misfit"] += values["raw_misfit"]
+                _total["nevents"] += 1
+    return {"events": event_misfits, "total": total}
+
+
+def sum_adjoint_events(paths, nworkers=None, verbose=False,
+                       streaming=False, summary_file=None):
+    """
+    Sum adjoint sources of many events, each with its own path
+    information(same as PostAdjASDF), using a process pool.
+
+    :param paths: list of path dict
+    :param nworkers: number of worker processes. By default, the
+        number of cpus
+    :param summary_file: if given, the combined misfit summary is
+        written into it
+    :return: combined misfit summary
+    """
+    if nworkers is None:
+        nworkers = multiprocessing.cpu_count()
+    print("Summing %d events with %d workers" % (len(paths), nworkers))
+
+    event_misfits = {}
+    failed = {}
+    with ProcessPoolExecutor(max_workers=nworkers) as pool:
+        results = pool.map(partial(_sum_one_event, verbose=verbose,
+                                   streaming=streaming), paths)
+        for output_file, misfits, err in results:
+            if err is None:
+                event_misfits[output_file] = misfits
+            else:
+                failed[output_file] = err
+
+    summary = combine_misfit_summary(event_misfits)
+    summary["failed"] = failed
+    print("Events summed: %d; failed: %d"
+          % (len(event_misfits), len(failed)))
+    if summary_file is not None:
+        dump_json(summary, summary_file)
+    return summary
@@ -85,6 +85,71 @@ def smart_read_json(json_file, mpi_mode=True, comm=None, object_hook=False):
     return json_obj
 
 
+class JSONStreamWriter(object):
+    """
+    Write a json object(dict) to file item by item, so the whole
+    content never needs to be held in memory. Items are written in
+    the order they come; values are dumped with sorted keys.
+    The file content loads into the same dict as json.dump.
+
+    Use it as a context manager:
+        with JSONStreamWriter(filename) as writer:
+            writer.write_items(content)
+    """
+    def __init__(self, filename, indent=2, separators=None, cls=None):
+        self.filename = filename
+        self.indent = indent
+        if separators is None:
+            separators = (",", ": ") if indent is not None else (",", ":")
+        self.separators = separators
+        self.cls = cls
+        self._fh = None
+        self._nitems = 0
+
+    def __enter__(self):
+        self.open()
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+    def open(self):
+        self._fh = open(self.filename, "w")
+        self._fh.write("{")
+        self._nitems = 0
+
+    def write_item(self, key, value):
+        content = json.dumps(value, cls=self.cls, sort_keys=True,
+                             indent=self.indent, separators=self.separators)
+        item = json.dumps(key) + self.separators[1]
+        if self.indent is None:
+            sep = self.separators[0] if self._nitems > 0 else ""
+            item += content
+        else:
+            pad = " " * self.indent
+            sep = (self.separators[0] if self._nitems > 0 else "") + \
+                "\n" + pad
+            item += content.replace("\n", "\n" + pad)
+        self._fh.write(sep + item)
+        self._nitems += 1
+
+    def write_items(self, content, skip_none=True):
+        """
+        Write all items of dict content, in sorted order of keys
+        """
+        for key in sorted(content):
+            if skip_none and content[key] is None:
+                continue
+            self.write_item(key, content[key])
+
+    def close(self):
+        if self._nitems > 0 and self.indent is not None:
+            self._fh.write("\n")
+        self._fh.write("}")
+        self._fh.close()
+        self._fh = None
+
+
 def read_yaml_file(filename):
     with open(filename) as fh:
         content = yaml.load_all(fh)
@@ -16,11 +16,13 @@ import os
 import inspect
 import json
 import numpy as np
+from pyasdf import ASDFDataSet
 from .procbase import ProcASDFBase
 from pytomo3d.window.window import window_on_stream
 import pyflex
 from .utils import smart_read_yaml, smart_mkdir
 from .write_window import write_window_json
+from .window_store import write_window_table, write_windows_to_asdf
 
 
 def check_param_with_function_args(config):
@@ -69,10 +71,12 @@ def window_wrapper(obsd_station_group, synt_station_group, config_dict=None,
 
 class WindowASDF(ProcASDFBase):
 
-    def __init__(self, path, param, verbose=False, debug=False):
+    def __init__(self, path, param, verbose=False, debug=False,
+                 executor=None, nworkers=None, event_farm=False):
 
         ProcASDFBase.__init__(self, path, param, verbose=verbose,
-                              debug=debug)
+                              debug=debug, executor=executor,
+                              nworkers=nworkers, event_farm=event_farm)
 
     def _parse_param(self):
         """
@@ -101,6 +105,15 @@ class WindowASDF(ProcASDFBase):
         necessary_keys = ["obsd_asdf", "obsd_tag", "synt_asdf", "synt_tag",
                           "output_dir", "figure_mode"]
         self._missing_keys(necessary_keys, path)
+        if path.get("window_format", "json") not in ["json", "npz",
+                                                     "asdf"]:
+            raise ValueError("Not recogonized window_format: %s. "
+                             "Supported: 'json', 'npz' and 'asdf'"
+                             % path["window_format"])
+        if path.get("window_asdf", "synt") not in ["obsd", "synt"]:
+            raise ValueError("Not recogonized window_asdf: %s. "
+                             "Supported: 'obsd' and 'synt'"
+                             % path["window_asdf"])
 
     def _validate_param(self, param):
         for key, value in param.iteritems():
@@ -283,8 +296,8 @@ class WindowASDF(ProcASDFBase):
         figure_mode = path["figure_mode"]
         figure_dir = path["output_dir"]
 
-        obsd_ds = self.load_asdf(obsd_file)
-        synt_ds = self.load_asdf(synt_file)
+        obsd_ds = self.load_asdf(obsd_file, mode="r")
+        synt_ds = self.load_asdf(synt_file, mode="r")
 
         event = obsd_ds.events[0]
 
@@ -295,8 +308,11 @@ class WindowASDF(ProcASDFBase):
                           event=event, figure_mode=figure_mode,
                           figure_dir=figure_dir, _verbose=self._verbose)
 
-        results = \
-            obsd_ds.process_two_files(synt_ds, winfunc)
+        stations = self.build_station_index(
+            obsd_ds, synt_ds, obsd_tag, synt_tag, synt_staxml=True)
+
+        results = self.process_two_files(obsd_ds, synt_ds, winfunc,
+                                         stations=stations)
 
         if self.rank == 0:
             if instrument_merge_flag:
@@ -307,5 +323,26 @@ class WindowASDF(ProcASDFBase):
                                     instrument_merge_flag,
                                     path["output_dir"],)
 
-        if self.rank == 0:
-            write_window_json(results, output_dir)
+        window_format = path.get("window_format", "json")
+        if window_format == "asdf":
+            # windows go into the auxiliary data of the observed or
+            # synthetic asdf file, which has to be closed by all ranks
+            # before rank 0 reopens it for writing
+            window_asdf = path["%s_asdf" % path.get("window_asdf", "synt")]
+            del obsd_ds
+            del synt_ds
+            if self.mpi_mode:
+                self.comm.barrier()
+            if self.rank == 0:
+                ds = ASDFDataSet(window_asdf, mode="a", mpi=False)
+                write_windows_to_asdf(results, ds)
+                del ds
+            if self.mpi_mode:
+                self.comm.barrier()
+        elif self.rank == 0:
+            if window_format == "json":
+                write_window_json(results, output_dir,
+                                  compact=path.get("compact_json", False))
+            else:
+                write_window_table(results,
+                                   os.path.join(output_dir, "windows.npz"))
@@ -0,0 +1,378 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+"""
+Binary columnar store for windows, as an alternative to windows.json.
+Windows are kept in a numpy npz file with one row per window: numeric
+fields are typed columns, channel ids go into a string table and the
+station and trace ids are kept so the nested dict of windows.json,
+including traces without windows, could be restored exactly.
+
+Windows could also be stored inside the asdf file, as auxiliary data
+under "Windows/<station>", one array per station, so they stay with
+the waveforms they describe. Times are stored as timestamp columns and
+channel ids as indexes, so the attributes of a station stay small no
+matter how many windows it has.
+
+:copyright:
+    Wenjie Lei (lei@princeton.edu), 2016
+:license:
+    GNU Lesser General Public License, version 3 (LGPLv3)
+    (http://www.gnu.org/licenses/lgpl-3.0.en.html)
+"""
+from __future__ import (absolute_import, division, print_function)
+import os
+import json
+import numpy as np
+from obspy import UTCDateTime
+from .utils import smart_read_json, _get_mpi_comm
+from .write_window import get_json_content, write_window_json
+from .stations import count_station_windows
+
+INT_FIELDS = ["left_index", "right_index", "center_index",
+              "cc_shift_in_samples"]
+FLOAT_FIELDS = ["max_cc_value", "cc_shift_in_seconds", "dlnA", "dt",
+                "min_period", "relative_starttime", "relative_endtime",
+                "window_weight"]
+TIME_FIELDS = ["time_of_first_sample", "absolute_starttime",
+               "absolute_endtime"]
+STRING_FIELDS = ["channel_id", "channel_id_2"]
+
+# data type of windows in the auxiliary data of asdf file
+WINDOW_DATA_TYPE = "Windows"
+
+
+def _to_window_dict(window):
+    if isinstance(window, dict):
+        return window
+    return get_json_content(window)
+
+
+def windows_to_table(windows):
+    """
+    Convert windows, in the format of windows.json(or pyflex.Window
+    objects in the same structure), to columns
+
+    :param windows: dict of windows, keyed by station and trace id
+    :return: dict of numpy arrays
+    """
+    stations = []
+    traces = []
+    trace_station = []
+    window_trace = []
+    rows = []
+    for sta in sorted(windows):
+        sta_win = windows[sta]
+        if sta_win is None:
+            continue
+        stations.append(sta)
+        for trace_id in sorted(sta_win):
+            traces.append(trace_id)
+            trace_station.append(len(stations) - 1)
+            for win in sta_win[trace_id]:
+                window_trace.append(len(traces) - 1)
+                rows.append(_to_window_dict(win))
+
+    strings = {}
+
+    def _string_index(value):
+        if value is None:
+            return -1
+        return strings.setdefault(value, len(strings))
+
+    table = {
+        "stations": np.array(stations, dtype="U"),
+        "traces": np.array(traces, dtype="U"),
+        "trace_station": np.array(trace_station, dtype=np.int32),
+        "window_trace": np.array(window_trace, dtype=np.int32)}
+    for field in INT_FIELDS:
+        table[field] = np.array([_r[field] for _r in rows], dtype=np.int64)
+    for field in FLOAT_FIELDS:
+        table[field] = np.array([_r[field] for _r in rows],
+                                dtype=np.float64)
+    for field in TIME_FIELDS:
+        table[field] = np.array([str(_r[field]) for _r in rows],
+                                dtype="U")
+    for field in STRING_FIELDS:
+        table[field] = np.array([_string_index(_r.get(field))
+                                 for _r in rows], dtype=np.int32)
+
+    string_table = [None] * len(strings)
+    for value, idx in strings.iteritems():
+        string_table[idx] = value
+    table["strings"] = np.array(string_table, dtype="U")
+    return table
+
+
+def table_to_windows(table):
+    """
+    Convert columns back to the nested dict of windows, the same as
+    loading windows.json
+
+    :param table: dict of numpy arrays(or the npz file)
+    :return: dict of windows, keyed by station and trace id
+    """
+    stations = table["stations"].tolist()
+    traces = table["traces"].tolist()
+    strings = table["strings"].tolist()
+
+    windows = dict((sta, {}) for sta in stations)
+    trace_lists = []
+    for trace_id, sta_idx in zip(traces, table["trace_station"].tolist()):
+        trace_win = []
+        windows[stations[sta_idx]][trace_id] = trace_win
+        trace_lists.append(trace_win)
+
+    fields = INT_FIELDS + FLOAT_FIELDS + TIME_FIELDS
+    columns = [table[field].tolist() for field in fields]
+    string_columns = [table[field].tolist() for field in STRING_FIELDS]
+    for irow, trace_idx in enumerate(table["window_trace"].tolist()):
+        win = dict((field, col[irow]) for field, col in zip(fields, columns))
+        for field, col in zip(STRING_FIELDS, string_columns):
+            if col[irow] >= 0:
+                win[field] = strings[col[irow]]
+        trace_lists[trace_idx].append(win)
+
+    return windows
+
+
+def write_window_table(windows, filename, compress=False):
+    """
+    Write windows into npz file
+
+    :param windows: dict of windows, keyed by station and trace id
+    :param compress: compress the npz file
+    """
+    print("Output window file: %s" % filename)
+    table = windows_to_table(windows)
+    with open(filename, "wb") as fh:
+        if compress:
+            np.savez_compressed(fh, **table)
+        else:
+            np.savez(fh, **table)
+
+
+def read_window_table(filename):
+    """
+    Read the columns of windows from npz file, without building the
+    nested dict
+
+    :return: dict of numpy arrays
+    """
+    with np.load(filename) as npz:
+        return dict((key, npz[key]) for key in npz.files)
+
+
+def load_windows(filename):
+    """
+    Load windows from json or npz file(by extension), in the format
+    of windows.json
+    """
+    if os.path.splitext(filename)[1] == ".npz":
+        return table_to_windows(read_window_table(filename))
+    return smart_read_json(filename, mpi_mode=False)
+
+
+def smart_load_windows(filename, mpi_mode=True, comm=None, bcast=True):
+    """
+    Load windows from json or npz file on rank 0 and broadcast to
+    all ranks in mpi mode
+
+    :param bcast: if False, windows are only loaded on rank 0 and the
+        other ranks get None. See scatter_windows.
+    """
+    if not mpi_mode:
+        return load_windows(filename)
+
+    if comm is None:
+        comm = _get_mpi_comm()
+    if comm.Get_rank() == 0:
+        try:
+            windows = load_windows(filename)
+        except Exception as err:
+            print("Error in %s:%s" % (filename, err))
+            comm.Abort()
+    else:
+        windows = None
+    if not bcast:
+        return windows
+    return comm.bcast(windows, root=0)
+
+
+def scatter_windows(windows, partition, comm=None):
+    """
+    Scatter windows from rank 0 so that each rank gets only the
+    windows of its own stations, instead of broadcasting all of them
+
+    :param windows: dict of all windows on rank 0, ignored on the
+        other ranks
+    :param partition: list of stations of each rank, same on all ranks
+    :return: dict of windows of the stations of this rank
+    """
+    if comm is None:
+        comm = _get_mpi_comm()
+    if comm.Get_rank() == 0:
+        shards = [dict((sta, windows[sta]) for sta in part)
+                  for part in partition]
+    else:
+        shards = None
+    return comm.scatter(shards, root=0)
+
+
+def convert_window_file(input_file, output_file, compress=False):
+    """
+    Convert window file between json and npz, based on the extension
+    of output_file
+    """
+    windows = load_windows(input_file)
+    if os.path.splitext(output_file)[1] == ".npz":
+        write_window_table(windows, output_file, compress=compress)
+    else:
+        write_window_json(windows, os.path.dirname(output_file),
+                          filename=os.path.basename(output_file))
+
+
+def _time_to_timestamp(value):
+    return UTCDateTime(value).timestamp
+
+
+def _timestamp_to_time(value):
+    """
+    Time string of the timestamp, the same as str(UTCDateTime), to the
+    microsecond. The float timestamp of a date around now is good to
+    about 0.2 microsecond, so the rounding restores it exactly.
+    """
+    seconds, microseconds = divmod(int(round(value * 1e6)), 1000000)
+    return "%s.%06dZ" % (
+        UTCDateTime(seconds).strftime("%Y-%m-%dT%H:%M:%S"), microseconds)
+
+
+def station_windows_to_array(sta_win):
+    """
+    Convert the windows of one station to an array with one row per
+    window, and the parameters to restore it. The columns are the
+    index of the trace id, INT_FIELDS, FLOAT_FIELDS, TIME_FIELDS as
+    timestamps and STRING_FIELDS as indexes into the trace ids followed
+    by the other channel ids(-1 if missing). Only the trace and channel
+    ids are kept in the parameters, so their size doesn't grow with the
+    number of windows.
+
+    :param sta_win: dict of windows of one station, keyed by trace id
+    :return: numpy array and dict of parameters
+    """
+    traces = sorted(sta_win)
+    channel_index = dict((_t, _i) for _i, _t in enumerate(traces))
+    channels = []
+
+    def _channel_index(value):
+        if value is None:
+            return -1
+        if value not in channel_index:
+            channel_index[value] = len(channel_index)
+            channels.append(value)
+        return channel_index[value]
+
+    rows = []
+    for trace_idx, trace_id in enumerate(traces):
+        for win in sta_win[trace_id]:
+            win = _to_window_dict(win)
+            rows.append([trace_idx] + [win[_f] for _f in INT_FIELDS] +
+                        [win[_f] for _f in FLOAT_FIELDS] +
+                        [_time_to_timestamp(win[_f]) for _f in TIME_FIELDS] +
+                        [_channel_index(win.get(_f)) for _f in STRING_FIELDS])
+
+    ncols = 1 + len(INT_FIELDS + FLOAT_FIELDS + TIME_FIELDS + STRING_FIELDS)
+    data = np.array(rows, dtype=np.float64).reshape(-1, ncols)
+    parameters = {"traces": json.dumps(traces),
+                  "channels": json.dumps(channels),
+                  "nwins": len(rows)}
+    return data, parameters
+
+
+def array_to_station_windows(data, parameters):
+    """
+    Convert the array and parameters of one station back to the
+    windows dict of this station, keyed by trace id
+    """
+    traces = json.loads(parameters["traces"])
+    channels = traces + json.loads(parameters["channels"])
+    sta_win = dict((trace_id, []) for trace_id in traces)
+
+    for row in np.asarray(data).tolist():
+        win = {}
+        columns = iter(row[1:])
+        for field, value in zip(INT_FIELDS, columns):
+            win[field] = int(value)
+        for field, value in zip(FLOAT_FIELDS, columns):
+            win[field] = value
+        for field, value in zip(TIME_FIELDS, columns):
+            win[field] = _timestamp_to_time(value)
+        for field, value in zip(STRING_FIELDS, columns):
+            if value >= 0:
+                win[field] = channels[int(value)]
+        sta_win[traces[int(row[0])]].append(win)
+    return sta_win
+
+
+def write_windows_to_asdf(windows, ds):
+    """
+    Write windows into the auxiliary data of the asdf dataset, as
+    "Windows/<station>". Existing windows in the dataset are replaced.
+    Stations without any window are not written since nothing could
+    be measured on them.
+
+    :param windows: dict of windows, keyed by station and trace id
+    :param ds: asdf dataset, opened in "a" mode
+    """
+    print("Output windows into asdf file: %s" % ds.filename)
+    aux_group = ds._auxiliary_data_group
+    if WINDOW_DATA_TYPE in aux_group:
+        del aux_group[WINDOW_DATA_TYPE]
+
+    for sta in sorted(windows):
+        sta_win = windows[sta]
+        if count_station_windows(sta_win) == 0:
+            continue
+        data, parameters = station_windows_to_array(sta_win)
+        parameters["station"] = sta
+        ds.add_auxiliary_data(data, data_type=WINDOW_DATA_TYPE,
+                              path=sta.replace(".", "_"),
+                              parameters=parameters)
+
+
+def read_window_counts_from_asdf(ds):
+    """
+    Read the number of windows of each station from the asdf dataset.
+    Only the parameters are read, not the window arrays.
+
+    :return: dict of number of windows, keyed by station
+    """
+    if WINDOW_DATA_TYPE not in ds.auxiliary_data:
+        raise ValueError("No windows in asdf file: %s" % ds.filename)
+    group = ds.auxiliary_data[WINDOW_DATA_TYPE]
+    counts = {}
+    for path in group.list():
+        parameters = group[path].parameters
+        counts[parameters["station"]] = int(parameters["nwins"])
+    return counts
+
+
+def read_windows_from_asdf(ds, stations=None):
+    """
+    Read windows from the asdf dataset. If stations are given, only
+    windows of those stations are read, so each rank could read just
+    the stations it processes.
+
+    :return: dict of windows, keyed by station and trace id
+    """
+    group = ds.auxiliary_data[WINDOW_DATA_TYPE]
+    if stations is None:
+        paths = group.list()
+    else:
+        paths = [sta.replace(".", "_") for sta in stations]
+
+    windows = {}
+    for path in paths:
+        aux = group[path]
+        windows[aux.parameters["station"]] = \
+            array_to_station_windows(aux.data, aux.parameters)
+    return windows
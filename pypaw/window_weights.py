@@ -12,19 +12,30 @@ distribution.
 """
 from __future__ import print_function, division, absolute_import
 
+import io
 import os
 from collections import defaultdict
+from functools import partial
 import numpy as np
+import h5py
 import logging
+from concurrent.futures import ProcessPoolExecutor
 import matplotlib.pyplot as plt
 plt.switch_backend('agg')  # NOQA
 
 from spaceweight import SpherePoint
 from spaceweight import SphereDistRel
-from pyasdf import ASDFDataSet
+from obspy import read_events
 from pypaw.bins.utils import load_json, dump_json, load_yaml
+from pypaw.window_store import load_windows, read_window_table
+from pypaw.executor import lpt_partition
+from pypaw.neighbor_weight import NeighborDistWeight
+from pypaw.utils import _get_mpi_comm
 
 
+# "exact": all-pairs SphereDistRel; "kdtree": NeighborDistWeight
+RECEIVER_WEIGHTING_ENGINES = ["exact", "kdtree"]
+
 # Setup the logger.
 logger = logging.getLogger(" window-weight")
 logger.setLevel(logging.INFO)
@@ -52,7 +63,12 @@ def safe_mkdir(dirname):
         if not os.path.isdir(dirname):
             raise ValueError("Check (%s) is not a dir" % dirname)
     else:
-        os.makedirs(dirname)
+        try:
+            os.makedirs(dirname)
+        except OSError:
+            # could be created by another worker at the same time
+            if not os.path.isdir(dirname):
+                raise
 
 
 def validate_path(path):
@@ -100,6 +116,12 @@ def validate_param(param):
             print("Key(%s) not in param file")
             err = 1
 
+    engine = param.get("receiver_weighting_engine", "exact")
+    if engine not in RECEIVER_WEIGHTING_ENGINES:
+        print("Unknown receiver_weighting_engine(%s), supported: %s"
+              % (engine, RECEIVER_WEIGHTING_ENGINES))
+        err = 1
+
     if err != 0:
         raise ValueError("Error in param file. Please double check!")
 
@@ -112,46 +134,205 @@ def extract_receiver_locations(station_file, windows):
     return station_info
 
 
-def extract_source_location(input_info):
+def read_source_location(asdf_fn):
     """
-    Extract source location information from asdf file
+    Read the source location from the QuakeML inside the asdf file.
+    Only the QuakeML dataset is read through h5py, instead of opening
+    the whole asdf file.
+    """
+    with h5py.File(asdf_fn, "r") as fh:
+        if "QuakeML" not in fh:
+            raise ValueError("No QuakeML in asdf file: %s" % asdf_fn)
+        quakeml = np.asarray(fh["QuakeML"][()]).tobytes()
+    event = read_events(io.BytesIO(quakeml), format="QUAKEML")[0]
+    origin = event.preferred_origin()
+    return {"latitude": origin.latitude, "longitude": origin.longitude,
+            "depth:": origin.depth}
+
+
+def extract_source_location(input_info, cache_file=None):
+    """
+    Extract source location information from asdf file. Each asdf
+    file is read once for all period bands. If cache_file is given,
+    locations are cached on disk, keyed by the asdf file path and its
+    mtime, so re-runs don't read the asdf files again.
     """
     logger_block("Extracting source location information")
+    cache = {}
+    if cache_file is not None and os.path.exists(cache_file):
+        cache = load_json(cache_file)
+
+    nread = 0
     src_info = defaultdict(dict)
     for period, period_info in input_info.iteritems():
         logger.info("Period band: %s -- Number of files: %s"
                     % (period, len(period_info)))
         for eventname, event_info in period_info.iteritems():
-            asdf_fn = event_info["asdf_file"]
-            ds = ASDFDataSet(asdf_fn, mode='r')
-            event = ds.events[0]
-            origin = event.preferred_origin()
-            latitude = origin.latitude
-            longitude = origin.longitude
-            depth = origin.depth
+            asdf_fn = os.path.abspath(event_info["asdf_file"])
+            mtime = os.path.getmtime(asdf_fn)
+            entry = cache.get(asdf_fn)
+            if entry is None or entry["mtime"] != mtime:
+                entry = read_source_location(asdf_fn)
+                entry["mtime"] = mtime
+                cache[asdf_fn] = entry
+                nread += 1
             src_info[period][eventname] = {
-                "latitude": latitude, "longitude": longitude,
-                "depth:": depth}
+                "latitude": entry["latitude"],
+                "longitude": entry["longitude"],
+                "depth:": entry["depth:"]}
 
+    logger.info("Number of asdf files read: %d" % nread)
+    if cache_file is not None and nread > 0:
+        dump_json(cache, cache_file)
     return src_info
 
 
-def _receiver_validator(weights, rec_wcounts, src_wcounts):
+def _channel_table(channels, nwins):
+    """
+    Build the channel table from channel ids and number of windows.
+    Channels without windows are dropped and the rest are sorted by id.
+
+    :return: dict of numpy arrays, "channels", "components" and "nwins"
+    """
+    channels = np.array(channels, dtype="U")
+    nwins = np.array(nwins, dtype=np.int64)
+    keep = nwins > 0
+    channels = channels[keep]
+    nwins = nwins[keep]
+    order = np.argsort(channels)
+    channels = channels[order]
+    components = np.array([_c.split(".")[-1] for _c in channels.tolist()],
+                          dtype="U")
+    return {"channels": channels, "components": components,
+            "nwins": nwins[order]}
+
+
+def channel_window_counts(windows):
+    """
+    Count the windows of each channel, as a channel table
+
+    :param windows: dict of windows, keyed by station and channel id
+    :return: dict of numpy arrays, "channels", "components" and "nwins"
+    """
+    channels = []
+    nwins = []
+    for sta_window in windows.itervalues():
+        if sta_window is None:
+            continue
+        for chan, chan_win in sta_window.iteritems():
+            channels.append(chan)
+            nwins.append(len(chan_win))
+    return _channel_table(channels, nwins)
+
+
+def read_channel_window_counts(window_file):
+    """
+    Read the window counts of each channel from window file. For npz
+    window file, the counts come from the window columns directly,
+    without building the windows.
+    """
+    if os.path.splitext(window_file)[1] == ".npz":
+        table = read_window_table(window_file)
+        nwins = np.bincount(table["window_trace"],
+                            minlength=len(table["traces"]))
+        return _channel_table(table["traces"], nwins)
+    return channel_window_counts(load_windows(window_file))
+
+
+def _receiver_validator(components, weights, nwins):
+    comps, comp_idx = np.unique(components, return_inverse=True)
+    wsums = np.bincount(comp_idx, weights=weights * nwins,
+                        minlength=len(comps))
+    counts = np.bincount(comp_idx, weights=nwins, minlength=len(comps))
+    for comp, wsum, count in zip(comps.tolist(), wsums, counts):
+        if not np.isclose(wsum, count):
+            raise ValueError("receiver validator fails(%s): %f, %f" %
+                             (comp, wsum, count))
+
+
+def _channel_location(stations, chan):
+    """
+    Location of the channel. For R and T component, there are only E
+    and N(or 1 and 2) component in station file, so the location of
+    E, 1 or Z channel is used.
+    """
+    if chan[-1] == "Z":
+        candidates = [chan]
+    else:
+        candidates = [chan[:-1] + "E", chan[:-1] + "1", chan[:-1] + "Z"]
+    for _chan in candidates:
+        if _chan in stations:
+            return stations[_chan]["latitude"], stations[_chan]["longitude"]
+    raise ValueError("Missing station location of channel: %s" % chan)
+
+
+class DistanceMatrixCache(object):
+    """
+    Great-circle distances(in degrees) between the receivers of one
+    event. The matrix is built once over the unique receiver coordinates
+    and shared by the components, each of which takes the sub-matrix
+    of its own channels.
+
+    :param locations: dict of (latitude, longitude), keyed by channel id
+    """
+
+    def __init__(self, locations):
+        coords = sorted(set(locations.itervalues()))
+        coord_index = dict((_c, _i) for _i, _c in enumerate(coords))
+        self.index = dict((chan, coord_index[loc])
+                          for chan, loc in locations.iteritems())
+
+        lats, lons = np.deg2rad(np.array(coords, dtype=float).reshape(-1, 2)).T
+        xyz = np.column_stack([np.cos(lats) * np.cos(lons),
+                               np.cos(lats) * np.sin(lons),
+                               np.sin(lats)])
+        self.matrix = np.rad2deg(
+            np.arccos(np.clip(np.dot(xyz, xyz.T), -1.0, 1.0)))
+        np.fill_diagonal(self.matrix, 0.0)
+        # kept for the weight kernel, so it is not squared again for
+        # each component and each reference distance
+        self.neg_sq_matrix = -self.matrix ** 2
+
+    def submatrix(self, channels, squared=False):
+        """
+        Distance matrix between the given channels. If squared, the
+        negative squared distances are returned.
+        """
+        idx = np.array([self.index[_c] for _c in channels], dtype=int)
+        matrix = self.neg_sq_matrix if squared else self.matrix
+        return matrix[np.ix_(idx, idx)]
+
+
+class CachedSphereDistRel(SphereDistRel):
+    """
+    SphereDistRel which takes its distance matrix from a
+    DistanceMatrixCache instead of computing it pair by pair. With the
+    negative squared distances at hand, each reference distance of the
+    scan only needs one exponential over the matrix.
+    """
+
+    def __init__(self, points, distance_cache, center=None):
+        self.distance_cache = distance_cache
+        self._dist_m = None
+        self._neg_sq_dist_m = None
+        SphereDistRel.__init__(self, points, center=center)
 
-    for comp in weights:
-        wsum = 0
-        for trace_id, trace_weight in weights[comp].iteritems():
-            nwin = rec_wcounts[trace_id]
-            wsum += trace_weight * nwin
+    def _build_distance_matrix(self):
+        tags = [_p.tag for _p in self.points]
+        self._dist_m = self.distance_cache.submatrix(tags)
+        self._neg_sq_dist_m = self.distance_cache.submatrix(tags,
+                                                            squared=True)
+        return self._dist_m
 
-        if not np.isclose(wsum, src_wcounts[comp]):
-            raise ValueError("receiver validator fails: %f, %f" %
-                             (wsum, src_wcounts[comp]))
+    def _transfer_dist_to_weight(self, dist_m, ref_distance):
+        if dist_m is not self._dist_m:
+            return np.exp(-(dist_m / ref_distance) ** 2)
+        return np.exp(self._neg_sq_dist_m / ref_distance ** 2)
 
 
 def determine_receiver_weighting(src, stations, windows, max_ratio=0.35,
                                  flag=True, plot=False,
-                                 figname_prefix=None):
+                                 figname_prefix=None, engine="exact"):
     """
     Given one station and window information, determine the receiver
     weighting
@@ -159,61 +340,67 @@ def determine_receiver_weighting(src, stations, windows, max_ratio=0.35,
     ["BHR", "BHT", "BHZ"]. These three components should be treated
     indepandently and weights will be calculated independantly.
 
-    :return: dict of weights which contains 3 components. Each components
-        contains weights values
+    :return: see determine_receiver_weighting_on_table
+    """
+    return determine_receiver_weighting_on_table(
+        src, stations, channel_window_counts(windows),
+        max_ratio=max_ratio, flag=flag, plot=plot,
+        figname_prefix=figname_prefix, engine=engine)
+
+
+def determine_receiver_weighting_on_table(src, stations, table,
+                                          max_ratio=0.35, flag=True,
+                                          plot=False, figname_prefix=None,
+                                          engine="exact"):
+    """
+    Determine the receiver weighting of the channels in the channel
+    table, see channel_window_counts.
+
+    :param engine: "exact", the all-pairs SphereDistRel, or "kdtree",
+        the neighbor based NeighborDistWeight for very dense arrays,
+        which doesn't plot
+
+    :return: dict of results. "rec_table" is the channel table with
+        the receiver weights of channels added as "weights".
     """
     center = SpherePoint(src["latitude"], src["longitude"],
                          tag="source")
-
-    # extract window information
-    weights = {}
-    rec_wcounts = {}
-    src_wcounts = defaultdict(lambda: 0)
-    for sta, sta_window in windows.iteritems():
-        for chan, chan_win in sta_window.iteritems():
-            comp = chan.split(".")[-1]
-            _nwin = len(chan_win)
-            if _nwin == 0:
-                continue
-            weights.setdefault(comp, {}).update({chan: 0.0})
-            rec_wcounts[chan] = _nwin
-            src_wcounts[comp] += _nwin
+    channels = table["channels"]
+    components = table["components"]
+    nwins = table["nwins"]
+
+    locations = dict((chan, _channel_location(stations, chan))
+                     for chan in channels.tolist())
+    if engine not in RECEIVER_WEIGHTING_ENGINES:
+        raise ValueError("Unknown receiver weighting engine: %s" % engine)
+    if flag and engine == "exact":
+        # distance matrix shared by all components
+        distance_cache = DistanceMatrixCache(locations)
 
     # in each components, calculate weight
+    weights = np.ones(len(channels))
+    src_wcounts = {}
     ref_dists = {}
     cond_nums = {}
-    for comp, comp_info in weights.iteritems():
-        points = []
+    for comp in np.unique(components).tolist():
         logger.info("Components:%s" % comp)
-        for chan in comp_info:
-            _comp = chan[-1]
-            if _comp == "Z":
-                point = SpherePoint(stations[chan]["latitude"],
-                                    stations[chan]["longitude"],
-                                    tag=chan, weight=1.0)
-            else:
-                # for R and T component. In station file, there
-                # are only E and N component. So we need transfer
-                echan = chan[:-1] + "E"
-                chan1 = chan[:-1] + "1"
-                zchan = chan[:-1] + "Z"
-                if echan in stations:
-                    point = SpherePoint(stations[echan]["latitude"],
-                                        stations[echan]["longitude"],
-                                        tag=chan, weight=1.0)
-                elif chan1 in stations:
-                    point = SpherePoint(stations[chan1]["latitude"],
-                                        stations[chan1]["longitude"],
-                                        tag=chan, weight=1.0)
-                elif zchan in stations:
-                    point = SpherePoint(stations[zchan]["latitude"],
-                                        stations[zchan]["longitude"],
-                                        tag=chan, weight=1.0)
-            points.append(point)
-
-        if flag:
+        idx = np.nonzero(components == comp)[0]
+        points = []
+        for chan in channels[idx].tolist():
+            lat, lon = locations[chan]
+            points.append(SpherePoint(lat, lon, tag=chan, weight=1.0))
+
+        if flag and engine == "kdtree":
+            lats, lons = np.array([locations[_p.tag] for _p in points]).T
+            weightobj = NeighborDistWeight(lats, lons)
+            ref_dists[comp], cond_nums[comp] = weightobj.smart_scan(
+                max_ratio=max_ratio, start=0.5, gap=0.5, drop_ratio=0.95)
+            for point, weight in zip(points, weightobj.weights.tolist()):
+                point.weight = weight
+        elif flag:
             # calculate weight; otherwise, leave it as default value(1)
-            weightobj = SphereDistRel(points, center=center)
+            weightobj = CachedSphereDistRel(points, distance_cache,
+                                            center=center)
             scan_figname = figname_prefix + "%s.smart_scan.png" % comp
             ref_dists[comp], cond_nums[comp] = weightobj.smart_scan(
                 max_ratio=max_ratio, start=0.5, gap=0.5,
@@ -226,27 +413,56 @@ def determine_receiver_weighting(src, stations, windows, max_ratio=0.35,
             ref_dists[comp] = None
             cond_nums[comp] = None
 
-        wsum = 0
-        for point in points:
-            nwin = rec_wcounts[point.tag]
-            wsum += point.weight * nwin
-        norm_factor = src_wcounts[comp] / wsum
+        comp_weights = np.array([_p.weight for _p in points])
+        comp_nwins = nwins[idx]
+        src_wcounts[comp] = int(comp_nwins.sum())
+        norm_factor = src_wcounts[comp] / np.dot(comp_weights, comp_nwins)
+        weights[idx] = comp_weights * norm_factor
 
-        for point in points:
-            weights[comp][point.tag] = point.weight * norm_factor
+    _receiver_validator(components, weights, nwins)
 
-    _receiver_validator(weights, rec_wcounts, src_wcounts)
+    rec_table = dict(table)
+    rec_table["weights"] = weights
+    return {"rec_table": rec_table, "src_wcounts": src_wcounts,
+            "rec_ref_dists": ref_dists, "rec_cond_nums": cond_nums}
 
-    return {"rec_weights": weights, "rec_wcounts": rec_wcounts,
-            "src_wcounts": src_wcounts, "rec_ref_dists": ref_dists,
-            "rec_cond_nums": cond_nums}
+
+def receiver_weighting_job(period, event, event_info, src, max_ratio=0.35,
+                           flag=True, plot=False, engine="exact"):
+    """
+    Receiver weighting of one (period, event) pair, which is
+    independent from the others, so they could be run in parallel.
+
+    :return: period, event and the results of
+        determine_receiver_weighting
+    """
+    logger.info("Receiver weighting(%s, %s)" % (period, event))
+    logger.info("station file: %s" % event_info["station_file"])
+    logger.info("window file: %s" % event_info["window_file"])
+    logger.info("output file: %s" % event_info["output_file"])
+    station_info = load_json(event_info["station_file"])
+    table = read_channel_window_counts(event_info["window_file"])
+    outputdir = os.path.dirname(event_info["output_file"])
+    safe_mkdir(outputdir)
+    figname_prefix = os.path.join(outputdir, "%s.%s" % (event, period))
+    results = determine_receiver_weighting_on_table(
+        src, station_info, table, max_ratio=max_ratio,
+        flag=flag, plot=plot, figname_prefix=figname_prefix,
+        engine=engine)
+    return period, event, results
+
+
+def _run_receiver_weighting_job(job, max_ratio=0.35, flag=True,
+                                plot=False, engine="exact"):
+    return receiver_weighting_job(*job, max_ratio=max_ratio, flag=flag,
+                                  plot=plot, engine=engine)
 
 
 def _source_validator(weights, src_wcounts, cat_counts):
     for comp, comp_weights in weights.iteritems():
-        wsum = 0
-        for event, event_weights in comp_weights.iteritems():
-            wsum += event_weights * src_wcounts[event][comp]
+        events = list(comp_weights)
+        wsum = np.dot([comp_weights[_e] for _e in events],
+                      [src_wcounts[_e].get(comp, 0) for _e in events])
         if not np.isclose(wsum, cat_counts[comp]):
             raise ValueError("Source validator fails!")
 
@@ -283,6 +499,9 @@ def determine_source_weighting(src_info, src_wcounts, max_ratio=0.35,
         if plot:
             figname = figname_prefix + ".weight.png"
             weightobj.plot_global_map(figname=figname, lon0=180.0)
+    else:
+        _ref_dist = None
+        _cond_num = None
 
     # stats window counts in category level
     cat_wcounts = {}
@@ -294,27 +513,35 @@ def determine_source_weighting(src_info, src_wcounts, max_ratio=0.35,
     weights = {}
     ref_dists = {}
     cond_nums = {}
+    events = [point.tag for point in points]
+    point_weights = np.array([point.weight for point in points])
     # nomalization
     for comp in cat_wcounts:
         # ref dist and condition number are the same for different components
         # because the source distribution is exactly the same
         ref_dists[comp] = _ref_dist
         cond_nums[comp] = _cond_num
-        wsum = 0
-        for point in points:
-            nwin = src_wcounts[point.tag][comp]
-            wsum += point.weight * nwin
-        norm_factor = cat_wcounts[comp] / wsum
-        weights[comp] = {}
-        for point in points:
-            eventname = point.tag
-            weights[comp][eventname] = point.weight * norm_factor
+        nwins = np.array([src_wcounts[_e].get(comp, 0) for _e in events])
+        norm_factor = cat_wcounts[comp] / np.dot(point_weights, nwins)
+        weights[comp] = dict(zip(events,
+                                 (point_weights * norm_factor).tolist()))
 
     _source_validator(weights, src_wcounts, cat_wcounts)
     return {"src_weights": weights, "cat_wcounts": cat_wcounts,
             "src_ref_dists": ref_dists, "src_cond_nums": cond_nums}
 
 
+def weights_table_to_dict(table):
+    """
+    Convert the combined weights of channels, in numpy arrays, to the
+    dict keyed by channel id, as in the output weight file
+    """
+    keys = ["receiver", "source", "category", "weight"]
+    columns = [table[_k].tolist() for _k in keys]
+    return dict((chan, dict(zip(keys, values))) for chan, values in
+                zip(table["channels"].tolist(), zip(*columns)))
+
+
 def _category_validator(weights, counts):
     wsum = 0.0
     ncat = 0
@@ -362,16 +589,33 @@ def determine_category_weighting(cat_wcounts):
 
 
 class WindowWeight(object):
+    """
+    Window weighting, the product of receiver, source and category
+    weighting.
+
+    :param nworkers: number of worker processes for receiver weighting
+        of the (period, event) pairs. If 1, they are run one by one.
+    :param mpi_mode: distribute the receiver weighting over MPI ranks.
+        Everything else is done on rank 0.
+    """
 
-    def __init__(self, path, param):
+    def __init__(self, path, param, nworkers=1, mpi_mode=False):
         self.path = load_json(path)
         self.param = load_yaml(param)
+        self.nworkers = nworkers
+        self.mpi_mode = mpi_mode
+        if mpi_mode:
+            self.comm = _get_mpi_comm()
+            self.rank = self.comm.Get_rank()
+        else:
+            self.comm = None
+            self.rank = 0
 
         self.src_info = None
         self.weights = None
 
-        self.rec_weights = None
-        self.rec_wcounts = None
+        # channel tables with receiver weights of each (period, event)
+        self.rec_tables = None
         self.rec_ref_dists = None
         self.rec_cond_nums = None
 
@@ -389,34 +633,34 @@ class WindowWeight(object):
         category weighting
         """
         logger_block("Combine Weighting")
-        # combine weights
-        # print("source weights:", self.src_weights)
         weights = {}
-        for period, period_info in self.rec_weights.iteritems():
-            weights[period] = {}
-            for event, event_info in period_info.iteritems():
-                weights[period][event] = {}
-                for comp, comp_info in event_info.iteritems():
-                    for chan_id in comp_info:
-                        rec_weight = comp_info[chan_id]
-                        src_weight = self.src_weights[period][comp][event]
-                        cat_weight = self.cat_weights[period][comp]
-                        _weight = {"receiver": rec_weight,
-                                   "source": src_weight,
-                                   "category": cat_weight}
-                        _weight["weight"] = \
-                            rec_weight * src_weight * cat_weight
-                        weights[period][event][chan_id] = _weight
-
         nwins_array = []
         weights_array = []
+        for period, period_info in self.rec_tables.iteritems():
+            weights[period] = {}
+            for event, table in period_info.iteritems():
+                comps, comp_idx = np.unique(table["components"],
+                                            return_inverse=True)
+                comps = comps.tolist()
+                src_weights = np.array(
+                    [self.src_weights[period][_c][event] for _c in comps])
+                cat_weights = np.array(
+                    [self.cat_weights[period][_c] for _c in comps])
+                _weights = {"channels": table["channels"],
+                            "components": table["components"],
+                            "receiver": table["weights"],
+                            "source": src_weights[comp_idx],
+                            "category": cat_weights[comp_idx]}
+                _weights["weight"] = \
+                    _weights["receiver"] * _weights["source"] * \
+                    _weights["category"]
+                weights[period][event] = _weights
+                nwins_array.append(table["nwins"])
+                weights_array.append(_weights["weight"])
+
+        nwins_array = np.concatenate(nwins_array)
+        weights_array = np.concatenate(weights_array)
         # validate the sum of all weights is 1
-        for _p, _pw in weights.iteritems():
-            for _e, _ew in _pw.iteritems():
-                for _chan, _chanw in _ew.iteritems():
-                    nwins_array.append(self.rec_wcounts[_p][_e][_chan])
-                    weights_array.append(_chanw["weight"])
-
         wsum = np.dot(nwins_array, weights_array)
         if not np.isclose(wsum, 1.0):
             raise ValueError("The sum of all weights(%f) does not add "
@@ -433,8 +677,8 @@ class WindowWeight(object):
         plt.hist(nwins_array, 50)
         plt.savefig(figname)
 
-        maxw = max(weights_array)
-        minw = min(weights_array)
+        maxw = weights_array.max()
+        minw = weights_array.min()
         logger.info("Total number of receivers: %d" % len(weights_array))
         logger.info("Total number of windows: %d" % np.sum(nwins_array))
         logger.info("Weight max, min, max/min: %f, %f, %f"
@@ -450,17 +694,10 @@ class WindowWeight(object):
             log[_p] = {}
             for _e, _ew in _pw.iteritems():
                 log[_p][_e] = {}
-                maxw = defaultdict(lambda: 0)
-                minw = defaultdict(lambda: 10**9)
-                for _chan, _chanw in _ew.iteritems():
-                    comp = _chan.split(".")[-1]
-                    if _chanw["weight"] > maxw[comp]:
-                        maxw[comp] = _chanw["weight"]
-                    if _chanw["weight"] < minw[comp]:
-                        minw[comp] = _chanw["weight"]
-                for comp in maxw:
+                for comp in np.unique(_ew["components"]).tolist():
+                    _w = _ew["weight"][_ew["components"] == comp]
                     log[_p][_e][comp] = \
-                        {"maxw": maxw[comp], "minw": minw[comp],
+                        {"maxw": float(_w.max()), "minw": float(_w.min()),
                          "nwindows": self.src_wcounts[_p][_e][comp],
                          "ref_dist": self.rec_ref_dists[_p][_e][comp],
                          "cond_num": self.rec_cond_nums[_p][_e][comp]}
@@ -530,7 +767,7 @@ class WindowWeight(object):
         for period, period_info in self.weights.iteritems():
             for event, event_info in period_info.iteritems():
                 outputfn = self.path['input'][period][event]["output_file"]
-                dump_json(event_info, outputfn)
+                dump_json(weights_table_to_dict(event_info), outputfn)
 
     def calculate_receiver_weights(self):
         """
@@ -543,48 +780,52 @@ class WindowWeight(object):
         receiver_weighting = self.param["receiver_weighting"]
         plot = self.param["plot"]
         search_ratio = self.param["receiver_search_ratio"]
+        engine = self.param.get("receiver_weighting_engine", "exact")
 
-        self.rec_weights = defaultdict(dict)
-        self.rec_wcounts = defaultdict(dict)
+        self.rec_tables = defaultdict(dict)
         self.rec_ref_dists = defaultdict(dict)
         self.rec_cond_nums = defaultdict(dict)
         self.src_wcounts = defaultdict(dict)
 
-        nperiods = len(input_info)
-        period_idx = 0
-        # determine receiver weightings for each asdf file
+        jobs = []
+        costs = {}
         for period, period_info in input_info.iteritems():
-            period_idx += 1
-            logger.info("-" * 15 + "[%d/%d]Period band: %s"
-                        % (period_idx, nperiods, period) + "-" * 15)
-            nevents = len(period_info)
-            event_idx = 0
             for event, event_info in period_info.iteritems():
-                event_idx += 1
-                logger.info("*" * 6 + " [%d/%d]Event: %s "
-                            % (event_idx, nevents, event) + "*" * 6)
-                # each file still contains 3-component
-                logger.info("station file: %s" % event_info["station_file"])
-                logger.info("window file: %s" % event_info["window_file"])
-                logger.info("output file: %s" % event_info["output_file"])
-                src = self.src_info[period][event]
-                station_info = load_json(event_info["station_file"])
-                window_info = load_json(event_info["window_file"])
-                outputdir = os.path.dirname(event_info["output_file"])
-                safe_mkdir(outputdir)
-                figname_prefix = os.path.join(
-                    outputdir, "%s.%s" % (event, period))
-                _results = determine_receiver_weighting(
-                    src, station_info, window_info,
-                    max_ratio=search_ratio,
-                    flag=receiver_weighting,
-                    plot=plot, figname_prefix=figname_prefix)
-
-                self.rec_weights[period][event] = _results["rec_weights"]
-                self.rec_wcounts[period][event] = _results["rec_wcounts"]
-                self.rec_ref_dists[period][event] = _results["rec_ref_dists"]
-                self.rec_cond_nums[period][event] = _results["rec_cond_nums"]
-                self.src_wcounts[period][event] = _results["src_wcounts"]
+                job = (period, event, event_info, self.src_info[period][event])
+                jobs.append(job)
+                # the cost is dominated by the number of windows
+                costs[(period, event)] = \
+                    os.path.getsize(event_info["window_file"])
+        logger.info("Number of (period, event) pairs: %d" % len(jobs))
+
+        worker_function = partial(
+            _run_receiver_weighting_job, max_ratio=search_ratio,
+            flag=receiver_weighting, plot=plot, engine=engine)
+
+        if self.mpi_mode:
+            keys = sorted(costs)
+            rank_keys = set(lpt_partition(
+                keys, costs, self.comm.Get_size())[self.rank])
+            results = [worker_function(job) for job in jobs
+                       if (job[0], job[1]) in rank_keys]
+            results = self.comm.gather(results, root=0)
+            if self.rank != 0:
+                return
+            results = [_r for _rank_results in results
+                       for _r in _rank_results]
+        elif self.nworkers > 1:
+            # biggest jobs first
+            jobs.sort(key=lambda x: -costs[(x[0], x[1])])
+            with ProcessPoolExecutor(max_workers=self.nworkers) as pool:
+                results = list(pool.map(worker_function, jobs))
+        else:
+            results = [worker_function(job) for job in jobs]
+
+        for period, event, _results in results:
+            self.rec_tables[period][event] = _results["rec_table"]
+            self.rec_ref_dists[period][event] = _results["rec_ref_dists"]
+            self.rec_cond_nums[period][event] = _results["rec_cond_nums"]
+            self.src_wcounts[period][event] = _results["src_wcounts"]
 
     def calculate_source_weights(self):
         input_info = self.path["input"]
@@ -616,14 +857,26 @@ class WindowWeight(object):
 
     def run(self):
 
-        validate_path(self.path)
+        if self.rank == 0:
+            validate_path(self.path)
         validate_param(self.param)
 
         input_info = self.path["input"]
 
-        self.src_info = extract_source_location(input_info)
+        if self.rank == 0:
+            cache_file = self.path.get("source_cache_file")
+            if cache_file is None and "log_dir" in self.path:
+                cache_file = os.path.join(self.path["log_dir"],
+                                          "source_locations.cache.json")
+            self.src_info = extract_source_location(input_info,
+                                                    cache_file=cache_file)
+        if self.mpi_mode:
+            self.src_info = self.comm.bcast(self.src_info, root=0)
 
         self.calculate_receiver_weights()
+        if self.rank != 0:
+            # only the receiver weighting is distributed
+            return
         self.calculate_source_weights()
         self.cat_weights = determine_category_weighting(self.cat_wcounts)
 
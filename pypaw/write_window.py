@@ -14,6 +14,7 @@ import os
 import json
 import obspy
 import numpy as np
+from .utils import JSONStreamWriter
 
 
 def get_json_content(window):
@@ -61,25 +62,51 @@ class WindowEncoder(json.JSONEncoder):
         return json.JSONEncoder.default(self, obj)
 
 
-def write_window_json(results, outputdir):
-
-    output_json = os.path.join(outputdir, "windows.json")
+def window_json_writer(outputdir, compact=False, filename="windows.json"):
+    """
+    JSONStreamWriter of outputdir/windows.json, see write_window_json.
+    It is not opened yet.
+    """
+    output_json = os.path.join(outputdir, filename)
     print("Output window file: %s" % output_json)
-    window_all = {}
-    for station, sta_win in results.iteritems():
+    indent = None if compact else 2
+    return JSONStreamWriter(output_json, indent=indent, separators=(',', ':'),
+                            cls=WindowEncoder)
+
+
+def write_station_windows(writer, results):
+    """
+    Write windows of the stations in results into the opened window
+    json writer, station by station.
+
+    :param results: windows, keyed by station and then trace id. The
+        windows could be pyflex.Window or dict(already converted)
+    """
+    for station in sorted(results):
+        sta_win = results[station]
         if sta_win is None:
             continue
-        window_all[station] = {}
         _window_comp = {}
         for trace_id, trace_win in sta_win.iteritems():
-            _window = [get_json_content(_i) for _i in trace_win]
+            _window = [_i if isinstance(_i, dict)
+                       else get_json_content(_i) for _i in trace_win]
             _window_comp[trace_id] = _window
-        window_all[station] = _window_comp
+        writer.write_item(station, _window_comp)
+
+
+def write_window_json(results, outputdir, compact=False,
+                      filename="windows.json"):
+    """
+    Write windows into outputdir/windows.json. Windows are converted
+    and written out station by station, so the whole json content is
+    never held in memory.
 
-    with open(output_json, 'w') as fh:
-        j = json.dumps(window_all, cls=WindowEncoder, sort_keys=True,
-                       indent=2, separators=(',', ':'))
-        try:
-            fh.write(j)
-        except TypeError:
-            fh.write(j.encode())
+    :param results: windows, keyed by station and then trace id. The
+        windows could be pyflex.Window or dict(already converted)
+    :param outputdir: output directory
+    :param compact: write compact json without indentation
+    :param filename: output filename
+    """
+    with window_json_writer(outputdir, compact=compact,
+                            filename=filename) as writer:
+        write_station_windows(writer, results)
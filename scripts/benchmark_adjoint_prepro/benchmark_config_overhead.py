@@ -0,0 +1,147 @@
+#!/usr/bin/env python
+"""
+Micro-benchmark of the per-station config overhead in
+adjoint_prepro.func_wrapper.
+
+Before: every station deep-copies the param and rebuilds the
+pyflex.Config and pyadjoint.Config objects.
+After: the configs are built once per event in AdjPreASDF._core and
+shared read-only.
+
+func_wrapper itself is timed on one station of the test data, with
+signal processing, window selection and adjoint source stages stubbed
+out, so what is left is the per-station work of func_wrapper.
+
+Usage(from this directory):
+    python benchmark_config_overhead.py -n 5000
+"""
+from __future__ import print_function, division
+import os
+import copy
+import json
+import time
+import argparse
+import yaml
+from obspy import read, read_events, read_inventory
+
+from pypaw import adjoint_prepro
+from pypaw.adjoint_prepro import load_window_config, load_adjoint_config, \
+    func_wrapper
+
+ROOT_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)),
+                        "..", "..")
+EXAMPLE_DIR = os.path.join(ROOT_DIR, "examples", "preproc_wf")
+DATA_DIR = os.path.join(ROOT_DIR, "tests", "data", "sac")
+EVENT = "C200912240023A"
+
+
+def read_yaml(filename):
+    with open(os.path.join(EXAMPLE_DIR, filename)) as fh:
+        return yaml.load(fh)
+
+
+def load_param(param_file, event):
+    with open(param_file) as fh:
+        param_files = json.load(fh)
+
+    param = {}
+    for key in ["proc_obsd_param", "proc_synt_param", "adjsrc_param"]:
+        param[key] = read_yaml(param_files[key])
+    param["window_param"] = {}
+    for comp, filename in param_files["window_param"].iteritems():
+        param["window_param"][comp] = read_yaml(filename)
+
+    # same as AdjPreASDF._refine_param
+    origin = event.preferred_origin() or event.origins[0]
+    for key in ["proc_obsd_param", "proc_synt_param"]:
+        _p = param[key]
+        _p["starttime"] = origin.time + _p["relative_starttime"]
+        _p["endtime"] = origin.time + _p["relative_endtime"]
+        _p["event_latitude"] = origin.latitude
+        _p["event_longitude"] = origin.longitude
+    return param
+
+
+class StationGroup(object):
+    """ Stand-in of the pyasdf station group """
+    def __init__(self, station, staxml, tag, stream):
+        self._station_name = station
+        self.StationXML = staxml
+        setattr(self, tag, stream)
+
+
+def load_station_groups():
+    staxml = read_inventory(
+        os.path.join(DATA_DIR, "stationxml", EVENT, "II.AAK.xml"))
+    obsd = read(os.path.join(DATA_DIR, "obsd", EVENT, "II.AAK.mseed"))
+    synt = read(os.path.join(DATA_DIR, "synt", EVENT, "AAK.II.MX*.sem.sac"))
+    return (StationGroup("II.AAK", staxml, "obsd", obsd),
+            StationGroup("II.AAK", staxml, "synt", synt))
+
+
+def stub_stages():
+    """
+    Replace the signal processing, window selection and adjoint source
+    stages used by func_wrapper with functions doing nothing
+    """
+    def _first_argument(arg, *args, **kwargs):
+        return arg
+
+    def _windows(*args, **kwargs):
+        return {"II.AAK..MXZ": []}
+
+    def _empty(*args, **kwargs):
+        return []
+
+    adjoint_prepro.process_stream = _first_argument
+    adjoint_prepro.window_on_stream = _windows
+    adjoint_prepro.smart_transform_window = _first_argument
+    adjoint_prepro.calculate_adjsrc_on_stream = _empty
+    adjoint_prepro.calculate_chan_weight = _empty
+    adjoint_prepro.process_adjoint = _empty
+    adjoint_prepro.reshape_adj = _empty
+
+
+def benchmark(param, event, nstations):
+    obsd_group, synt_group = load_station_groups()
+    stub_stages()
+
+    # the param is deep-copied and the configs are built from it
+    # inside func_wrapper, for every station
+    t0 = time.time()
+    for _ in range(nstations):
+        func_wrapper(obsd_group, synt_group, obsd_tag="obsd",
+                     synt_tag="synt", event=event,
+                     param=copy.deepcopy(param))
+    t_before = time.time() - t0
+
+    t0 = time.time()
+    window_config = load_window_config(param["window_param"])
+    adj_config, adj_src_type = load_adjoint_config(param["adjsrc_param"])
+    for _ in range(nstations):
+        func_wrapper(obsd_group, synt_group, obsd_tag="obsd",
+                     synt_tag="synt", event=event, param=param,
+                     window_config=window_config, adj_config=adj_config,
+                     adj_src_type=adj_src_type)
+    t_after = time.time() - t0
+
+    print("Number of stations: %d" % nstations)
+    print("Before: %8.3f s total, %8.1f us per station"
+          % (t_before, t_before / nstations * 1e6))
+    print("After:  %8.3f s total, %8.1f us per station"
+          % (t_after, t_after / nstations * 1e6))
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument('-p', action='store', dest='param_file',
+                        default=os.path.join(EXAMPLE_DIR,
+                                             "adjproc.param.json"),
+                        help="AdjPreASDF param file")
+    parser.add_argument('-n', action='store', dest='nstations', type=int,
+                        default=5000, help="number of stations")
+    args = parser.parse_args()
+
+    event = read_events(
+        os.path.join(DATA_DIR, "quakeml", EVENT + ".xml"))[0]
+    benchmark(load_param(args.param_file, event), event, args.nstations)
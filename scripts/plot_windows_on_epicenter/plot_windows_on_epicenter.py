@@ -19,6 +19,7 @@ from obspy.geodetics import locations2degrees
 from obspy.taup import TauPyModel
 import pyasdf
 from pypaw.stations import extract_waveform_stations
+from pypaw.window_store import load_windows
 
 
 def load_json(filename):
@@ -196,7 +197,7 @@ def plot_windows_on_epicenter(path):
     if not os.path.exists(outputdir):
         os.makedirs(outputdir)
 
-    windows = load_json(winfile)
+    windows = load_windows(winfile)
     print("Extract event and stations location information")
     dist_info, event_depth = extract_distance_info(asdffile, windows)
 
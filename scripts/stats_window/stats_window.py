@@ -7,6 +7,7 @@ import matplotlib
 matplotlib.use("Agg")
 import matplotlib.pyplot as plt
 import matplotlib.gridspec as gridspec
+from pypaw.window_store import load_windows
 
 
 def read_txt_into_list(txtfile):
@@ -19,8 +20,7 @@ def read_txt_into_list(txtfile):
 def extract_window_info(window_file):
     event_info = {}
 
-    with open(window_file) as fh:
-        windows = json.load(fh)
+    windows = load_windows(window_file)
 
     for sta, sta_info in windows.iteritems():
         for chan, chan_info in sta_info.iteritems():
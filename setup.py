@@ -29,7 +29,8 @@ consoles = [
     'pypaw-convert_adjsrcs_from_asdf=pypaw.bins.convert_adjsrcs_from_asdf:main',   # NOQA
     'pypaw-convert_to_asdf=pypaw.bins.convert_to_asdf:main',
     'pypaw-convert_to_sac=pypaw.bins.convert_to_sac:main',
-    'pypaw-generate_stations_asdf=pypaw.bins.generate_stations_asdf:main'
+    'pypaw-generate_stations_asdf=pypaw.bins.generate_stations_asdf:main',
+    'pypaw-convert_window_file=pypaw.bins.convert_window_file:main'
 ]
 
 
@@ -65,12 +66,13 @@ setup(
     ],
     install_requires=[
         "numpy", "obspy>=1.0.0", "flake8", "pytest", "nose", "future>=0.14.1",
-        "pytomo3d", "pyasdf"
+        "pytomo3d", "pyasdf", "h5py", "futures; python_version < '3'"
     ],
     entry_points={
         'console_scripts': consoles
     },
     extras_require={
-        "docs": ["sphinx", "ipython", "runipy"]
+        "docs": ["sphinx", "ipython", "runipy"],
+        "kdtree": ["scipy"]
     }
 )
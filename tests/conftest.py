@@ -0,0 +1,94 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+"""
+Shared fixtures: generators of random windows and stations
+
+:copyright:
+    Wenjie Lei (lei@princeton.edu), 2016
+:license:
+    GNU Lesser General Public License, version 3 (LGPLv3)
+    (http://www.gnu.org/licenses/lgpl-3.0.en.html)
+"""
+from __future__ import print_function, division, absolute_import
+import numpy as np
+import pytest
+
+
+def _make_window(rng, channel_id, channel_id_2=None):
+    """ one window, in the format of windows.json """
+    win = {"left_index": int(rng.randint(0, 1000)),
+           "right_index": int(rng.randint(1000, 2000)),
+           "center_index": int(rng.randint(500, 1500)),
+           "cc_shift_in_samples": int(rng.randint(-20, 20)),
+           "max_cc_value": float(rng.rand()),
+           "cc_shift_in_seconds": float(rng.randn()),
+           "dlnA": float(rng.randn()),
+           "dt": 0.1425,
+           "min_period": 27.0,
+           "relative_starttime": float(rng.rand() * 100),
+           "relative_endtime": float(rng.rand() * 100 + 100),
+           "window_weight": float(rng.rand() * 3),
+           "time_of_first_sample": "2009-12-24T00:23:31.149000Z",
+           "absolute_starttime": "2009-12-24T00:30:00.000000Z",
+           "absolute_endtime": "2009-12-24T00:40:00.123456Z",
+           "channel_id": channel_id}
+    if channel_id_2 is not None:
+        win["channel_id_2"] = channel_id_2
+    return win
+
+
+@pytest.fixture
+def sample_windows():
+    """
+    Generator of windows of a few stations, keyed by station and
+    channel id. Channels have 0 to 3 windows, and one station has no
+    window at all.
+    """
+    def _generate(seed=0):
+        rng = np.random.RandomState(seed)
+        windows = {}
+        for sta in ["II.AAK", "II.ABKT", "IU.ADK"]:
+            windows[sta] = {}
+            for comp in "ZRT":
+                trace_id = "%s.00.BH%s" % (sta, comp)
+                windows[sta][trace_id] = [
+                    _make_window(rng, trace_id, channel_id_2=trace_id)
+                    for _ in range(rng.randint(0, 4))]
+        windows["IU.AFI"] = {"IU.AFI.00.BHZ": []}
+        return windows
+    return _generate
+
+
+@pytest.fixture
+def random_stations():
+    """
+    Generator of station coordinates of a dense regional array. The
+    first four stations are co-located.
+
+    :return: latitudes and longitudes in degrees
+    """
+    def _generate(npts, seed=0):
+        rng = np.random.RandomState(seed)
+        lats = rng.uniform(25, 50, npts)
+        lons = rng.uniform(-125, -65, npts)
+        if npts > 3:
+            lats[:3] = lats[3]
+            lons[:3] = lons[3]
+        return lats, lons
+    return _generate
+
+
+@pytest.fixture
+def station_locations(random_stations):
+    """
+    Generator of (latitude, longitude) keyed by channel id, of the Z, R
+    and T channels of random_stations, which share the location.
+    """
+    def _generate(npts, seed=0):
+        lats, lons = random_stations(npts, seed=seed)
+        locations = {}
+        for idx, loc in enumerate(zip(lats.tolist(), lons.tolist())):
+            for comp in "ZRT":
+                locations["XX.S%03d..BH%s" % (idx, comp)] = loc
+        return locations
+    return _generate
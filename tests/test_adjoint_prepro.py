@@ -0,0 +1,105 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+"""
+Tests of the checkpoint outputs of the fused preprocessing pipeline
+
+:copyright:
+    Wenjie Lei (lei@princeton.edu), 2016
+:license:
+    GNU Lesser General Public License, version 3 (LGPLv3)
+    (http://www.gnu.org/licenses/lgpl-3.0.en.html)
+"""
+from __future__ import print_function, division, absolute_import
+import json
+import os
+import numpy as np
+import pytest
+
+pytest.importorskip("pyasdf")
+pytest.importorskip("pytomo3d")
+pytest.importorskip("pyadjoint")
+
+from obspy import read, read_events, read_inventory  # NOQA
+from pyasdf import ASDFDataSet  # NOQA
+from pypaw.adjoint_prepro import CheckpointWriter  # NOQA
+
+DATA_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)),
+                        "data", "sac")
+EVENT = "C200912240023A"
+QUAKEML = os.path.join(DATA_DIR, "quakeml", EVENT + ".xml")
+SYNT_DIR = os.path.join(DATA_DIR, "synt", EVENT)
+STAXML_DIR = os.path.join(DATA_DIR, "stationxml", EVENT)
+
+
+def _station_results(station, seed):
+    """ results of one station, as returned by func_wrapper """
+    network, code = station.split(".")
+    chan = "%s..MXZ" % station
+    adjsrc = {"type": "AuxiliaryData",
+              "path": "AdjointSources/%s_%s_MXZ" % (network, code),
+              "object": np.arange(10, dtype=np.float32) * seed,
+              "parameters": {"station_id": station, "component": "MXZ"}}
+    return {
+        "adjsrcs": [adjsrc],
+        "proc_synt": {
+            "inventory": read_inventory(
+                os.path.join(STAXML_DIR, "%s.xml" % station)),
+            "stream": read(os.path.join(
+                SYNT_DIR, "%s.%s.MX*.sem.sac" % (code, network)))},
+        "windows": {chan: [{"left_index": seed, "right_index": 2 * seed}]},
+        "measurements": {chan: {"dt": 0.5 * seed}}}
+
+
+def test_checkpoint_writer(tmpdir):
+    path = {"output_asdf": str(tmpdir.join("adjsrc.h5")),
+            "proc_synt_asdf": str(tmpdir.join("proc_synt.h5")),
+            "proc_synt_tag": "proc_synt",
+            "window_dir": str(tmpdir),
+            "measure_file": str(tmpdir.join("measure.json"))}
+    results = [{"II.AAK": _station_results("II.AAK", 1),
+                "II.ABKT": None},
+               {"IU.ADK": _station_results("IU.ADK", 2)}]
+
+    writer = CheckpointWriter(path, read_events(QUAKEML))
+    writer.open()
+    # results of each rank(or chunk) are appended as they arrive
+    for _results in results:
+        writer.write_results(_results)
+    writer.close()
+
+    stations = ["II.AAK", "IU.ADK"]
+    ds = ASDFDataSet(path["output_asdf"], mode="r", mpi=False)
+    adjsrcs = ds.auxiliary_data.AdjointSources
+    assert adjsrcs.list() == ["II_AAK_MXZ", "IU_ADK_MXZ"]
+    np.testing.assert_array_equal(adjsrcs.IU_ADK_MXZ.data[()],
+                                  np.arange(10) * 2)
+    del ds
+
+    ds = ASDFDataSet(path["proc_synt_asdf"], mode="r", mpi=False)
+    assert len(ds.events) == 1
+    assert ds.waveforms.list() == stations
+    for sta in stations:
+        group = getattr(ds.waveforms, sta.replace(".", "_"))
+        assert "StationXML" in dir(group)
+        assert len(group.proc_synt) == 3
+    del ds
+
+    with open(os.path.join(path["window_dir"], "windows.json")) as fh:
+        windows = json.load(fh)
+    assert windows == dict((sta, value["windows"])
+                           for _results in results
+                           for sta, value in _results.iteritems()
+                           if value is not None)
+
+    with open(path["measure_file"]) as fh:
+        measurements = json.load(fh)
+    assert measurements == {"II.AAK": {"II.AAK..MXZ": {"dt": 0.5}},
+                            "IU.ADK": {"IU.ADK..MXZ": {"dt": 1.0}}}
+
+
+def test_checkpoint_writer_not_opened(tmpdir):
+    path = {"output_asdf": str(tmpdir.join("adjsrc.h5")),
+            "measure_file": str(tmpdir.join("measure.json"))}
+    # ranks other than 0 never open the writer
+    CheckpointWriter(path, read_events(QUAKEML)).close()
+    assert tmpdir.listdir() == []
@@ -0,0 +1,156 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+"""
+Tests of converting sac and StationXML files into asdf
+
+:copyright:
+    Wenjie Lei (lei@princeton.edu), 2016
+:license:
+    GNU Lesser General Public License, version 3 (LGPLv3)
+    (http://www.gnu.org/licenses/lgpl-3.0.en.html)
+"""
+from __future__ import print_function, division, absolute_import
+import os
+import shutil
+import numpy as np
+import pytest
+
+pytest.importorskip("pyasdf")
+
+from obspy import read, read_inventory  # NOQA
+from pyasdf import ASDFDataSet  # NOQA
+from pypaw.convert import convert_to_asdf, convert_adjsrcs_from_asdf, \
+    write_adjsrc_ascii, _imap_files  # NOQA
+
+DATA_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)),
+                        "data", "sac")
+EVENT = "C200912240023A"
+QUAKEML = os.path.join(DATA_DIR, "quakeml", EVENT + ".xml")
+SYNT_DIR = os.path.join(DATA_DIR, "synt", EVENT)
+STAXML_DIR = os.path.join(DATA_DIR, "stationxml", EVENT)
+
+
+def _copy_files(filenames, srcdir, destdir):
+    files = []
+    for filename in filenames:
+        dest = os.path.join(destdir, filename)
+        shutil.copy(os.path.join(srcdir, filename), dest)
+        files.append(dest)
+    return files
+
+
+def _touch_later(filename):
+    # make sure the changed file doesn't share mtime with the old one
+    stat = os.stat(filename)
+    os.utime(filename, (stat.st_atime, stat.st_mtime + 10))
+
+
+def test_convert_create_simple_inv(tmpdir):
+    files = [os.path.join(SYNT_DIR, "AAK.II.MX%s.sem.sac" % _c)
+             for _c in "ENZ"]
+    asdf_fn = str(tmpdir.join("synt.h5"))
+    convert_to_asdf(asdf_fn, files, "synthetic", quakemlfile=QUAKEML,
+                    create_simple_inv=True)
+
+    ds = ASDFDataSet(asdf_fn, mode="r", mpi=False)
+    assert ds.waveforms.list() == ["II.AAK"]
+    inv = ds.waveforms.II_AAK.StationXML
+    sac = read(files[0])[0].stats.sac
+    sta = inv[0][0]
+    assert sta.code == "AAK"
+    assert np.isclose(sta.latitude, sac["stla"])
+    assert np.isclose(sta.longitude, sac["stlo"])
+    assert len(ds.waveforms.II_AAK.synthetic) == 3
+    del ds
+
+
+def test_convert_incremental_replaces_changed_waveform(tmpdir):
+    filename = _copy_files(["AAK.II.MXZ.sem.sac"], SYNT_DIR,
+                           str(tmpdir))[0]
+    asdf_fn = str(tmpdir.join("synt.h5"))
+    convert_to_asdf(asdf_fn, [filename], "synthetic", quakemlfile=QUAKEML,
+                    create_simple_inv=True)
+
+    st = read(filename)
+    st[0].data *= 2.0
+    st.write(filename, format="SAC")
+    _touch_later(filename)
+    convert_to_asdf(asdf_fn, [filename], "synthetic", quakemlfile=QUAKEML,
+                    create_simple_inv=True, incremental=True)
+
+    ds = ASDFDataSet(asdf_fn, mode="r", mpi=False)
+    new_st = ds.waveforms.II_AAK.synthetic
+    assert len(new_st) == 1
+    np.testing.assert_allclose(new_st[0].data, st[0].data)
+    del ds
+
+
+def test_convert_incremental_replaces_changed_stationxml(tmpdir):
+    filename = _copy_files(["AAK.II.MXZ.sem.sac"], SYNT_DIR,
+                           str(tmpdir))[0]
+    staxml = _copy_files(["II.AAK.xml"], STAXML_DIR, str(tmpdir))[0]
+    asdf_fn = str(tmpdir.join("synt.h5"))
+    convert_to_asdf(asdf_fn, [filename], "synthetic", quakemlfile=QUAKEML,
+                    staxml_filelist=[staxml])
+
+    inv = read_inventory(staxml)
+    for sta in inv[0]:
+        sta.latitude = 10.0
+    inv.write(staxml, format="STATIONXML")
+    _touch_later(staxml)
+    convert_to_asdf(asdf_fn, [filename], "synthetic", quakemlfile=QUAKEML,
+                    staxml_filelist=[staxml], incremental=True)
+
+    ds = ASDFDataSet(asdf_fn, mode="r", mpi=False)
+    new_inv = ds.waveforms.II_AAK.StationXML
+    lats = [sta.latitude for nw in new_inv for sta in nw]
+    assert lats == [10.0] * len(inv[0])
+    del ds
+
+
+def test_imap_files_keeps_order():
+    filelist = ["/data/%03d.sac" % _i for _i in range(50)]
+    expected = [(_f, os.path.basename(_f)) for _f in filelist]
+    assert list(_imap_files(os.path.basename, filelist)) == expected
+    for chunksize, max_pending in [(1, 1), (3, 2), (16, None), (100, 4)]:
+        assert list(_imap_files(os.path.basename, filelist, nworkers=2,
+                                chunksize=chunksize,
+                                max_pending=max_pending)) == expected
+
+
+def test_write_adjsrc_ascii_matches_savetxt(tmpdir):
+    data = np.random.RandomState(0).randn(100).astype(np.float32)
+    filename = str(tmpdir.join("adj.adj"))
+    write_adjsrc_ascii(filename, data, -10.0, 0.1)
+
+    expected = str(tmpdir.join("savetxt.adj"))
+    np.savetxt(expected, np.column_stack(
+        [-10.0 + 0.1 * np.arange(100), data]))
+    with open(filename) as fh, open(expected) as fh_expected:
+        assert fh.read() == fh_expected.read()
+
+
+def test_convert_adjsrcs_from_asdf(tmpdir):
+    asdf_fn = str(tmpdir.join("adjsrc.h5"))
+    ds = ASDFDataSet(asdf_fn, mode="a", mpi=False)
+    rng = np.random.RandomState(0)
+    for _i in range(10):
+        ds.add_auxiliary_data(
+            rng.randn(50).astype(np.float32), data_type="AdjointSources",
+            path="II_S%02d_MXZ" % _i,
+            parameters={"time_offset": -5.0, "dt": 0.5})
+    del ds
+
+    contents = []
+    for nworkers in [1, 3]:
+        outputdir = str(tmpdir.join("adj_%d" % nworkers))
+        convert_adjsrcs_from_asdf(asdf_fn, outputdir, _verbose=False,
+                                  nworkers=nworkers)
+        files = sorted(os.listdir(outputdir))
+        assert files == ["II.S%02d.MXZ.adj" % _i for _i in range(10)]
+        content = []
+        for filename in files:
+            with open(os.path.join(outputdir, filename)) as fh:
+                content.append(fh.read())
+        contents.append(content)
+    assert contents[0] == contents[1]
@@ -0,0 +1,165 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+"""
+Tests of the station partition of the executors
+
+:copyright:
+    Wenjie Lei (lei@princeton.edu), 2016
+:license:
+    GNU Lesser General Public License, version 3 (LGPLv3)
+    (http://www.gnu.org/licenses/lgpl-3.0.en.html)
+"""
+from __future__ import print_function, division, absolute_import
+import random
+import pytest
+
+pytest.importorskip("pyasdf")
+
+import pypaw.utils  # NOQA
+from pypaw.executor import split_stations, lpt_partition, \
+    MPIExecutor, PoolExecutor  # NOQA
+
+STATIONS = ["XX.S%03d" % _i for _i in range(103)]
+
+
+def _assert_partition(parts, stations):
+    """ every station lands in exactly one part """
+    flat = [sta for part in parts for sta in part]
+    assert sorted(flat) == sorted(stations)
+
+
+def _skewed_costs(stations):
+    # a few very expensive stations and a long tail of cheap ones
+    rng = random.Random(0)
+    costs = dict((sta, rng.randint(1, 10)) for sta in stations)
+    for sta in stations[::8][:5]:
+        costs[sta] = 200
+    return costs
+
+
+def test_split_stations():
+    for nchunks in [1, 2, 7, 103]:
+        chunks = split_stations(STATIONS, nchunks)
+        _assert_partition(chunks, STATIONS)
+        assert len(chunks) == nchunks
+        sizes = [len(_c) for _c in chunks]
+        assert max(sizes) - min(sizes) <= 1
+
+
+def test_split_stations_more_chunks_than_stations():
+    chunks = split_stations(STATIONS[:3], 10)
+    # empty chunks are dropped
+    assert chunks == [[_s] for _s in STATIONS[:3]]
+    assert split_stations([], 4) == []
+
+
+def test_pool_executor_split():
+    executor = PoolExecutor(nworkers=3, chunks_per_worker=2)
+    stations = list(reversed(STATIONS))
+    chunks = executor._split(stations)
+    _assert_partition(chunks, stations)
+    assert len(chunks) == 6
+    assert executor._split(stations) == executor._split(STATIONS)
+    assert len(executor._split(STATIONS[:4])) == 4
+
+
+def test_lpt_partition():
+    costs = _skewed_costs(STATIONS)
+    nparts = 8
+    parts = lpt_partition(STATIONS, costs, nparts)
+    _assert_partition(parts, STATIONS)
+    assert len(parts) == nparts
+
+    loads = [sum(costs[_s] for _s in part) for part in parts]
+    # the 5 expensive stations go to different parts, and the cheap
+    # ones fill up the rest up to the cost of one station
+    assert sorted(loads)[-5:] == [200] * 5
+    assert max(loads[_i] for _i in range(nparts) if loads[_i] != 200) - \
+        min(loads) <= 10
+
+    # uniform split puts all the expensive stations into one part
+    uniform = [STATIONS[_i::nparts] for _i in range(nparts)]
+    assert max(sum(costs[_s] for _s in part) for part in uniform) > 1000
+
+
+def test_lpt_partition_more_parts_than_stations():
+    costs = _skewed_costs(STATIONS[:3])
+    parts = lpt_partition(STATIONS[:3], costs, 5)
+    assert len(parts) == 5
+    _assert_partition(parts, STATIONS[:3])
+    assert sorted(len(_p) for _p in parts) == [0, 0, 1, 1, 1]
+
+
+def test_lpt_partition_independent_of_order():
+    costs = _skewed_costs(STATIONS)
+    # ties in costs are broken by station name
+    shuffled = list(STATIONS)
+    random.Random(1).shuffle(shuffled)
+    assert lpt_partition(shuffled, costs, 6) == \
+        lpt_partition(STATIONS, costs, 6)
+
+
+def test_pool_executor_split_with_costs():
+    executor = PoolExecutor(nworkers=2, chunks_per_worker=2)
+    costs = _skewed_costs(STATIONS)
+    chunks = executor._split(STATIONS, costs=costs)
+    _assert_partition(chunks, STATIONS)
+    assert len(chunks) == 4
+    loads = [sum(costs[_s] for _s in chunk) for chunk in chunks]
+    # most expensive chunks first
+    assert loads == sorted(loads, reverse=True)
+
+    chunks = executor._split(STATIONS[:2], costs=costs)
+    assert sorted(chunks) == [[STATIONS[0]], [STATIONS[1]]]
+
+
+class FakeComm(object):
+    """ rank and size of an mpi communicator """
+    def __init__(self, rank, size):
+        self.rank = rank
+        self.size = size
+
+    def Get_rank(self):
+        return self.rank
+
+    def Get_size(self):
+        return self.size
+
+
+def _local_stations_of_ranks(monkeypatch, size, stations, costs):
+    local_stations = []
+    for rank in range(size):
+        comm = FakeComm(rank, size)
+        monkeypatch.setattr(pypaw.utils, "_get_mpi_comm", lambda: comm)
+        local_stations.append(
+            MPIExecutor().local_stations(stations, costs=costs))
+    return local_stations
+
+
+def test_mpi_local_stations(monkeypatch):
+    costs = _skewed_costs(STATIONS)
+    for _costs in [None, costs]:
+        for size in [1, 4, 200]:
+            local_stations = _local_stations_of_ranks(
+                monkeypatch, size, STATIONS, _costs)
+            assert len(local_stations) == size
+            _assert_partition(local_stations, STATIONS)
+
+    # each rank computes the same lpt partition by itself
+    assert _local_stations_of_ranks(monkeypatch, 4, STATIONS, costs) == \
+        lpt_partition(STATIONS, costs, 4)
+
+
+def test_mpi_partition_stations(monkeypatch):
+    costs = _skewed_costs(STATIONS)
+    for _costs in [None, costs]:
+        partitions = []
+        for rank in range(4):
+            comm = FakeComm(rank, 4)
+            monkeypatch.setattr(pypaw.utils, "_get_mpi_comm", lambda: comm)
+            partitions.append(
+                MPIExecutor().partition_stations(STATIONS, costs=_costs))
+        # every rank sees the whole partition, the same one
+        assert all(_p == partitions[0] for _p in partitions)
+        assert partitions[0] == _local_stations_of_ranks(
+            monkeypatch, 4, STATIONS, _costs)
@@ -0,0 +1,73 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+"""
+Tests of the neighbor based receiver weighting
+
+:copyright:
+    Wenjie Lei (lei@princeton.edu), 2016
+:license:
+    GNU Lesser General Public License, version 3 (LGPLv3)
+    (http://www.gnu.org/licenses/lgpl-3.0.en.html)
+"""
+from __future__ import print_function, division, absolute_import
+import numpy as np
+import pytest
+
+pytest.importorskip("scipy")
+
+from pypaw.neighbor_weight import NeighborDistWeight, unit_vectors  # NOQA
+
+
+def _all_pairs_weights(lats, lons, ref_distance):
+    """ weights with the kernel summed over all pairs """
+    xyz = unit_vectors(lats, lons)
+    dists = np.rad2deg(np.arccos(np.clip(np.dot(xyz, xyz.T), -1, 1)))
+    np.fill_diagonal(dists, 0.0)
+    weights = 1.0 / np.exp(-(dists / ref_distance) ** 2).sum(axis=1)
+    return weights / weights.mean()
+
+
+def test_weights_match_all_pairs(random_stations):
+    lats, lons = random_stations(500)
+    weightobj = NeighborDistWeight(lats, lons)
+    for ref_distance in [0.5, 2.0, 5.0, 10.0]:
+        np.testing.assert_allclose(
+            weightobj.weights_at(ref_distance),
+            _all_pairs_weights(lats, lons, ref_distance), rtol=1e-5)
+
+
+def test_weights_match_all_pairs_without_truncation(random_stations):
+    lats, lons = random_stations(200, seed=1)
+    # radius covers the whole sphere
+    weightobj = NeighborDistWeight(lats, lons, truncate=200.0)
+    np.testing.assert_allclose(weightobj.weights_at(1.0),
+                               _all_pairs_weights(lats, lons, 1.0),
+                               rtol=1e-10)
+
+
+def test_smart_scan(random_stations):
+    lats, lons = random_stations(300, seed=2)
+    weightobj = NeighborDistWeight(lats, lons)
+    ref_distance, cond_num = weightobj.smart_scan(
+        max_ratio=0.35, start=0.5, gap=0.5, drop_ratio=0.95)
+
+    assert 0.5 <= ref_distance <= 180.0
+    assert cond_num >= 1.0
+    weights = weightobj.weights
+    assert len(weights) == 300
+    assert np.all(weights > 0)
+    np.testing.assert_allclose(weights.mean(), 1.0)
+    np.testing.assert_allclose(weights.max() / weights.min(), cond_num)
+    np.testing.assert_allclose(weights, weightobj.weights_at(ref_distance))
+
+
+def test_smart_scan_single_station():
+    weightobj = NeighborDistWeight([10.0], [20.0])
+    ref_distance, cond_num = weightobj.smart_scan()
+    assert cond_num == 1.0
+    np.testing.assert_allclose(weightobj.weights, [1.0])
+
+
+def test_invalid_truncate():
+    with pytest.raises(ValueError):
+        NeighborDistWeight([0.0], [0.0], truncate=0.0)
@@ -0,0 +1,40 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+"""
+Tests of summing adjoint sources
+
+:copyright:
+    Wenjie Lei (lei@princeton.edu), 2016
+:license:
+    GNU Lesser General Public License, version 3 (LGPLv3)
+    (http://www.gnu.org/licenses/lgpl-3.0.en.html)
+"""
+from __future__ import print_function, division, absolute_import
+import numpy as np
+from obspy.signal.rotate import rotate_rt_ne
+
+from pypaw.sum_adjoint import rotate_rt_to_ne
+
+
+def test_rotate_rt_to_ne():
+    rng = np.random.RandomState(0)
+    nsta = 20
+    npts = 100
+    data = rng.randn(nsta, 3, npts)
+    backazimuths = rng.uniform(0, 360, nsta)
+    backazimuths[:4] = [0.0, 90.0, 180.0, 270.0]
+
+    rotated = rotate_rt_to_ne(data, backazimuths)
+
+    assert rotated.shape == data.shape
+    for idx in range(nsta):
+        n, e = rotate_rt_ne(data[idx, 1], data[idx, 2], backazimuths[idx])
+        np.testing.assert_array_equal(rotated[idx, 0], data[idx, 0])
+        np.testing.assert_allclose(rotated[idx, 1], n, atol=1e-12)
+        np.testing.assert_allclose(rotated[idx, 2], e, atol=1e-12)
+
+
+def test_rotate_rt_to_ne_keeps_input():
+    data = np.ones([2, 3, 10])
+    rotate_rt_to_ne(data, np.array([30.0, 60.0]))
+    np.testing.assert_array_equal(data, np.ones([2, 3, 10]))
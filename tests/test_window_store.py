@@ -0,0 +1,107 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+"""
+Tests of the binary window store
+
+:copyright:
+    Wenjie Lei (lei@princeton.edu), 2016
+:license:
+    GNU Lesser General Public License, version 3 (LGPLv3)
+    (http://www.gnu.org/licenses/lgpl-3.0.en.html)
+"""
+from __future__ import print_function, division, absolute_import
+import numpy as np
+import pytest
+from obspy import UTCDateTime
+
+from pypaw.stations import count_station_windows
+from pypaw.window_store import windows_to_table, table_to_windows, \
+    write_window_table, load_windows, station_windows_to_array, \
+    array_to_station_windows, write_windows_to_asdf, \
+    read_window_counts_from_asdf, read_windows_from_asdf
+
+
+def test_windows_table_round_trip(sample_windows):
+    windows = sample_windows()
+    assert table_to_windows(windows_to_table(windows)) == windows
+
+
+def test_windows_table_round_trip_without_channel_id_2(sample_windows):
+    windows = sample_windows(seed=1)
+    for sta_win in windows.itervalues():
+        for chan_win in sta_win.itervalues():
+            for win in chan_win:
+                del win["channel_id_2"]
+    assert table_to_windows(windows_to_table(windows)) == windows
+
+
+def test_window_table_file_round_trip(tmpdir, sample_windows):
+    windows = sample_windows()
+    for compress in [False, True]:
+        filename = str(tmpdir.join("windows.%s.npz" % compress))
+        write_window_table(windows, filename, compress=compress)
+        assert load_windows(filename) == windows
+
+
+def test_station_windows_array_round_trip(sample_windows):
+    windows = sample_windows(seed=2)
+    for sta_win in windows.itervalues():
+        data, parameters = station_windows_to_array(sta_win)
+        assert data.shape[0] == parameters["nwins"]
+        assert array_to_station_windows(data, parameters) == sta_win
+
+
+def test_windows_asdf_round_trip(tmpdir, sample_windows):
+    pyasdf = pytest.importorskip("pyasdf")
+    windows = sample_windows(seed=3)
+    # stations without any window are not written
+    windows = dict((sta, sta_win) for sta, sta_win in windows.iteritems()
+                   if count_station_windows(sta_win) > 0)
+
+    filename = str(tmpdir.join("windows.h5"))
+    ds = pyasdf.ASDFDataSet(filename, mode="a", mpi=False)
+    write_windows_to_asdf(windows, ds)
+    del ds
+
+    ds = pyasdf.ASDFDataSet(filename, mode="r", mpi=False)
+    counts = read_window_counts_from_asdf(ds)
+    assert counts == dict((sta, count_station_windows(sta_win))
+                          for sta, sta_win in windows.iteritems())
+    assert read_windows_from_asdf(ds) == windows
+    sta = sorted(windows)[0]
+    assert read_windows_from_asdf(ds, stations=[sta]) == \
+        {sta: windows[sta]}
+    del ds
+
+
+def test_windows_asdf_many_windows(tmpdir, sample_windows):
+    pyasdf = pytest.importorskip("pyasdf")
+    # a station with many more windows than the attributes of an
+    # hdf5 dataset could hold as strings, with times to the microsecond
+    # and channel_id_2 from the synthetic
+    rng = np.random.RandomState(5)
+    template = [win for sta_win in sample_windows().itervalues()
+                for chan_win in sta_win.itervalues() for win in chan_win][0]
+    origin = UTCDateTime("2009-12-24T00:23:31.149000Z")
+    sta_win = {}
+    for comp in "ZRT":
+        trace_id = "II.AAK.00.BH%s" % comp
+        sta_win[trace_id] = []
+        for _ in range(200):
+            win = dict(template)
+            for field in ["absolute_starttime", "absolute_endtime"]:
+                win[field] = str(origin + rng.randint(0, 10 ** 10) * 1e-6)
+            win["channel_id"] = trace_id
+            win["channel_id_2"] = "II.AAK.S3.MX%s" % comp
+            sta_win[trace_id].append(win)
+    windows = {"II.AAK": sta_win}
+
+    filename = str(tmpdir.join("windows.h5"))
+    ds = pyasdf.ASDFDataSet(filename, mode="a", mpi=False)
+    write_windows_to_asdf(windows, ds)
+    del ds
+
+    ds = pyasdf.ASDFDataSet(filename, mode="r", mpi=False)
+    assert read_window_counts_from_asdf(ds) == {"II.AAK": 600}
+    assert read_windows_from_asdf(ds) == windows
+    del ds
@@ -0,0 +1,217 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+"""
+Tests of the window weighting
+
+:copyright:
+    Wenjie Lei (lei@princeton.edu), 2016
+:license:
+    GNU Lesser General Public License, version 3 (LGPLv3)
+    (http://www.gnu.org/licenses/lgpl-3.0.en.html)
+"""
+from __future__ import print_function, division, absolute_import
+import json
+import numpy as np
+import pytest
+
+pytest.importorskip("spaceweight")
+
+from obspy.geodetics import locations2degrees  # NOQA
+from spaceweight import SpherePoint, SphereDistRel  # NOQA
+from pypaw.bins.utils import load_json  # NOQA
+from pypaw.window_weights import WindowWeight, DistanceMatrixCache, \
+    CachedSphereDistRel, determine_category_weighting, \
+    determine_receiver_weighting_on_table, _channel_table, \
+    _receiver_validator, _source_validator  # NOQA
+
+PERIOD = "27_60"
+
+# number of windows of each event and channel. II.AAK..BHT of event A
+# has no window, and event B has no T component at all.
+NWINS = {"A": {"II.AAK..BHZ": 2, "II.AAK..BHR": 1, "II.AAK..BHT": 0,
+               "IU.BBB..BHZ": 1, "IU.BBB..BHR": 3, "IU.BBB..BHT": 2},
+         "B": {"II.AAK..BHZ": 1, "II.AAK..BHR": 2,
+               "IU.BBB..BHZ": 2}}
+
+STATIONS = {"II.AAK": (42.6, 74.5), "IU.BBB": (-10.0, 120.0)}
+
+
+def _write_json(content, filename):
+    with open(filename, "w") as fh:
+        json.dump(content, fh)
+    return filename
+
+
+def _window_weight(tmpdir):
+    stations = {}
+    for sta, (lat, lon) in STATIONS.iteritems():
+        for comp in "ZEN":
+            stations["%s..BH%s" % (sta, comp)] = \
+                {"latitude": lat, "longitude": lon}
+    station_file = _write_json(stations, str(tmpdir.join("stations.json")))
+
+    input_info = {}
+    for event, event_nwins in NWINS.iteritems():
+        windows = {}
+        for chan, nwin in event_nwins.iteritems():
+            sta = ".".join(chan.split(".")[:2])
+            windows.setdefault(sta, {})[chan] = \
+                [{"channel_id": chan}] * nwin
+        input_info[event] = {
+            "station_file": station_file,
+            "window_file": _write_json(
+                windows, str(tmpdir.join("%s.windows.json" % event))),
+            "output_file": str(tmpdir.join("%s.weights.json" % event))}
+
+    path = {"input": {PERIOD: input_info}, "log_dir": str(tmpdir)}
+    param = {"receiver_weighting": False, "source_weighting": False,
+             "plot": False, "receiver_search_ratio": 0.35,
+             "source_search_ratio": 0.35}
+    ww = WindowWeight(_write_json(path, str(tmpdir.join("path.json"))),
+                      _write_json(param, str(tmpdir.join("param.yml"))))
+    ww.src_info = {PERIOD: {"A": {"latitude": 0.0, "longitude": 0.0},
+                            "B": {"latitude": 30.0, "longitude": 60.0}}}
+    return ww
+
+
+def test_window_weight_output(tmpdir):
+    ww = _window_weight(tmpdir)
+
+    ww.calculate_receiver_weights()
+    assert ww.src_wcounts[PERIOD] == {"A": {"BHZ": 3, "BHR": 4, "BHT": 2},
+                                      "B": {"BHZ": 3, "BHR": 2}}
+    table = ww.rec_tables[PERIOD]["A"]
+    channels = table["channels"].tolist()
+    assert channels == ["II.AAK..BHR", "II.AAK..BHZ", "IU.BBB..BHR",
+                        "IU.BBB..BHT", "IU.BBB..BHZ"]
+    np.testing.assert_array_equal(table["nwins"], [1, 2, 3, 2, 1])
+    np.testing.assert_array_equal(table["weights"], np.ones(5))
+    # receiver weights of A, BHZ, which still add up to its 3 windows
+    table["weights"][channels.index("II.AAK..BHZ")] = 0.75
+    table["weights"][channels.index("IU.BBB..BHZ")] = 1.5
+
+    ww.calculate_source_weights()
+    assert ww.cat_wcounts[PERIOD] == {"BHZ": 6, "BHR": 6, "BHT": 2}
+    # source weights of BHZ, which add up to its 6 windows
+    ww.src_weights[PERIOD]["BHZ"] = {"A": 0.5, "B": 1.5}
+
+    ww.cat_weights = determine_category_weighting(ww.cat_wcounts)
+    assert ww.cat_weights == {PERIOD: pytest.approx(
+        {"BHZ": 1 / 18.0, "BHR": 1 / 18.0, "BHT": 1 / 6.0})}
+
+    ww.combine_weights()
+    ww.dump_weights()
+
+    expected = {
+        "A": {"II.AAK..BHZ": (0.75, 0.5, 1 / 18.0),
+              "II.AAK..BHR": (1.0, 1.0, 1 / 18.0),
+              "IU.BBB..BHZ": (1.5, 0.5, 1 / 18.0),
+              "IU.BBB..BHR": (1.0, 1.0, 1 / 18.0),
+              "IU.BBB..BHT": (1.0, 1.0, 1 / 6.0)},
+        "B": {"II.AAK..BHZ": (1.0, 1.5, 1 / 18.0),
+              "II.AAK..BHR": (1.0, 1.0, 1 / 18.0),
+              "IU.BBB..BHZ": (1.0, 1.5, 1 / 18.0)}}
+    for event, event_expected in expected.iteritems():
+        weights = load_json(str(tmpdir.join("%s.weights.json" % event)))
+        assert sorted(weights) == sorted(event_expected)
+        for chan, (rec, src, cat) in event_expected.iteritems():
+            assert weights[chan] == pytest.approx(
+                {"receiver": rec, "source": src, "category": cat,
+                 "weight": rec * src * cat})
+
+
+def test_receiver_validator():
+    components = np.array(["BHZ", "BHZ", "BHR"])
+    nwins = np.array([2, 1, 4])
+    _receiver_validator(components, np.array([0.75, 1.5, 1.0]), nwins)
+    with pytest.raises(ValueError):
+        _receiver_validator(components, np.array([1.0, 1.5, 1.0]), nwins)
+
+
+def test_source_validator():
+    src_wcounts = {"A": {"BHZ": 3, "BHT": 2}, "B": {"BHZ": 3}}
+    weights = {"BHZ": {"A": 0.5, "B": 1.5}, "BHT": {"A": 1.0, "B": 1.0}}
+    _source_validator(weights, src_wcounts, {"BHZ": 6, "BHT": 2})
+    with pytest.raises(ValueError):
+        _source_validator(weights, src_wcounts, {"BHZ": 6, "BHT": 4})
+
+
+def _points(locations, comp):
+    return [SpherePoint(loc[0], loc[1], tag=chan, weight=1.0)
+            for chan, loc in sorted(locations.iteritems())
+            if chan.endswith(comp)]
+
+
+def test_distance_matrix_cache(station_locations):
+    locations = station_locations(50)
+    cache = DistanceMatrixCache(locations)
+    # one row for each unique location, the first four are co-located
+    assert cache.matrix.shape == (47, 47)
+
+    chans = sorted(locations)[::4]
+    dists = cache.submatrix(chans)
+    expected = np.array([[locations2degrees(*(locations[_i] + locations[_j]))
+                          for _j in chans] for _i in chans])
+    np.testing.assert_allclose(dists, expected, atol=1e-6)
+    np.testing.assert_allclose(cache.submatrix(chans, squared=True),
+                               -expected ** 2, atol=1e-4)
+
+
+def test_cached_sphere_dist_rel_matches_uncached(station_locations):
+    locations = station_locations(150, seed=1)
+    cache = DistanceMatrixCache(locations)
+    center = SpherePoint(0.0, 0.0, tag="source")
+
+    for comp in "ZRT":
+        points = _points(locations, comp)
+        cached_points = _points(locations, comp)
+
+        ref_dist, cond_num = SphereDistRel(
+            points, center=center).smart_scan(
+            max_ratio=0.35, start=0.5, gap=0.5, drop_ratio=0.95,
+            plot=False)
+        cached_ref_dist, cached_cond_num = CachedSphereDistRel(
+            cached_points, cache, center=center).smart_scan(
+            max_ratio=0.35, start=0.5, gap=0.5, drop_ratio=0.95,
+            plot=False)
+
+        assert np.isclose(cached_ref_dist, ref_dist)
+        assert np.isclose(cached_cond_num, cond_num)
+        weights = dict((_p.tag, _p.weight) for _p in points)
+        for point in cached_points:
+            assert np.isclose(point.weight, weights[point.tag], rtol=1e-6)
+
+
+def test_receiver_weighting_engines_agree(tmpdir, station_locations):
+    pytest.importorskip("scipy")
+    locations = station_locations(200, seed=4)
+    stations = {}
+    for chan, (lat, lon) in locations.iteritems():
+        for comp in "ZEN":
+            stations[chan[:-1] + comp] = {"latitude": lat, "longitude": lon}
+    rng = np.random.RandomState(4)
+    channels = sorted(locations)
+    table = _channel_table(channels, rng.randint(0, 5, len(channels)))
+    src = {"latitude": 0.0, "longitude": 0.0}
+
+    results = {}
+    for engine in ["exact", "kdtree"]:
+        results[engine] = determine_receiver_weighting_on_table(
+            src, stations, table, max_ratio=0.35,
+            figname_prefix=str(tmpdir.join("%s." % engine)), engine=engine)
+
+    exact = results["exact"]
+    kdtree = results["kdtree"]
+    # same scan, so the same reference distance is taken
+    assert kdtree["rec_ref_dists"] == exact["rec_ref_dists"]
+    assert kdtree["src_wcounts"] == exact["src_wcounts"]
+    np.testing.assert_array_equal(kdtree["rec_table"]["channels"],
+                                  exact["rec_table"]["channels"])
+    # the kernel is truncated at 4 * ref_distance. Each of the 200
+    # stations drops at most exp(-16) from a kernel sum of at least 1,
+    # so the weights agree to about 200 * exp(-16) = 2.3e-5
+    np.testing.assert_allclose(kdtree["rec_table"]["weights"],
+                               exact["rec_table"]["weights"], rtol=1e-4)
+    for comp, cond_num in exact["rec_cond_nums"].iteritems():
+        np.testing.assert_allclose(kdtree["rec_cond_nums"][comp], cond_num,
+                                   rtol=1e-4)